@@ -0,0 +1,500 @@
+# encoding=utf-8
+import asyncio
+import os
+import queue
+import random
+import re
+import threading
+from contextlib import asynccontextmanager
+
+import aiohttp
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from concurrency import AimdController, AsyncGate
+import extract
+from manifest import Manifest
+import pixivdb
+from pixivspider import PixivSpiderLogin, TryError
+from progressbar import ProgressBar
+import transcode
+
+
+# 基于asyncio的爬取引擎:
+# 一个事件循环里同时进行成千上万个请求, 只受连接数限制, 不再依赖多进程+多线程
+# max_connections: 同时打开的连接总数上限, 也是并发窗口的上限
+# per_host: 每个host同时打开的连接上限, 也是并发窗口的初始值
+# 同时进行的请求数由AIMD并发窗口(self.concurrency)根据延迟和错误率调整
+# 其他参数与PixivSpiderLogin相同
+# arun_* 是协程版本; 原来的同步方法保留, 只是在新的事件循环中运行对应的协程
+class AsyncPixivSpider(PixivSpiderLogin):
+    def __init__(self, path='D:/PixivSpider/', max_connections=1000, per_host=100, **kwargs):
+        super().__init__(path, **kwargs)
+        self.max_connections = max_connections
+        self.per_host = per_host
+        self.concurrency = AimdController(initial=min(per_host, max_connections), maximum=max_connections)
+        self._gate = AsyncGate(self.concurrency)
+        self._client_session = None
+        self._seen_users = 0
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['_client_session'] = None
+        state['_gate'] = None
+        state['_seen_users'] = 0
+        return state
+
+    # 在同一次运行中共用一个ClientSession(连接池) 可以嵌套使用
+    @asynccontextmanager
+    async def client_session(self):
+        if self._client_session is not None:
+            yield self._client_session
+            return
+        connector = aiohttp.TCPConnector(limit=self.max_connections, limit_per_host=self.per_host)
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=50, sock_read=50)
+        cookies = {name: value for name, value in self.cookies.items()}
+        # asyncio.Condition属于当前的事件循环 每次运行重新建立
+        self._gate = AsyncGate(self.concurrency)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout, cookies=cookies) as session:
+            self._client_session = session
+            try:
+                yield session
+            finally:
+                self._client_session = None
+
+    # 已下载作品id集合 同一个事件循环中同时运行的arun_pixiv_pages共用一个SeenSet, 最后一个退出时关闭
+    # 没有设置seen_path时得到None
+    @asynccontextmanager
+    async def seen_set(self):
+        if self.seen_path is None:
+            yield None
+            return
+        if self._seen_users == 0:
+            self._seen_set = self.open_seen_set()
+        self._seen_users += 1
+        try:
+            yield self._seen_set
+        finally:
+            self._seen_users -= 1
+            if self._seen_users == 0:
+                self._seen_set.close()
+                self._seen_set = None
+
+    def random_headers(self):
+        return dict(self.base_headers[random.randint(0, len(self.base_headers) - 1)])
+
+    # GET请求 返回(status, 内容) result_type: 'bytes' 'text' 'json'
+    # 按retry_policy重试 (try_time 最多尝试的次数, 缺省按retry_policy)
+    # 与get_response一样经过response_cache (同样的key和策略, 同步和异步引擎共用缓存) 命中缓存时不占用令牌和并发窗口
+    async def afetch(self, url, params=None, headers=None, result_type='bytes', try_time=None):
+        if headers is None:
+            headers = self.random_headers()
+        if params is not None:
+            params = {key: str(value) for key, value in params.items()}
+        async with self.client_session() as session:
+            async def request(_url, params=None, headers=None, **kwargs):
+                if self.request_limiter is not None:
+                    await self.request_limiter.aacquire()
+                async with self._gate.track() as call, session.get(_url, params=params, headers=headers) as resp:
+                    call.status(resp.status)
+                    return await self.as_response(resp)
+
+            async def once():
+                if self.response_cache is None:
+                    return await request(url, params=params, headers=headers)
+                return await self.response_cache.aget(request, url, params=params, headers=headers,
+                                                      cookies=self.cookies)
+
+            r = await self.request_policy(try_time).arun(once)
+            if result_type == 'json':
+                return r.status_code, r.json()
+            if result_type == 'text':
+                return r.status_code, r.text
+            return r.status_code, r.content
+
+    # aiohttp的响应读出内容 转换为requests.Response (可以写入ResponseCache)
+    @staticmethod
+    async def as_response(resp):
+        r = requests.Response()
+        r.status_code = resp.status
+        r.url = str(resp.url)
+        r.headers = CaseInsensitiveDict(resp.headers)
+        r._content = await resp.read()
+        r.encoding = requests.utils.get_encoding_from_headers(r.headers)
+        return r
+
+    # 获取网页的lxml根节点 (extract中预编译的XPath使用)
+    async def afetch_html_root(self, url, params=None, headers=None):
+        status, content = await self.afetch(url, params=params, headers=headers)
+        return extract.parse_html(content)
+
+    # 下载某一个图片 与download_pic相同: 写入.part临时文件, 中断后用Range从断点继续
+    async def adownload_pic(self, page_url, pic_url, path, chunk_size=None, max_retries=None):
+        if chunk_size is None:
+            chunk_size = self.chunk_size
+        if max_retries is None:
+            max_retries = self.download_retries
+        policy = self.retry_policy.derive(max_attempts=max_retries + 1, deadline=None)
+        await policy.arun(lambda: self.adownload_pic_range(page_url, pic_url, path, chunk_size))
+
+    async def adownload_pic_range(self, page_url, pic_url, path, chunk_size):
+        temp_path = path + '.part'
+        ledger_path = temp_path + '.json'
+        ledger = self.read_download_ledger(ledger_path)
+        offset = 0
+        if ledger is not None and ledger['url'] == pic_url and os.path.exists(temp_path):
+            offset = os.path.getsize(temp_path)
+            if ledger['length'] and offset > ledger['length']:
+                offset = 0
+        else:
+            ledger = None
+        headers = {"Accept": "image/webp,image/*,*/*;q=0.8",
+                   "Referer": page_url,
+                   "User-Agent": self.random_headers()["User-Agent"]}
+        if offset > 0:
+            headers['Range'] = 'bytes=%d-' % offset
+            if_range = ledger['etag'] or ledger['last_modified']
+            if if_range:
+                headers['If-Range'] = if_range
+        async with self.client_session() as session:
+            # 下载的整个过程占用一个并发位置
+            async with self._gate.track() as call, session.get(pic_url, headers=headers) as resp:
+                call.status(resp.status)
+                if resp.status == 416 and ledger is not None and offset == ledger['length']:
+                    self.finish_download(temp_path, ledger_path, path, ledger['length'])
+                    return
+                if resp.status == 416 and offset > 0:
+                    raise self.discard_download(temp_path, ledger_path, '断点无效 416')
+                if resp.status == 200:
+                    offset = 0
+                elif resp.status != 206:
+                    raise TryError(resp.status)
+                elif not resp.headers.get('Content-Range', '').startswith('bytes %d-' % offset):
+                    raise self.discard_download(temp_path, ledger_path,
+                                                'Content-Range不匹配 %s' % resp.headers.get('Content-Range'))
+                content_size = int(resp.headers.get('Content-Length', 0))
+                ledger = {'url': pic_url,
+                          'length': offset + content_size if content_size else 0,
+                          'etag': resp.headers.get('ETag', ledger['etag'] if ledger else None),
+                          'last_modified': resp.headers.get('Last-Modified',
+                                                            ledger['last_modified'] if ledger else None),
+                          'received': offset}
+                self.write_download_ledger(ledger_path, ledger)
+                with open(temp_path, 'ab' if offset else 'wb') as code:
+                    try:
+                        async for data in resp.content.iter_chunked(chunk_size):
+                            code.write(data)
+                            if self.byte_limiter is not None:
+                                await self.byte_limiter.aacquire(len(data))
+                    except (aiohttp.ClientError, asyncio.TimeoutError):
+                        call.fail()
+                        code.flush()
+                        ledger['received'] = code.tell()
+                        self.write_download_ledger(ledger_path, ledger)
+                        raise
+        try:
+            self.finish_download(temp_path, ledger_path, path, ledger['length'])
+        except Exception as error:
+            raise aiohttp.ClientPayloadError(str(error))
+        print(path.split('/')[-1], '下载完成')
+
+    # run_pixiv_page的协程版本
+    async def arun_pixiv_page(self, illust_id, path):
+        if self.manifest is not None and self.manifest.is_complete(illust_id, path):
+            print('file exist')
+            return True
+        loop = asyncio.get_running_loop()
+        if await loop.run_in_executor(None, self.link_from_store, illust_id, path):
+            print(illust_id, 'linked')
+            return True
+        directory = path
+        process_page = "http://www.pixiv.net/member_illust.php?mode=medium&illust_id=%s" % illust_id
+        html_root = await self.afetch_html_root(process_page)
+        info = self.parse_illust_page(html_root, illust_id)
+        if info is None:
+            print(illust_id, '作品不存在或不可见')
+            return
+        # 单图
+        if info.type == 'single':
+            file_path = path + self.single_file_name(info)
+            if os.path.exists(file_path):
+                print('file exist')
+            else:
+                await self.adownload_pic(process_page, info.data_src, file_path)
+            # 计算sha1写入清单在线程池里进行
+            return await loop.run_in_executor(None, self.record_download, illust_id, directory, [(0, file_path)])
+        # 多图 manga_big页面同时请求
+        elif info.type == 'multiple':
+            path, save_file_name = self.multiple_save_path(info, path)
+            manga_page = await self.afetch_html_root(info.manga_page_url)
+            download_args, item_urls = self.parse_manga_page(manga_page, info.manga_page_url, path, save_file_name)
+            coroutines = [self.adownload_pic(*arg) for arg in download_args]
+            if item_urls:
+                coroutines.append(self.adownload_manga_pages(item_urls, path, save_file_name))
+            await asyncio.gather(*coroutines)
+            return await loop.run_in_executor(None, self.record_download, illust_id, directory,
+                                              Manifest.page_files(path, save_file_name))
+        # 动图 交给转码进程池(arun_pixiv_pages中) 或在线程池里转码 不阻塞事件循环
+        elif info.type == 'ugoira':
+            zip_path = path + self.ugoira_file_name(info)
+            if os.path.exists(zip_path):
+                print('file exist')
+            else:
+                await self.adownload_pic(process_page, self.ugoira_zip_url(info.ugoku_data), zip_path)
+            return await loop.run_in_executor(None, self.transcode_ugoira, illust_id, directory, zip_path,
+                                              info.ugoku_data)
+
+    # download_manga_pages的协程版本 只请求第一个manga_big页面, 每一页推出地址后立即开始下载
+    async def adownload_manga_pages(self, item_urls, path, save_file_name):
+        first_src = extract.manga_big_src(await self.afetch_html_root(item_urls[0]))
+
+        async def run_page(url):
+            index = re.split(r'=', url)[-1]
+            arg = self.manga_download_arg(url, self.manga_original_url(first_src, index), path, save_file_name, index)
+            if arg is None:
+                return
+            try:
+                await self.adownload_pic(*arg)
+            except TryError as error:
+                if error.args[0] != 404:
+                    raise
+                arg = self.manga_big_download_arg(await self.afetch_html_root(url), url, path, save_file_name)
+                if arg is not None:
+                    await self.adownload_pic(*arg)
+
+        await asyncio.gather(*[run_page(url) for url in item_urls])
+
+    # 同时下载illust_id_list中的所有作品 一个作品出错不影响其他作品
+    # 设置了seen_path时先跳过已下载的作品, 下载完成的作品加入集合
+    # 使用任务队列时作品先加入队列, 每一轮取出队列中的全部任务(包括上次中断时没有完成的)同时下载,
+    # 失败的任务放回队列在下一轮重试, 直到没有可以取出的任务
+    async def arun_pixiv_pages(self, illust_id_list, path):
+        jobs = self.job_queue
+        async with self.seen_set() as seen, self.client_session():
+            with self.renewing_jobs(), self.transcoding():
+                illust_id_list = self.filter_seen(illust_id_list, seen, path)
+                if jobs is not None:
+                    print('新加入的任务:', jobs.enqueue(illust_id_list, path))
+                    illust_id_list = await self.aclaim_jobs(path)
+                while illust_id_list:
+                    results = await asyncio.gather(*[self.arun_pixiv_page(illust_id, path)
+                                                     for illust_id in illust_id_list], return_exceptions=True)
+                    for illust_id, result in zip(illust_id_list, results):
+                        if isinstance(result, BaseException):
+                            print(illust_id, result)
+                            if jobs is not None:
+                                jobs.fail(illust_id, path, repr(result))
+                            continue
+                        # 交给转码进程的动图 由转码的回调更新任务队列和seen
+                        if result == transcode.QUEUED:
+                            continue
+                        if jobs is not None:
+                            jobs.finish(illust_id, path, result)
+                        if result and seen is not None:
+                            seen.add(illust_id)
+                    illust_id_list = await self.aclaim_jobs(path) if jobs is not None else []
+                if jobs is not None:
+                    print('任务:', jobs.counts(path))
+        print("download finished")
+
+    # 取出path中全部可以下载的任务 没有时等待转码中的动图(失败的会放回队列), 都完成后返回空列表
+    async def aclaim_jobs(self, path):
+        while True:
+            illust_ids = self.job_queue.claim(path, None)
+            if illust_ids or self.transcode_pending() == 0:
+                return illust_ids
+            await asyncio.sleep(1)
+
+    # run_pixiv_ranking的协程版本 json的每一页同时请求
+    async def arun_pixiv_ranking(self, content='all', mode='daily', date='', search_range=(1, 50), filter_func=None):
+        base_url = 'http://www.pixiv.net/ranking.php'
+        params = self.ranking_params(content, mode, date)
+        if params is None:
+            return
+        async with self.client_session():
+            status, content = await self.afetch(base_url, params=params)
+            if re.match(r'4\d\d', str(status)):
+                print("发生了错误")
+                return
+            save_dir, tt = self.ranking_page_info(extract.parse_html(content))
+            params['p'] = 1
+            params['format'] = 'json'
+            params['tt'] = tt
+            status, json = await self.afetch(base_url, params=params, result_type='json')
+            if re.match(r'4\d\d', str(status)):
+                print(json['error'])
+                return
+            plan = self.ranking_plan(search_range, int(json['rank_total']))
+            if plan is None:
+                return
+
+            async def get_ids(p, i_begin, i_end):
+                _params = dict(params, p=p)
+                _status, _json = await self.afetch(base_url, params=_params, result_type='json')
+                if re.match(r'4\d\d', str(_status)):
+                    print(_json['error'], "p站欺骗了我")
+                    return []
+                return self.filter_ranking_items(_json['contents'][i_begin - 1:i_end], filter_func)
+
+            illust_ids = []
+            for ids in await asyncio.gather(*[get_ids(*item) for item in plan]):
+                illust_ids.extend(ids)
+            await self.arun_pixiv_pages(illust_ids, save_dir)
+
+    # run_pixiv_user的协程版本
+    async def arun_pixiv_user(self, user_id, method="illust", search_type="", tag="", order="desc", rest="show",
+                              untagged="", page='1'):
+        request = self.user_request(user_id, method, search_type, tag, order, rest, untagged, page)
+        if request is None:
+            return
+        url, params, current_method = request
+        async with self.client_session():
+            html_root = await self.afetch_html_root(url, params=params)
+            path = self.user_save_path(html_root, user_id, method, current_method)
+            if path is None:
+                return
+            illust_ids = self.listing_illust_ids(html_root)
+            # 列表页只能一页一页地翻 收集全部作品后一次下载 (同一个目录只有一个arun_pixiv_pages取任务)
+            next_url = self.listing_next_url(html_root)
+            while next_url is not None:
+                html_root = await self.afetch_html_root(next_url)
+                illust_ids.extend(self.listing_illust_ids(html_root))
+                next_url = self.listing_next_url(html_root)
+            await self.arun_pixiv_pages(illust_ids, path)
+
+    # run_pixiv_recommended的协程版本
+    async def arun_pixiv_recommended(self, folder='推荐', num_recommendations=500, sample_illusts=None, tags=None,
+                                     match_mode=0, strict_fliter=False):
+        recommender_url = 'http://www.pixiv.net/rpc/recommender.php'
+        illust_list_url = 'http://www.pixiv.net/rpc/illust_list.php'
+        params, headers = self.recommended_request(sample_illusts, num_recommendations)
+        async with self.client_session():
+            status, recommender_json = await self.afetch(recommender_url, params=params, headers=headers,
+                                                         result_type='json')
+            if re.match(r'4\d\d', str(status)):
+                print("发生了错误")
+                return
+            recommender_list = recommender_json['recommendations']
+            print("获得插画:", len(recommender_list))
+            if tags:
+                print("筛选插画列表:")
+            # 每700个作品一次illust_list请求 同时进行
+            chunks = [recommender_list[i:i + 700] for i in range(0, len(recommender_list), 700)]
+            results = await asyncio.gather(*[self.afetch(illust_list_url, params=self.illust_list_params(chunk),
+                                                         headers=headers, result_type='json') for chunk in chunks])
+            illust_id_list = []
+            for status, json in results:
+                illust_id_list.extend(self.filter_recommended(json, tags, match_mode, strict_fliter))
+            if tags:
+                print("筛选插画:", len(illust_id_list))
+            path = self.savePath + folder + '/'
+            print(path)
+            if os.path.exists(path):
+                print('this dir exists')
+            else:
+                os.makedirs(path)
+            await self.arun_pixiv_pages(illust_id_list, path)
+
+    # run_pixiv_ranking_update_database_threading的协程版本
+    # 所有content/mode/date组合的json同时请求, 数据库仍然由一个消费线程写入
+    async def arun_pixiv_ranking_update_database_threading(self, db_path, **kwargs):
+        self.create_pixiv_ranking_database(db_path)
+        content_mode, date, save_img = self.ranking_update_combinations(**kwargs)
+        base_url = 'http://www.pixiv.net/ranking.php'
+        loop = asyncio.get_running_loop()
+        first_params = []
+        for item_date in date:
+            for combine in content_mode:
+                params = {'format': 'json', 'tt': self.pixiv_context_token, 'content': combine[0], 'mode': combine[1]}
+                if item_date != '':
+                    params['date'] = item_date
+                first_params.append(params)
+
+        async with self.client_session():
+            # 第一页 得到rank_total 计算总数量
+            bar = ProgressBar('预处理', len(first_params), ProgressBar.none_transfrom(), run_status='处理中',
+                              fin_status='处理完成')
+
+            async def get_first(_params):
+                _status, _json = await self.afetch(base_url, params=_params, result_type='json')
+                bar.refresh(1)
+                if re.match(r'4\d\d', str(_status)):
+                    print('{} {} {} {}'.format(_params['content'], _params['mode'], _params.get('date', ''),
+                                               _json['error']))
+                    return None
+                return _json
+
+            first_pages = [json for json in await asyncio.gather(*[get_first(p) for p in first_params]) if json]
+            bar.close()
+            total_progress = sum(int(json['rank_total']) for json in first_pages)
+
+            # 更新数据库
+            queue_for_contents = queue.Queue()
+            consumer_thread = threading.Thread(target=self.ranking_database_consumer,
+                                               args=(db_path, queue_for_contents, total_progress))
+            consumer_thread.start()
+
+            async def get_contents(_params):
+                _status, _json = await self.afetch(base_url, params=_params, result_type='json')
+                if re.match(r'4\d\d', str(_status)):
+                    queue_for_contents.put({'contents': []})
+                    return
+                queue_for_contents.put(_json)
+
+            remain_params = []
+            for json in first_pages:
+                queue_for_contents.put(json)
+                rank_total = int(json['rank_total'])
+                max_p = rank_total // 50 + (1 if (rank_total % 50) > 0 else 0)
+                for p in range(2, max_p + 1):
+                    remain_params.append({'format': 'json', 'tt': self.pixiv_context_token, 'content': json['content'],
+                                          'mode': json['mode'], 'date': json['date'], 'p': p})
+            await asyncio.gather(*[get_contents(p) for p in remain_params])
+            queue_for_contents.put(None)
+            await loop.run_in_executor(None, consumer_thread.join)
+
+            # 下载缩略图
+            if save_img:
+                connect = pixivdb.connect(db_path, check_same_thread=False)
+                rows = self.ranking_thumbnail_rows(connect)
+                if rows is None:
+                    return
+                cursor, row_count = rows
+                rows = cursor.fetchall()
+                consumer_thread = threading.Thread(target=self.ranking_thumbnail_consumer,
+                                                   args=(connect, db_path, queue_for_contents, row_count))
+                consumer_thread.start()
+
+                store = self.get_thumbnail_store(db_path)
+
+                async def get_img(_id, url):
+                    _status, img = await self.afetch(url)
+                    if _status != 200:
+                        return
+                    img_hash = await loop.run_in_executor(None, store.put, img)
+                    queue_for_contents.put((img_hash, _id))
+
+                await asyncio.gather(*[get_img(*row) for row in rows])
+                queue_for_contents.put(None)
+                await loop.run_in_executor(None, consumer_thread.join)
+                connect.commit()
+                connect.close()
+
+    # 同步接口 在新的事件循环中运行对应的协程
+    def run_pixiv_page(self, illust_id, path):
+        asyncio.run(self.arun_pixiv_page(illust_id, path))
+
+    def async_run_pixiv_page(self, illust_id_list, path):
+        asyncio.run(self.arun_pixiv_pages(illust_id_list, path))
+
+    def run_pixiv_ranking(self, *args, **kwargs):
+        asyncio.run(self.arun_pixiv_ranking(*args, **kwargs))
+
+    def run_pixiv_user(self, *args, **kwargs):
+        asyncio.run(self.arun_pixiv_user(*args, **kwargs))
+
+    def run_pixiv_recommended(self, *args, **kwargs):
+        asyncio.run(self.arun_pixiv_recommended(*args, **kwargs))
+
+    def run_pixiv_ranking_update_database_threading(self, db_path, **kwargs):
+        asyncio.run(self.arun_pixiv_ranking_update_database_threading(db_path, **kwargs))
@@ -0,0 +1,114 @@
+# encoding=utf-8
+import os
+import re
+import sys
+import time
+
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import extract
+
+# 对比 BeautifulSoup(lxml)建立完整的树再find 和 extract中lxml+预编译XPath 的解析速度
+# python benchmarks/bench_extract.py 保存的html目录 [重复次数]
+# 目录中的文件按名字前缀区分页面类型:
+# illust_*.html 作品页面; manga_*.html 多图页面; listing_*.html 用户作品/收藏列表;
+# search_*.html 搜索结果; ranking_*.html 排行榜页面
+# (可以用PixivSpiderLogin.save_html_page保存)
+
+
+# 原来的BeautifulSoup解析方式
+def soup_illust(content):
+    html_root = BeautifulSoup(content, "lxml")
+    works_display = html_root.find('div', {'class': 'works_display'})
+    if works_display is None:
+        return None
+    content_title_user_name = html_root.find('meta', {'property': 'og:title'})['content']
+    m = re.match(r'「(.*?)」/「(.*?)」.*', content_title_user_name)
+    display_type = works_display.div['class'][-1]
+    if display_type == 'ui-modal-trigger':
+        return m.group(1), m.group(2), html_root.find('img', {'class': 'original-image'})['data-src']
+    elif display_type == '_layout-thumbnail':
+        return m.group(1), m.group(2), works_display.a['href']
+    elif display_type == '_ugoku-illust-player-container':
+        return m.group(1), m.group(2), re.search(r'pixiv.context.ugokuIllustFullscreenData\s*=\s*\{(.+?)\};',
+                                                 html_root.get_text()).group(1)
+    return m.group(1), m.group(2)
+
+
+def soup_manga(content):
+    html_root = BeautifulSoup(content, "lxml")
+    item_container = html_root.find_all('div', {'class': 'item-container'})
+    if not item_container:
+        return re.findall(r'pixiv\.context\.originalImages\[\d+\]\s*=\s*\"(.+?)\";', html_root.get_text())
+    return ["http://www.pixiv.net/" + item.a['href'] for item in item_container]
+
+
+def soup_listing(content):
+    html_root = BeautifulSoup(content, "lxml")
+    if html_root.find('div', {'class': 'error-unit'}) is not None:
+        return None
+    user_name = html_root.find('h1', {'class': 'user'}).get_text()
+    ids = [item.img['data-id'] for item in html_root.find_all('li', {'class': 'image-item'})]
+    next_span = html_root.find('span', {'class': 'next'})
+    return user_name, ids, next_span is not None and next_span.a is not None
+
+
+def soup_search(content):
+    html_root = BeautifulSoup(content, "lxml")
+    count_badge = html_root.find('span', {'class': 'count-badge'}).get_text()
+    search_result = html_root.find('section', {'class': 'column-search-result'})
+    return re.search(r'\d+', count_badge).group(), [item.img['data-id'] for item in
+                                                    search_result.find_all('li', {'class': 'image-item'})]
+
+
+def soup_ranking(content):
+    html_root = BeautifulSoup(content, "lxml")
+    current_title = html_root.find('h1', {'class': 'column-title'}).a.get_text()
+    current_date = html_root.find('ul', {'class': 'sibling-items'}).find('a', {'class': 'current'}).get_text()
+    return current_title, current_date, html_root.find('input', {'name': 'tt'})['value']
+
+
+# (BeautifulSoup解析, extract解析)
+PARSERS = {
+    'illust': (soup_illust, lambda content: extract.illust_page(extract.parse_html(content), 0)),
+    'manga': (soup_manga, lambda content: extract.manga_page(extract.parse_html(content))),
+    'listing': (soup_listing, lambda content: extract.user_listing(extract.parse_html(content))),
+    'search': (soup_search, lambda content: extract.search_result(extract.parse_html(content))),
+    'ranking': (soup_ranking, lambda content: extract.ranking_page(extract.parse_html(content))),
+}
+
+
+def timeit(func, contents, repeat):
+    t = time.perf_counter()
+    for _ in range(repeat):
+        for content in contents:
+            func(content)
+    return time.perf_counter() - t
+
+
+def main(fixture_dir, repeat=20):
+    fixtures = {}
+    for name in sorted(os.listdir(fixture_dir)):
+        kind = name.split('_', 1)[0]
+        if kind in PARSERS:
+            with open(os.path.join(fixture_dir, name), 'rb') as f:
+                fixtures.setdefault(kind, []).append(f.read())
+    if not fixtures:
+        print('没有找到html文件 (文件名以 %s 开头)' % ' '.join(PARSERS))
+        return
+    print('%-8s %5s %12s %12s %8s' % ('page', 'files', 'soup ms', 'xpath ms', 'speedup'))
+    for kind, contents in fixtures.items():
+        soup_func, xpath_func = PARSERS[kind]
+        soup_time = timeit(soup_func, contents, repeat)
+        xpath_time = timeit(xpath_func, contents, repeat)
+        count = len(contents) * repeat
+        print('%-8s %5d %12.3f %12.3f %7.1fx' % (kind, len(contents), soup_time * 1000 / count,
+                                                xpath_time * 1000 / count, soup_time / xpath_time))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('python benchmarks/bench_extract.py 保存的html目录 [重复次数]')
+    else:
+        main(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 20)
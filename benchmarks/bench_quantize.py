@@ -0,0 +1,84 @@
+# encoding=utf-8
+import os
+import sys
+import tempfile
+import time
+import zipfile
+
+import numpy as np
+from PIL import Image, ImageSequence
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import quantize
+import ugoira
+
+# 对比动图zip转gif的方式: 每一帧单独计算调色板(ADAPTIVE + Floyd-Steinberg) 和 quantize中的全局调色板
+# python benchmarks/bench_quantize.py 动图zip的目录 [重复次数]
+# 目录中的 xxx.zip 旁边有 xxx.json (作品页面中的ugokuIllustFullscreenData) 时按其中的帧顺序和延时,
+# 否则按zip中的文件名顺序 每帧100ms
+# 输出: 每个zip的平均转换时间 gif大小 和原始帧对比的PSNR(越大越接近原图)
+
+METHODS = [
+    ('adaptive', lambda zip_path, gif_path, frames: ugoira.zip_to_gif(zip_path, gif_path, frames)),
+    ('global', lambda zip_path, gif_path, frames: quantize.zip_to_gif(zip_path, gif_path, frames, crop=False)),
+    ('global+crop', lambda zip_path, gif_path, frames: quantize.zip_to_gif(zip_path, gif_path, frames)),
+]
+
+
+def load_frames(zip_path):
+    json_path = zip_path[:-4] + '.json'
+    if os.path.exists(json_path):
+        with open(json_path, encoding='utf-8') as f:
+            return ugoira.ugoira_frames(f.read().strip().strip('{}'))
+    with zipfile.ZipFile(zip_path) as file_zip:
+        return [(name, 100) for name in sorted(file_zip.namelist())]
+
+
+# 所有帧的平均PSNR gif的每一帧按合成后的完整画面比较
+def psnr(zip_path, frames, gif_path):
+    values = []
+    with Image.open(gif_path) as gif:
+        for (source, _), frame in zip(ugoira.iter_frames(zip_path, frames), ImageSequence.Iterator(gif)):
+            a = np.asarray(source.convert('RGB'), dtype=np.float64)
+            b = np.asarray(frame.convert('RGB'), dtype=np.float64)
+            mse = ((a - b) ** 2).mean()
+            values.append(99.0 if mse == 0 else 10 * np.log10(255.0 ** 2 / mse))
+    return sum(values) / len(values)
+
+
+def main(zip_dir, repeat=3):
+    zip_paths = [os.path.join(zip_dir, name) for name in sorted(os.listdir(zip_dir)) if name.endswith('.zip')]
+    if not zip_paths:
+        print('没有找到zip文件')
+        return
+    totals = {name: [0.0, 0, 0.0] for name, _ in METHODS}
+    print('%-24s %-12s %6s %10s %10s %8s' % ('zip', 'method', 'frames', 'ms', 'KB', 'PSNR'))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for zip_path in zip_paths:
+            frames = load_frames(zip_path)
+            for name, convert in METHODS:
+                gif_path = os.path.join(temp_dir, name + '.gif')
+                t = time.perf_counter()
+                for _ in range(repeat):
+                    convert(zip_path, gif_path, frames)
+                elapsed = (time.perf_counter() - t) / repeat
+                size = os.path.getsize(gif_path)
+                quality = psnr(zip_path, frames, gif_path)
+                totals[name][0] += elapsed
+                totals[name][1] += size
+                totals[name][2] += quality
+                print('%-24s %-12s %6d %10.1f %10.1f %8.2f' % (os.path.basename(zip_path)[:24], name, len(frames),
+                                                               elapsed * 1000, size / 1024, quality))
+    base_time, base_size, _ = totals['adaptive']
+    print()
+    print('%-12s %10s %10s %8s %10s %10s' % ('method', 'ms', 'KB', 'PSNR', 'speedup', 'size'))
+    for name, (elapsed, size, quality) in totals.items():
+        print('%-12s %10.1f %10.1f %8.2f %9.2fx %9.1f%%' % (name, elapsed * 1000, size / 1024, quality / len(zip_paths),
+                                                           base_time / elapsed, size * 100.0 / base_size))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('python benchmarks/bench_quantize.py 动图zip的目录 [重复次数]')
+    else:
+        main(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 3)
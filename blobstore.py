@@ -0,0 +1,72 @@
+# encoding=utf-8
+import os
+import shutil
+import threading
+
+from manifest import Manifest
+
+
+# 按内容寻址的原图存储:
+# 每张原图只在 root/sha1前两位/接下来两位/sha1.扩展名 保存一份
+# 排行榜 用户 推荐等按名字整理的文件夹里放的是指向它的硬链接(link='hard')或符号链接(link='sym')
+# 硬链接要求和root在同一个分区; 建立链接失败(跨分区, 没有权限)时退回复制文件
+# 注意 硬链接的文件是同一个文件, 修改其中一个, 其他文件夹里的也会改变
+class BlobStore(object):
+    def __init__(self, root, link='hard'):
+        if link not in ('hard', 'sym'):
+            raise ValueError("link 只能是 'hard' 或 'sym'")
+        self.root = root if root.endswith('/') else root + '/'
+        self.link_type = link
+
+    def path(self, sha1, ext):
+        return self.root + sha1[:2] + '/' + sha1[2:4] + '/' + sha1 + ext
+
+    def exists(self, sha1, ext):
+        return os.path.exists(self.path(sha1, ext))
+
+    @staticmethod
+    def _temp_path(path):
+        return '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+
+    @staticmethod
+    def _makedirs(path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    # 在dest建立指向blob的链接 (dest已存在时替换)
+    def link(self, blob, dest):
+        self._makedirs(dest)
+        temp_path = self._temp_path(dest)
+        try:
+            if self.link_type == 'hard':
+                os.link(blob, temp_path)
+            else:
+                os.symlink(os.path.abspath(blob), temp_path)
+        except OSError:
+            shutil.copyfile(blob, temp_path)
+        os.replace(temp_path, dest)
+
+    # 把已下载的文件放进存储 原位置换成链接 返回sha1
+    # 已经存储过同样内容的文件时只把原位置换成链接
+    def add(self, file_path, sha1=None):
+        sha1 = sha1 or Manifest.file_sha1(file_path)
+        blob = self.path(sha1, os.path.splitext(file_path)[1])
+        if os.path.exists(blob):
+            if not os.path.samefile(blob, file_path):
+                self.link(blob, file_path)
+            return sha1
+        self._makedirs(blob)
+        temp_path = self._temp_path(blob)
+        if self.link_type == 'hard':
+            try:
+                os.link(file_path, temp_path)
+                os.replace(temp_path, blob)
+                return sha1
+            except OSError:
+                pass
+        # 符号链接 或 不能建立硬链接时: 文件移进存储 原位置放链接
+        shutil.copyfile(file_path, temp_path)
+        os.replace(temp_path, blob)
+        self.link(blob, file_path)
+        return sha1
@@ -0,0 +1,186 @@
+# encoding=utf-8
+import asyncio
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+# 表示服务器过载的状态码 其他4xx是请求本身的问题, 不算拥塞
+CONGESTION_STATUS = (429, 500, 502, 503, 504)
+
+
+# AIMD(加性增 乘性减)并发控制:
+# window 为同时进行的请求数上限, 每完成约window个请求为一轮
+# 一轮中 错误率不超过error_rate 且平均延迟不超过 基准延迟*latency_factor 时 window += increase
+# 遇到错误(异常 429 5xx)时立即 window *= decrease, 每轮最多减一次, 持续出错时按轮次指数减小
+# 平均延迟变差时在这一轮结束时减小
+# 基准延迟为各轮平均延迟的最小值, 慢慢向当前值回升 (网络环境变化后不会一直偏低)
+# 线程安全; pickle时(传给子进程)保留当前window 等待中的线程不会被复制
+class AimdController(object):
+    def __init__(self, initial=10, minimum=1, maximum=64, increase=1, decrease=0.5, latency_factor=2.0,
+                 error_rate=0.05):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.window = float(min(max(initial, self.minimum), self.maximum))
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.error_rate = error_rate
+        self.in_flight = 0
+        self.baseline = None
+        self.increases = 0
+        self.decreases = 0
+        self._cond = threading.Condition()
+        self._new_round()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_cond'] = None
+        state['in_flight'] = 0
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._cond = threading.Condition()
+
+    def _new_round(self):
+        self._count = 0
+        self._errors = 0
+        self._latency = 0.0
+        self._decreased = False
+
+    @property
+    def limit(self):
+        return int(self.window)
+
+    # 当前的状态 用于打印或监控
+    def metrics(self):
+        with self._cond:
+            return {'window': self.limit, 'in_flight': self.in_flight, 'baseline_latency': self.baseline,
+                    'round_requests': self._count, 'round_errors': self._errors,
+                    'increases': self.increases, 'decreases': self.decreases}
+
+    # 不等待 有空位时占用一个并返回开始时间, 没有空位返回None
+    def try_acquire(self):
+        with self._cond:
+            if self.in_flight >= self.limit:
+                return None
+            self.in_flight += 1
+            return time.monotonic()
+
+    # 等待空位 返回开始时间
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= self.limit:
+                self._cond.wait()
+            self.in_flight += 1
+            return time.monotonic()
+
+    # 请求结束: start 为acquire的返回值, ok 是否健康; ignore为True时(例如命中缓存)不计入统计
+    # end 为计算延迟的结束时间(缺省为现在)
+    def release(self, start, ok=True, ignore=False, end=None):
+        with self._cond:
+            self.in_flight -= 1
+            if not ignore:
+                self._record((end or time.monotonic()) - start, ok)
+            self._cond.notify_all()
+
+    def _record(self, latency, ok):
+        self._count += 1
+        self._latency += latency
+        if not ok:
+            self._errors += 1
+            if not self._decreased:
+                self._backoff()
+                self._decreased = True
+        if self._count < max(self.limit, 1):
+            return
+        average = self._latency / self._count
+        if self.baseline is None or average < self.baseline:
+            self.baseline = average
+        else:
+            self.baseline += (average - self.baseline) * 0.05
+        if not self._decreased:
+            if self._errors / self._count > self.error_rate or average > self.baseline * self.latency_factor:
+                self._backoff()
+            elif self.window < self.maximum:
+                self.window = min(self.maximum, self.window + self.increase)
+                self.increases += 1
+        self._new_round()
+
+    def _backoff(self):
+        window = max(self.minimum, self.window * self.decrease)
+        if window < self.window:
+            self.decreases += 1
+        self.window = window
+
+    # 占用一个位置执行一次请求:
+    # with controller.track() as call:
+    #     r = requests.get(...)
+    #     call.status(r.status_code)
+    # 块中抛出异常算作错误 (已经调用过call.status时按状态码判断, 例如404后抛出的异常不算)
+    @contextmanager
+    def track(self):
+        call = Call()
+        start = self.acquire()
+        try:
+            yield call
+        except BaseException:
+            self.release(start, bool(call.ok), call.ignored, call.end)
+            raise
+        self.release(start, call.ok is not False, call.ignored, call.end)
+
+
+# track()中的一次请求
+# status(状态码) 收到响应头时调用: 判断是否拥塞, 延迟计算到这里(下载图片时不包括传输内容的时间)
+class Call(object):
+    def __init__(self):
+        self.ok = None
+        self.ignored = False
+        self.end = None
+
+    def status(self, status_code):
+        self.ok = status_code not in CONGESTION_STATUS
+        self.end = time.monotonic()
+
+    # 收到响应后传输中断等 算作错误
+    def fail(self):
+        self.ok = False
+
+    def ignore(self):
+        self.ignored = True
+
+
+# 在asyncio中使用AimdController: 协程等待空位时不阻塞事件循环
+# 只能在一个事件循环中使用
+class AsyncGate(object):
+    def __init__(self, controller):
+        self.controller = controller
+        self._cond = None
+
+    def _condition(self):
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    # async with gate.track() as call: 用法与AimdController.track相同
+    @asynccontextmanager
+    async def track(self):
+        cond = self._condition()
+        call = Call()
+        async with cond:
+            start = self.controller.try_acquire()
+            while start is None:
+                await cond.wait()
+                start = self.controller.try_acquire()
+        try:
+            yield call
+        except BaseException:
+            await self._release(start, bool(call.ok), call.ignored, call.end)
+            raise
+        await self._release(start, call.ok is not False, call.ignored, call.end)
+
+    async def _release(self, start, ok, ignored, end):
+        self.controller.release(start, ok, ignored, end)
+        cond = self._condition()
+        async with cond:
+            cond.notify_all()
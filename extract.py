@@ -0,0 +1,219 @@
+# encoding=utf-8
+import re
+from collections import namedtuple
+
+import lxml.html
+from lxml import etree
+
+# 页面提取层: 用lxml解析 + 预编译的XPath, 只取需要的几个节点, 返回小的namedtuple
+# 不再为每个页面建立完整的BeautifulSoup树(工作进程中最耗CPU的部分)
+
+
+# 作品页面 type: 'single' 单图; 'multiple' 多图; 'ugoira' 动图; None 未知
+# 单图 data_src: 原图地址; 多图 manga: 是否是漫画, manga_page_url: 多图页面地址; 动图 ugoku_data: 动图信息
+IllustPage = namedtuple('IllustPage', 'illust_id title user_name type data_src manga manga_page_url ugoku_data')
+# 多图页面 item_urls: 需要再请求的manga_big页面; original_urls: 页面中直接给出的原图地址(另一种漫画页面)
+MangaPage = namedtuple('MangaPage', 'item_urls original_urls')
+# 用户作品/收藏列表 error: 错误信息(h2, p) 或None; current_type: 作品类型(插画 漫画...); tag: 当前标签
+UserListing = namedtuple('UserListing', 'error user_name current_type tag illust_ids next_url')
+# 搜索结果 count: 结果数
+SearchResult = namedtuple('SearchResult', 'count illust_ids')
+# 排行榜页面 tt: 请求json用的token
+RankingPage = namedtuple('RankingPage', 'title date tt')
+# 首页 signed_in: cookies是否有效; token: pixiv.context.token
+HomePage = namedtuple('HomePage', 'signed_in token')
+# 旧版作品页面(PixivSpider 不登录) a_class: img-container中链接的class列表; text: 页面的全部文字(动图信息在脚本中)
+LegacyIllustPage = namedtuple('LegacyIllustPage', 'title user_name a_class img_src href text')
+
+
+# class属性中包含name (相当于css选择器 .name)
+# 取属性的XPath都用smart_strings=False 得到普通str, 不会引用整棵树
+def _has_class(name):
+    return "contains(concat(' ', normalize-space(@class), ' '), ' %s ')" % name
+
+
+SCRIPTS = etree.XPath('//script/text()', smart_strings=False)
+WORKS_DISPLAY = etree.XPath('//div[%s]' % _has_class('works_display'))
+OG_TITLE = etree.XPath("//meta[@property='og:title']/@content", smart_strings=False)
+ORIGINAL_IMAGE = etree.XPath('//img[%s]/@data-src' % _has_class('original-image'), smart_strings=False)
+ITEM_CONTAINER_HREF = etree.XPath('//div[%s]/a/@href' % _has_class('item-container'), smart_strings=False)
+FIRST_IMG_SRC = etree.XPath('(//img/@src)[1]', smart_strings=False)
+IMAGE_ITEM_ID = etree.XPath('//li[%s]//img/@data-id' % _has_class('image-item'), smart_strings=False)
+SEARCH_RESULT_ID = etree.XPath('//section[%s]//li[%s]//img/@data-id' % (_has_class('column-search-result'),
+                                                                           _has_class('image-item')),
+                               smart_strings=False)
+NEXT_HREF = etree.XPath('//span[%s]/a/@href' % _has_class('next'), smart_strings=False)
+ERROR_UNIT = etree.XPath('//div[%s]' % _has_class('error-unit'))
+USER_NAME = etree.XPath('//h1[%s]' % _has_class('user'))
+CURRENT_MENU = etree.XPath('//ul[%s]//a[%s]' % (_has_class('menu-items'), _has_class('current')))
+TAG_BADGE = etree.XPath('//span[%s]' % _has_class('tag-badge'))
+COUNT_BADGE = etree.XPath('//span[%s]' % _has_class('count-badge'))
+COLUMN_TITLE = etree.XPath('//h1[%s]/a' % _has_class('column-title'))
+CURRENT_DATE = etree.XPath('//ul[%s]//a[%s]' % (_has_class('sibling-items'), _has_class('current')))
+TT = etree.XPath("//input[@name='tt']/@value", smart_strings=False)
+SIGNUP_FORM = etree.XPath('//div[%s]' % _has_class('signup-form'))
+# 旧版页面和pixivision (PixivSpider)
+IMG_CONTAINER_A = etree.XPath('(//div[%s]//a)[1]' % _has_class('img-container'))
+MANGA_IMAGES = etree.XPath("//img[@data-filter='manga-image']")
+SIBLING_ITEMS = etree.XPath('(//ul[%s])[1]/li' % _has_class('sibling-items'))
+RANKING_ITEMS = etree.XPath('//section[%s]' % _has_class('ranking-item'))
+PIXIVISION_THUMBNAIL = etree.XPath('//div[%s]' % _has_class('aec__thumbnail-container'))
+PIXIVISION_CARDS = etree.XPath('//ul[%s]//li[%s]' % (_has_class('main-column-container'),
+                                                     _has_class('article-card-container')))
+TWITTER_TITLE = etree.XPath("//meta[@property='twitter:title']/@content", smart_strings=False)
+EYECATCH_HREF = etree.XPath('(//div[%s]//a)[1]/@href' % _has_class('_article-illust-eyecatch'), smart_strings=False)
+AM_WORKS = etree.XPath('//div[%s]' % _has_class('am__work'))
+
+TITLE_USER_PATTERN = re.compile(r'\u300c(.*?)\u300d/\u300c(.*?)\u300d.*')
+UGOKU_PATTERN = re.compile(r'pixiv.context.ugokuIllustFullscreenData\s*=\s*\{(.+?)\};')
+ORIGINAL_IMAGES_PATTERN = re.compile(r'pixiv\.context\.originalImages\[\d+\]\s*=\s*\"(.+?)\";')
+TOKEN_PATTERN = re.compile(r'pixiv\.context\.token\s*=\s*\"(.+?)\";')
+
+
+# pixiv的页面都是utf-8 bytes直接按utf-8解析, 不用再猜编码
+HTML_PARSER = lxml.html.HTMLParser(encoding='utf-8')
+
+
+# 解析html(bytes或str) 返回lxml的根节点 内容为空时返回None
+def parse_html(content):
+    if not content:
+        return None
+    if isinstance(content, str):
+        return lxml.html.fromstring(content)
+    return lxml.html.fromstring(content, parser=HTML_PARSER)
+
+
+def _first(results):
+    return results[0] if results else None
+
+
+def _text(element):
+    return str(element.text_content()) if element is not None else None
+
+
+def _scripts(root):
+    return '\n'.join(SCRIPTS(root))
+
+
+# 作品页面 作品不存在或不可见时返回None
+def illust_page(root, illust_id):
+    works_display = _first(WORKS_DISPLAY(root))
+    if works_display is None:
+        return None
+    m = TITLE_USER_PATTERN.match(OG_TITLE(root)[0])
+    title, user_name = m.group(1), m.group(2)
+    div = _first(works_display.xpath('.//div'))
+    display = div.get('class') if div is not None else None
+    display_type = display.split()[-1] if display else None
+    if display_type == 'ui-modal-trigger':
+        return IllustPage(illust_id, title, user_name, 'single', ORIGINAL_IMAGE(root)[0], None, None, None)
+    if display_type == '_layout-thumbnail':
+        a = works_display.xpath('.//a')[0]
+        return IllustPage(illust_id, title, user_name, 'multiple', None, 'manga' in a.get('class', '').split(),
+                          'http://www.pixiv.net/' + a.get('href'), None)
+    if display_type == '_ugoku-illust-player-container':
+        ugoku_data = UGOKU_PATTERN.search(_scripts(root)).group(1)
+        return IllustPage(illust_id, title, user_name, 'ugoira', None, None, None, ugoku_data)
+    return IllustPage(illust_id, title, user_name, None, None, None, None, None)
+
+
+# 多图页面
+def manga_page(root):
+    hrefs = ITEM_CONTAINER_HREF(root)
+    if hrefs:
+        return MangaPage(['http://www.pixiv.net/' + href for href in hrefs], [])
+    # 另一种漫画页面 e.g 54976833
+    original_urls = [url.replace('\\', '') for url in ORIGINAL_IMAGES_PATTERN.findall(_scripts(root))]
+    return MangaPage([], original_urls)
+
+
+# manga_big页面中的原图地址
+def manga_big_src(root):
+    return FIRST_IMG_SRC(root)[0]
+
+
+# 列表页面(用户作品 收藏 搜索结果)中的作品id
+def listing_illust_ids(root):
+    return list(IMAGE_ITEM_ID(root))
+
+
+# 列表页面的下一页地址 没有下一页返回None
+def listing_next_url(root):
+    href = _first(NEXT_HREF(root))
+    return None if href is None else 'http://www.pixiv.net/member_illust.php%s' % href
+
+
+# 用户作品/收藏列表页面
+def user_listing(root):
+    error_unit = _first(ERROR_UNIT(root))
+    if error_unit is not None:
+        return UserListing((_text(_first(error_unit.xpath('.//h2'))), _text(_first(error_unit.xpath('.//p')))),
+                           None, None, None, [], None)
+    return UserListing(None, _text(_first(USER_NAME(root))), _text(_first(CURRENT_MENU(root))),
+                       _text(_first(TAG_BADGE(root))), listing_illust_ids(root), listing_next_url(root))
+
+
+# 搜索结果页面
+def search_result(root):
+    m = re.search(r'\d+', _text(_first(COUNT_BADGE(root))) or '')
+    return SearchResult(int(m.group()) if m else 0, list(SEARCH_RESULT_ID(root)))
+
+
+# 排行榜页面
+def ranking_page(root):
+    return RankingPage(_text(_first(COLUMN_TITLE(root))), _text(_first(CURRENT_DATE(root))), _first(TT(root)))
+
+
+# 首页
+def home_page(root):
+    m = TOKEN_PATTERN.search(_scripts(root))
+    return HomePage(not SIGNUP_FORM(root), m.group(1) if m else None)
+
+
+# 旧版作品页面 没有img-container时返回None
+def legacy_illust_page(root):
+    a = _first(IMG_CONTAINER_A(root))
+    if a is None:
+        return None
+    m = TITLE_USER_PATTERN.match(OG_TITLE(root)[0])
+    img = _first(a.xpath('.//img'))
+    return LegacyIllustPage(m.group(1), m.group(2), a.get('class', '').split(),
+                            img.get('src') if img is not None else None, a.get('href'), str(root.text_content()))
+
+
+# 旧版多图页面 [(data-index, data-src)]
+def legacy_manga_images(root):
+    return [(img.get('data-index'), img.get('data-src')) for img in MANGA_IMAGES(root)]
+
+
+# 旧版排行榜页面 (日期, [(名次, 作品id)])
+def legacy_ranking(root):
+    items = SIBLING_ITEMS(root)
+    date = _text(items[1]) if len(items) > 1 else None
+    return date, [(int(section.get('id')), section.get('data-id')) for section in RANKING_ITEMS(root)]
+
+
+def _pixivision_card(element, category_xpath):
+    label = _text(_first(element.xpath(category_xpath)))
+    href = _first(element.xpath(".//a[@data-gtm-action='ClickImage']/@href", smart_strings=False))
+    return label.split()[0], href
+
+
+# pixivision首页 第一页顶部的大图文章 (分类, 地址)
+def pixivision_thumbnail(root):
+    return _pixivision_card(PIXIVISION_THUMBNAIL(root)[0], './/span')
+
+
+# pixivision首页 文章列表 [(分类, 地址)]
+def pixivision_cards(root):
+    return [_pixivision_card(li, ".//a[@data-gtm-action='ClickCategory']//span") for li in PIXIVISION_CARDS(root)]
+
+
+# pixivision文章 (标题, [作品页面地址]) 第一个是题图的作品
+def pixivision_article(root):
+    hrefs = list(EYECATCH_HREF(root))
+    for work in AM_WORKS(root):
+        href = _first(work.xpath('.//h3[%s]//a/@href' % _has_class('am__work__title'), smart_strings=False))
+        if href is not None:
+            hrefs.append(href)
+    return _first(TWITTER_TITLE(root)), hrefs
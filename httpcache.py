@@ -0,0 +1,246 @@
+# encoding=utf-8
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+import pixivdb
+
+# 缓存策略
+IMMUTABLE = 'immutable'    # 永久有效 不再请求
+TTL = 'ttl'                # 在有效期内直接使用, 过期后带ETag/Last-Modified重新验证
+REVALIDATE = 'revalidate'  # 每次都带ETag/Last-Modified请求, 304时使用缓存 (没有这两个响应头不缓存)
+
+# 不参与缓存key的参数: tt 是会话的token, 同一个排行榜页面每次登录都不一样 (key中已经包含会话)
+VOLATILE_PARAMS = ('tt',)
+# 区分登录会话的cookie 不同的登录(账号)的响应分开缓存
+SESSION_COOKIES = ('PHPSESSID',)
+
+
+# 按url分类的缓存策略 返回(策略, 有效秒数) 不缓存返回None
+# 过去日期的排行榜json永远不会改变: 永久缓存 (日期要早于前天, 当天和昨天的排行榜可能还在更新)
+# 排行榜页面: 里面有会话的tt 每次都重新验证
+# 作品页面(mode=medium): 有效期ttl
+# 其他www.pixiv.net的页面: 重新验证; 登录等其他域名的请求不缓存
+def default_policy(url, ttl=24 * 3600):
+    parts = urlsplit(url)
+    if parts.netloc != 'www.pixiv.net':
+        return None
+    query = dict(parse_qsl(parts.query))
+    if parts.path == '/ranking.php':
+        date = query.get('date', '')
+        if date and date < (datetime.date.today() - datetime.timedelta(days=2)).strftime('%Y%m%d'):
+            return (IMMUTABLE, None) if query.get('format') == 'json' else (REVALIDATE, None)
+        return REVALIDATE, None
+    if parts.path == '/member_illust.php' and query.get('mode') == 'medium':
+        return TTL, ttl
+    return REVALIDATE, None
+
+
+# 保存在SQLite中的http响应缓存, 放在PixivSpiderLogin.get_response (和AsyncPixivSpider.afetch)的下面
+# response 表: key(登录会话 + 去掉VOLATILE_PARAMS 参数排序后的url) 策略 状态码 响应头 zlib压缩的内容 ETag Last-Modified 保存时间 过期时间
+# 只缓存状态码200的GET, stream=True的请求(下载图片)不经过缓存
+# 与Manifest一样每个线程(进程)使用自己的连接, 对象可以pickle传给子进程
+# policy(url) 返回(策略, 有效秒数)或None, 缺省为default_policy
+class ResponseCache(object):
+    def __init__(self, db_path, policy=None, ttl=24 * 3600):
+        self.db_path = db_path
+        self.policy = policy
+        self.ttl = ttl
+        self._local = threading.local()
+        # 命中 重新验证后使用缓存(304) 请求网络
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_local'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    @staticmethod
+    def create_tables(conn):
+        conn.execute('''CREATE TABLE IF NOT EXISTS response(
+                        key text PRIMARY KEY,
+                        url text,
+                        policy text,
+                        status int,
+                        headers text,
+                        body blob,
+                        etag text,
+                        last_modified text,
+                        stored real,
+                        expires real
+                        )''')
+        conn.commit()
+
+    def connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            directory = os.path.dirname(self.db_path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            conn = pixivdb.connect(self.db_path)
+            self.create_tables(conn)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            conn.close()
+        self._local = threading.local()
+
+    # 请求的完整url(含params) 去掉VOLATILE_PARAMS, 参数排序
+    @staticmethod
+    def request_url(url, params=None):
+        return requests.Request('GET', url, params=params).prepare().url
+
+    # 请求所属的登录会话: cookies中SESSION_COOKIES的sha1(前16位) 没有登录时为''
+    @staticmethod
+    def session_identity(cookies):
+        if not cookies:
+            return ''
+        values = [cookies.get(name) or '' for name in SESSION_COOKIES]
+        if not any(values):
+            return ''
+        return hashlib.sha1('\n'.join(values).encode('utf-8')).hexdigest()[:16]
+
+    # "会话 url" 重新登录或换账号后不会用到其他会话的缓存
+    @staticmethod
+    def cache_key(url, identity=''):
+        parts = urlsplit(url)
+        query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k not in VOLATILE_PARAMS)
+        return identity + ' ' + urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query), ''))
+
+    def _policy(self, url):
+        if self.policy is not None:
+            return self.policy(url)
+        return default_policy(url, self.ttl)
+
+    def _load(self, key):
+        try:
+            return self.connect().execute('SELECT url, status, headers, body, etag, last_modified, expires '
+                                          'FROM response WHERE key = ?', (key,)).fetchone()
+        except sqlite3.Error as error:
+            print(error)
+            return None
+
+    @staticmethod
+    def _response(row):
+        url, status, headers, body, etag, last_modified, expires = row
+        r = requests.Response()
+        r.status_code = status
+        r.url = url
+        r.headers = CaseInsensitiveDict(json.loads(headers))
+        r._content = zlib.decompress(body)
+        r.encoding = requests.utils.get_encoding_from_headers(r.headers)
+        r.from_cache = True
+        return r
+
+    def _store(self, key, r, policy, seconds):
+        etag = r.headers.get('ETag')
+        last_modified = r.headers.get('Last-Modified')
+        if policy == REVALIDATE and etag is None and last_modified is None:
+            return
+        now = time.time()
+        expires = now + seconds if policy == TTL else None
+        # 内容已经解压 不保存Content-Encoding/Content-Length
+        headers = {k: v for k, v in r.headers.items() if k.lower() not in ('content-encoding', 'content-length',
+                                                                           'transfer-encoding', 'set-cookie')}
+        try:
+            conn = self.connect()
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO response (key, url, policy, status, headers, body, etag, '
+                             'last_modified, stored, expires) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                             (key, r.url, policy, r.status_code, json.dumps(headers),
+                              zlib.compress(r.content, 6), etag, last_modified, now, expires))
+        except sqlite3.Error as error:
+            print(error)
+
+    def _touch(self, key, policy, seconds):
+        now = time.time()
+        try:
+            conn = self.connect()
+            with conn:
+                conn.execute('UPDATE response SET policy = ?, stored = ?, expires = ? WHERE key = ?',
+                             (policy, now, now + seconds if policy == TTL else None, key))
+        except sqlite3.Error as error:
+            print(error)
+
+    # 查询缓存 返回(缓存的Response, 请求后写入缓存需要的state)
+    # 命中时state为None; 不经过缓存时两个都是None; 需要重新验证时kwargs中的headers加上验证用的请求头
+    def _lookup(self, url, kwargs):
+        if kwargs.get('stream'):
+            return None, None
+        full_url = self.request_url(url, kwargs.get('params'))
+        rule = self._policy(full_url)
+        if rule is None:
+            return None, None
+        policy, seconds = rule
+        key = self.cache_key(full_url, self.session_identity(kwargs.get('cookies')))
+        row = self._load(key)
+        if row is not None:
+            etag, last_modified, expires = row[4], row[5], row[6]
+            if policy == IMMUTABLE or (policy == TTL and expires is not None and expires > time.time()):
+                self.hits += 1
+                return self._response(row), None
+            headers = dict(kwargs.get('headers') or {})
+            if etag is not None:
+                headers['If-None-Match'] = etag
+            if last_modified is not None:
+                headers['If-Modified-Since'] = last_modified
+            kwargs['headers'] = headers
+        return None, (key, row, policy, seconds)
+
+    # 请求得到的响应r写入缓存 304时返回缓存中的Response
+    def _update(self, state, r):
+        if state is None or r is None:
+            return r
+        key, row, policy, seconds = state
+        if r.status_code == 304 and row is not None:
+            self.revalidated += 1
+            self._touch(key, policy, seconds)
+            return self._response(row)
+        self.misses += 1
+        if r.status_code == 200:
+            self._store(key, r, policy, seconds)
+        return r
+
+    # 经过缓存的GET: fetch(url, **kwargs) 真正发出请求(kwargs中的headers会加上验证用的请求头) 返回requests.Response
+    # 登录会话按kwargs中的cookies区分
+    # 从缓存得到的Response有from_cache属性
+    def get(self, fetch, url, **kwargs):
+        cached, state = self._lookup(url, kwargs)
+        if cached is not None:
+            return cached
+        return self._update(state, fetch(url, **kwargs))
+
+    # get的协程版本 fetch(url, **kwargs)返回awaitable, 结果同样是requests.Response
+    async def aget(self, fetch, url, **kwargs):
+        cached, state = self._lookup(url, kwargs)
+        if cached is not None:
+            return cached
+        return self._update(state, await fetch(url, **kwargs))
+
+    # 删除过期的ttl条目和days天内没有验证过的revalidate条目 (永久条目保留) 返回删除的行数
+    def prune(self, days=30):
+        conn = self.connect()
+        with conn:
+            count = conn.execute('DELETE FROM response WHERE (policy = ? AND expires < ?) '
+                                 'OR (policy = ? AND stored < ?)',
+                                 (TTL, time.time(), REVALIDATE, time.time() - days * 86400)).rowcount
+        return count
@@ -0,0 +1,90 @@
+# encoding=utf-8
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+# 长连接共享的HTTP客户端:
+# 所有线程共用一个HTTPAdapter(urllib3 PoolManager 按host分连接池, 本身线程安全)
+# 每个线程取出(checkout)自己的Session, Session只是共享连接池的一个视图, 创建不会产生新的TCP/TLS握手
+# 实例化时参数:
+# pool_connections: 缓存的host连接池数量
+# pool_maxsize: 每个host连接池保持的最大连接数(一般不小于线程数)
+# pool_block: 连接池用尽时是否阻塞等待(True) 还是临时新建连接用完丢弃(False)
+# 多进程时对象会被pickle, 连接池不会被复制, 子进程里第一次使用时重新建立
+class HttpClient(object):
+    def __init__(self, pool_connections=10, pool_maxsize=10, pool_block=False):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._adapter = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_lock'] = None
+        state['_local'] = None
+        state['_adapter'] = None
+        state['_pid'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    # 修改连接池大小 已经建立的连接池会被关闭 下一次请求时按新的大小重建
+    def configure(self, pool_connections=None, pool_maxsize=None, pool_block=None):
+        with self._lock:
+            if pool_connections is not None:
+                self.pool_connections = pool_connections
+            if pool_maxsize is not None:
+                self.pool_maxsize = pool_maxsize
+            if pool_block is not None:
+                self.pool_block = pool_block
+            self._reset()
+
+    def _reset(self):
+        if self._adapter is not None and self._pid == os.getpid():
+            self._adapter.close()
+        self._adapter = None
+        self._local = threading.local()
+
+    # 取得(必要时建立)本进程的共享连接池 fork出来的子进程不能沿用父进程的socket
+    def adapter(self):
+        pid = os.getpid()
+        if self._adapter is None or self._pid != pid:
+            with self._lock:
+                if self._adapter is None or self._pid != pid:
+                    self._local = threading.local()
+                    self._adapter = HTTPAdapter(pool_connections=self.pool_connections,
+                                                pool_maxsize=self.pool_maxsize,
+                                                pool_block=self.pool_block)
+                    self._pid = pid
+        return self._adapter
+
+    # 当前线程的Session(线程安全的checkout), 同一线程多次调用得到同一个Session
+    def session(self):
+        adapter = self.adapter()
+        s = getattr(self._local, 'session', None)
+        if s is None or s.adapters.get('http://') is not adapter:
+            s = requests.Session()
+            s.mount('http://', adapter)
+            s.mount('https://', adapter)
+            self._local.session = s
+        return s
+
+    def get(self, url, **kwargs):
+        return self.session().get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.session().post(url, **kwargs)
+
+    # 关闭所有连接
+    def close(self):
+        with self._lock:
+            self._reset()
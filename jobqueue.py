@@ -0,0 +1,215 @@
+# encoding=utf-8
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import pixivdb
+
+# 任务的状态
+PENDING = 'pending'        # 等待下载
+RUNNING = 'running'        # 已经交给下载进程 租约到期前不会再分配
+DONE = 'done'
+FAILED = 'failed'          # 超过最多尝试次数 或不需要重试的错误
+
+
+# 持久化的下载任务队列: 一个任务是 (作品id, 保存目录)
+# job 表: (illust_id, directory, state, attempts, lease_until, owner, error, added, updated)
+# claim 取出任务时尝试次数加一, 设置租约; 租约到期还没有结果(进程崩溃或被关闭)的任务可以再次取出
+# 重新运行时 上次没有完成的任务(等待中的, 和租约已经到期的)继续下载
+# 每个线程(进程)使用自己的连接, 对象可以pickle传给子进程
+class JobQueue(object):
+    def __init__(self, db_path, lease=300, max_attempts=3):
+        self.db_path = db_path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        # 这个队列对象取出的任务 用于续约
+        self.owner = uuid.uuid4().hex
+        self._local = threading.local()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_local'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    @staticmethod
+    def create_tables(conn):
+        conn.execute('''CREATE TABLE IF NOT EXISTS job(
+                        illust_id int not null,
+                        directory text not null,
+                        state text not null,
+                        attempts int not null default 0,
+                        lease_until real,
+                        owner text,
+                        error text,
+                        added timestamp,
+                        updated timestamp,
+                        PRIMARY KEY (illust_id, directory)
+                        ) WITHOUT ROWID''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_job_state ON job (directory, state, lease_until)')
+
+    # 当前线程的连接 fork出来的子进程重新连接
+    # 自动提交模式, 取任务时手动开始写事务(BEGIN IMMEDIATE) 多个进程不会取到同一个任务
+    def connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            directory = os.path.dirname(self.db_path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            conn = pixivdb.connect(self.db_path, isolation_level=None)
+            self.create_tables(conn)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            conn.close()
+        self._local = threading.local()
+
+    @staticmethod
+    def normalize(directory):
+        return os.path.normcase(os.path.abspath(directory))
+
+    # 加入任务 已经存在的任务不变, 以前失败的任务重新等待(尝试次数清零) 返回新加入的数量
+    def enqueue(self, illust_ids, directory):
+        directory = self.normalize(directory)
+        conn = self.connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            before = conn.total_changes
+            conn.executemany("INSERT OR IGNORE INTO job (illust_id, directory, state, added, updated) "
+                             "VALUES (?, ?, ?, datetime('now', 'localtime'), datetime('now', 'localtime'))",
+                             [(int(illust_id), directory, PENDING) for illust_id in illust_ids])
+            added = conn.total_changes - before
+            conn.executemany("UPDATE job SET state = ?, attempts = 0, error = NULL, "
+                             "updated = datetime('now', 'localtime') "
+                             "WHERE illust_id = ? AND directory = ? AND state = ?",
+                             [(PENDING, int(illust_id), directory, FAILED) for illust_id in illust_ids])
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return added
+
+    # 取出directory中最多limit个可以下载的任务(等待中的 和租约到期的) 返回作品id的列表
+    def claim(self, directory, limit=1):
+        directory = self.normalize(directory)
+        now = time.time()
+        conn = self.connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # 租约到期且已经用完尝试次数的任务 记为失败
+            conn.execute("UPDATE job SET state = ?, error = ?, lease_until = NULL, "
+                         "updated = datetime('now', 'localtime') "
+                         "WHERE directory = ? AND state = ? AND lease_until < ? AND attempts >= ?",
+                         (FAILED, '租约到期', directory, RUNNING, now, self.max_attempts))
+            ids = [row[0] for row in conn.execute(
+                'SELECT illust_id FROM job WHERE directory = ? AND '
+                '(state = ? OR (state = ? AND lease_until < ?)) ORDER BY attempts, added LIMIT ?',
+                (directory, PENDING, RUNNING, now, -1 if limit is None else limit))]
+            conn.executemany("UPDATE job SET state = ?, attempts = attempts + 1, lease_until = ?, owner = ?, "
+                             "updated = datetime('now', 'localtime') WHERE illust_id = ? AND directory = ?",
+                             [(RUNNING, now + self.lease, self.owner, illust_id, directory) for illust_id in ids])
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return ids
+
+    # 延长这个队列对象取出的 正在下载的任务的租约
+    def renew(self):
+        try:
+            self.connect().execute('UPDATE job SET lease_until = ? WHERE state = ? AND owner = ?',
+                                   (time.time() + self.lease, RUNNING, self.owner))
+        except sqlite3.Error as error:
+            print(error)
+
+    # 在这个范围内由后台线程每lease/3秒续约一次 下载时间再长租约也不会到期
+    # 可以嵌套使用, 每一层有自己的线程
+    @contextmanager
+    def renewing(self):
+        stop = threading.Event()
+
+        def run():
+            while not stop.wait(self.lease / 3):
+                self.renew()
+            # 只关闭这个线程的连接 (close()会丢掉所有线程的连接)
+            conn = getattr(self._local, 'conn', None)
+            if conn is not None:
+                conn.close()
+                self._local.conn = None
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        try:
+            yield self
+        finally:
+            stop.set()
+            thread.join()
+
+    def complete(self, illust_id, directory):
+        self._set(illust_id, directory, DONE, None)
+
+    # 下载失败: retry为True且尝试次数不到max_attempts时重新等待, 否则为失败 返回是否还会重试
+    def fail(self, illust_id, directory, error, retry=True):
+        conn = self.connect()
+        row = conn.execute('SELECT attempts FROM job WHERE illust_id = ? AND directory = ?',
+                           (int(illust_id), self.normalize(directory))).fetchone()
+        retry = retry and row is not None and row[0] < self.max_attempts
+        self._set(illust_id, directory, PENDING if retry else FAILED, str(error))
+        return retry
+
+    # run_pixiv_page的返回值: 完成 True; 不完整 False(重试); 作品不存在或不可见 None(不重试)
+    def finish(self, illust_id, directory, done):
+        if done:
+            self.complete(illust_id, directory)
+        elif done is None:
+            self.fail(illust_id, directory, '作品不存在或不可见', retry=False)
+        else:
+            self.fail(illust_id, directory, '下载不完整')
+
+    def _set(self, illust_id, directory, state, error):
+        try:
+            self.connect().execute("UPDATE job SET state = ?, error = ?, lease_until = NULL, "
+                                   "updated = datetime('now', 'localtime') WHERE illust_id = ? AND directory = ?",
+                                   (state, error, int(illust_id), self.normalize(directory)))
+        except sqlite3.Error as error:
+            print(error)
+
+    # 各状态的任务数 {state: n}; directory为None时统计全部
+    def counts(self, directory=None):
+        if directory is None:
+            rows = self.connect().execute('SELECT state, count(*) FROM job GROUP BY state')
+        else:
+            rows = self.connect().execute('SELECT state, count(*) FROM job WHERE directory = ? GROUP BY state',
+                                          (self.normalize(directory),))
+        return dict(rows.fetchall())
+
+    # 失败的任务 [(illust_id, directory, attempts, error)]
+    def failed(self, directory=None):
+        sql = 'SELECT illust_id, directory, attempts, error FROM job WHERE state = ?'
+        if directory is None:
+            return self.connect().execute(sql, (FAILED,)).fetchall()
+        return self.connect().execute(sql + ' AND directory = ?', (FAILED, self.normalize(directory))).fetchall()
+
+
+if __name__ == '__main__':
+    import sys
+
+    # python jobqueue.py jobs.db 打印各状态的任务数和失败的任务
+    if len(sys.argv) < 2:
+        print('python jobqueue.py jobs.db')
+    else:
+        queue = JobQueue(sys.argv[1])
+        print(queue.counts())
+        for row in queue.failed():
+            print(*row)
@@ -0,0 +1,206 @@
+# encoding=utf-8
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+
+import pixivdb
+
+# 保存的文件名: "标题 by 作者 id=123456.jpg" 多图 "..._p3.png" 动图 ".zip" ".gif"
+FILE_NAME_PATTERN = re.compile(r'id=(\d+)(?:_p(\d+))?\.(\w+)$')
+# 下载中的临时文件 不记录
+TEMP_SUFFIXES = ('.part', '.part.json', '.tmp')
+
+
+# 下载清单: 记录已经保存的作品和文件, 在请求作品页面之前判断是否需要下载, 不用再一个个os.path.exists
+# download 表: 每个文件一行 (path, illust_id, page, directory, size, sha1)
+# illust 表: 作品在某个保存目录中的全部文件都已保存时一行 (illust_id, directory, pages)
+# directory 是传给run_pixiv_page的保存目录(漫画的子文件夹也算在这个目录下)
+# 每个线程(进程)使用自己的连接, 对象可以pickle传给子进程
+class Manifest(object):
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_local'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    @staticmethod
+    def create_tables(conn):
+        conn.execute('''CREATE TABLE IF NOT EXISTS download(
+                        path text PRIMARY KEY,
+                        illust_id int not null,
+                        page int,
+                        directory text not null,
+                        size int,
+                        sha1 text,
+                        finished timestamp
+                        )''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_download_illust_id ON download (illust_id, directory)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_download_sha1 ON download (sha1)')
+        conn.execute('''CREATE TABLE IF NOT EXISTS illust(
+                        illust_id int not null,
+                        directory text not null,
+                        pages int,
+                        finished timestamp,
+                        PRIMARY KEY (illust_id, directory)
+                        ) WITHOUT ROWID''')
+        conn.commit()
+
+    # 当前线程的连接 fork出来的子进程重新连接
+    def connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            directory = os.path.dirname(self.db_path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            conn = pixivdb.connect(self.db_path)
+            self.create_tables(conn)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            conn.close()
+        self._local = threading.local()
+
+    @staticmethod
+    def normalize(directory):
+        return os.path.normcase(os.path.abspath(directory))
+
+    @staticmethod
+    def file_sha1(path, chunk_size=1024 * 1024):
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                sha1.update(chunk)
+        return sha1.hexdigest()
+
+    # 作品是否已经完整地保存在directory中
+    def is_complete(self, illust_id, directory):
+        try:
+            row = self.connect().execute('SELECT 1 FROM illust WHERE illust_id = ? AND directory = ?',
+                                         (int(illust_id), self.normalize(directory))).fetchone()
+        except sqlite3.Error as error:
+            print(error)
+            return False
+        return row is not None
+
+    # 一个作品在directory中的文件 [(page, path, size, sha1)]
+    def files(self, illust_id, directory):
+        return self.connect().execute('SELECT page, path, size, sha1 FROM download '
+                                      'WHERE illust_id = ? AND directory = ? ORDER BY page',
+                                      (int(illust_id), self.normalize(directory))).fetchall()
+
+    # 作品在directory以外的某个目录中完整保存时 返回(该目录, files(作品id, 该目录)), 否则返回None
+    def complete_copy(self, illust_id, directory):
+        conn = self.connect()
+        row = conn.execute('SELECT directory FROM illust WHERE illust_id = ? AND directory != ? LIMIT 1',
+                           (int(illust_id), self.normalize(directory))).fetchone()
+        if row is None:
+            return None
+        return row[0], self.files(illust_id, row[0])
+
+    # 记录下载完成的作品:
+    # files 为[(page, 文件路径)] 或 [(page, 文件路径, sha1)](已知sha1时不再读文件), 存在的文件写入download表;
+    # complete为True且files全部存在时写入illust表 之后is_complete返回True
+    # 同一个事务中写入 返回是否完整
+    def finish(self, illust_id, directory, files, complete=True):
+        directory = self.normalize(directory)
+        rows = []
+        for item in files:
+            page, path = item[:2]
+            if not os.path.exists(path):
+                complete = False
+                continue
+            sha1 = item[2] if len(item) > 2 else self.file_sha1(path)
+            rows.append((self.normalize(path), int(illust_id), page, directory, os.path.getsize(path), sha1))
+        conn = self.connect()
+        try:
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO download (path, illust_id, page, directory, size, sha1, "
+                                 "finished) VALUES (?, ?, ?, ?, ?, ?, datetime('now', 'localtime'))", rows)
+                if complete and rows:
+                    conn.execute("INSERT OR REPLACE INTO illust (illust_id, directory, pages, finished) "
+                                 "VALUES (?, ?, ?, datetime('now', 'localtime'))",
+                                 (int(illust_id), directory, len(rows)))
+        except sqlite3.Error as error:
+            print(error)
+            return False
+        return complete and bool(rows)
+
+    # directory中文件名以prefix开头的多图文件 [(page, path)]
+    @staticmethod
+    def page_files(directory, prefix):
+        files = []
+        if not os.path.exists(directory):
+            return files
+        for name in os.listdir(directory):
+            if not name.startswith(prefix) or name.endswith(TEMP_SUFFIXES):
+                continue
+            m = FILE_NAME_PATTERN.search(name)
+            if m is not None and m.group(2) is not None:
+                files.append((int(m.group(2)), directory + name))
+        return files
+
+    # 扫描root下的所有文件重建清单 (root下原有的记录先删除)
+    # 漫画子文件夹(名字以 id=作品id 结尾)中的文件算在上一级目录里
+    # 一个作品还有.part文件时认为没有下载完
+    def rebuild(self, root):
+        conn = self.connect()
+        root = self.normalize(root)
+        illusts = {}
+        partial = set()
+        for dir_path, dir_names, file_names in os.walk(root):
+            for name in file_names:
+                m = FILE_NAME_PATTERN.search(name[:-len('.part')] if name.endswith('.part') else name)
+                if m is None or name.endswith(('.part.json', '.tmp')):
+                    continue
+                illust_id = int(m.group(1))
+                directory = dir_path
+                if os.path.basename(dir_path).endswith('id=%d' % illust_id):
+                    directory = os.path.dirname(dir_path)
+                directory = self.normalize(directory)
+                if name.endswith('.part'):
+                    partial.add((illust_id, directory))
+                    continue
+                page = int(m.group(2)) if m.group(2) is not None else 0
+                illusts.setdefault((illust_id, directory), []).append((page, os.path.join(dir_path, name)))
+        prefix = root.rstrip(os.sep) + os.sep
+        with conn:
+            for table in ('download', 'illust'):
+                conn.execute('DELETE FROM %s WHERE directory = ? OR substr(directory, 1, ?) = ?' % table,
+                             (root, len(prefix), prefix))
+        count = 0
+        for (illust_id, directory), files in illusts.items():
+            self.finish(illust_id, directory, files, complete=(illust_id, directory) not in partial)
+            count += 1
+            if count % 100 == 0:
+                print('\r%d' % count, end='')
+        print('\r%d' % count)
+        return count
+
+
+if __name__ == '__main__':
+    import sys
+
+    # python manifest.py 保存目录 [manifest.db] 从已有的文件重建清单 (缺省为 保存目录/manifest.db)
+    if len(sys.argv) < 2:
+        print('python manifest.py 保存目录 [manifest.db]')
+    else:
+        _root = sys.argv[1]
+        _manifest = Manifest(sys.argv[2] if len(sys.argv) > 2 else os.path.join(_root, 'manifest.db'))
+        print(_manifest.rebuild(_root), 'illusts')
+        _manifest.close()
@@ -0,0 +1,443 @@
+# encoding=utf-8
+import re
+import sqlite3
+import time
+
+# pixiv_ranking 表中由排行榜json得到的列(顺序与ranking_row一致)
+RANKING_COLUMNS = ('illust_id', 'view_count', 'user_id', 'attr', 'illust_page_count', 'tags', 'url', 'total_score',
+                   'title', 'height', 'width', 'illust_upload_timestamp',
+                   'homosexual', 'bl', 'lo', 'antisocial', 'grotesque', 'drug',
+                   'religion', 'violent', 'yuri', 'furry', 'sexual', 'original', 'thoughts',
+                   'date', 'illust_type', 'illust_book_style', 'user_name', 'last_seen_run')
+
+CONTENT_TYPES = ('homosexual', 'bl', 'lo', 'antisocial', 'grotesque', 'drug', 'religion', 'violent', 'yuri', 'furry')
+
+
+# 标签存为 "tag1" "tag2" 的形式 方便 like '%"tag"%' 完全匹配
+def join_tags(tags):
+    if not tags:
+        return ''
+    return ' '.join('"' + tag + '"' for tag in tags)
+
+
+# 把排行榜json中的一个作品转换成RANKING_COLUMNS顺序的元组 run_id为本次更新的编号(start_run)
+def ranking_row(item, run_id):
+    content_type = item['illust_content_type']
+    illust_upload_timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(item['illust_upload_timestamp']))
+    return ((item['illust_id'], item['view_count'], item['user_id'], item['attr'], item['illust_page_count'],
+             join_tags(item['tags']), item['url'], item['total_score'], item['title'], item['height'], item['width'],
+             illust_upload_timestamp) +
+            tuple(int(content_type[key]) for key in CONTENT_TYPES) +
+            (content_type['sexual'], int(content_type['original']), int(content_type['thoughts']),
+             item['date'], item['illust_type'], item['illust_book_style'], item['user_name'], run_id))
+
+
+# 批量写入:
+# 用 INSERT ... ON CONFLICT(key) DO UPDATE 一次executemany写入batch_size行, 每批一个事务
+# conn: sqlite3连接
+# table: 表名
+# columns: 写入的列(元组), 每行的值按这个顺序
+# key: 冲突判断的列(主键)
+# update_columns: 已存在的行要更新的列 为空时已存在的行不变(DO NOTHING)
+# batch_size: 每批的行数
+# 需要 SQLite 3.24 以上(UPSERT)
+class BatchWriter(object):
+    def __init__(self, conn, table, columns, key='illust_id', update_columns=None, batch_size=500):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.rows = []
+        # 每一批的(行数, 用时秒)
+        self.timings = []
+        command = 'INSERT INTO %s (%s) VALUES (%s) ON CONFLICT(%s) ' % (table, ', '.join(columns),
+                                                                         ', '.join('?' * len(columns)), key)
+        if update_columns:
+            command += 'DO UPDATE SET ' + ', '.join('%s = excluded.%s' % (c, c) for c in update_columns)
+        else:
+            command += 'DO NOTHING'
+        self.command = command
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.flush()
+
+    # 加入一行 满batch_size时写入
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def add_many(self, rows):
+        for row in rows:
+            self.add(row)
+
+    # 把缓存的行在一个事务中写入 出错时整批回滚并抛出sqlite3.Error
+    def flush(self):
+        if not self.rows:
+            return
+        rows = self.rows
+        self.rows = []
+        t = time.time()
+        with self.conn:
+            self.conn.executemany(self.command, rows)
+        self.timings.append((len(rows), time.time() - t))
+
+    # 写入统计: 总行数 批数 总用时 平均每批用时 最慢一批用时
+    def report(self):
+        total_rows = sum(rows for rows, _ in self.timings)
+        total_time = sum(seconds for _, seconds in self.timings)
+        batches = len(self.timings)
+        return {'rows': total_rows, 'batches': batches, 'seconds': total_time,
+                'average': total_time / batches if batches else 0,
+                'slowest': max(seconds for _, seconds in self.timings) if batches else 0}
+
+    def print_report(self):
+        report = self.report()
+        print('写入 %d 行 %d 批 用时 %.2f 秒 平均每批 %.1f ms 最慢 %.1f ms' % (
+            report['rows'], report['batches'], report['seconds'], report['average'] * 1000,
+            report['slowest'] * 1000))
+
+
+# 规范化的标签表:
+# tag(tag_id, name) 每个标签一行; illust_tag(tag_id, illust_id) 每个作品的每个标签一行
+# illust_tag 主键 (tag_id, illust_id) WITHOUT ROWID, 按标签聚集存储, 查某个标签的作品只读一段连续的索引
+# 一个作品在 pixiv_ranking 和 pixiv_papi 中的标签相同, 两个表共用这两张表
+def create_tag_tables(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS tag(
+                    tag_id INTEGER PRIMARY KEY,
+                    name text not null UNIQUE
+                    )''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS illust_tag(
+                    tag_id int not null,
+                    illust_id int not null,
+                    PRIMARY KEY (tag_id, illust_id)
+                    ) WITHOUT ROWID''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_illust_tag_illust_id ON illust_tag (illust_id)')
+    conn.commit()
+
+
+# 把join_tags的结果拆回list
+def split_tags(tags):
+    if not tags:
+        return []
+    return re.findall(r'"(.*?)"(?= "|$)', tags)
+
+
+# 批量写入作品的标签: set_tags 覆盖一个作品的全部标签, 满batch_size个作品时写入
+class TagWriter(object):
+    def __init__(self, conn, batch_size=500):
+        self.conn = conn
+        self.batch_size = batch_size
+        create_tag_tables(conn)
+        self._tag_ids = {}
+        self.illusts = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.flush()
+
+    def set_tags(self, illust_id, tags):
+        self.illusts[int(illust_id)] = tags or []
+        if len(self.illusts) >= self.batch_size:
+            self.flush()
+
+    # 标签的tag_id 不存在时新建 (在flush的事务中调用)
+    def tag_id(self, name):
+        if name not in self._tag_ids:
+            self.conn.execute('INSERT OR IGNORE INTO tag (name) VALUES (?)', (name,))
+            self._tag_ids[name] = self.conn.execute('SELECT tag_id FROM tag WHERE name = ?', (name,)).fetchone()[0]
+        return self._tag_ids[name]
+
+    def flush(self):
+        if not self.illusts:
+            return
+        illusts = self.illusts
+        self.illusts = {}
+        try:
+            with self.conn:
+                self.conn.executemany('DELETE FROM illust_tag WHERE illust_id = ?', [(i,) for i in illusts])
+                self.conn.executemany('INSERT OR IGNORE INTO illust_tag (tag_id, illust_id) VALUES (?, ?)',
+                                      [(self.tag_id(name), illust_id)
+                                       for illust_id, tags in illusts.items() for name in tags])
+        except sqlite3.Error:
+            # 回滚后新建的tag_id不再有效
+            self._tag_ids = {}
+            raise
+
+
+# 用表中已有的tags列填充标签表 (升级旧的.db文件)
+def backfill_tags(conn, table, batch_size=500):
+    writer = TagWriter(conn, batch_size)
+    cursor = conn.execute('SELECT illust_id, tags FROM %s WHERE tags IS NOT NULL AND illust_id NOT IN '
+                          '(SELECT illust_id FROM illust_tag)' % table)
+    for illust_id, tags in cursor.fetchall():
+        writer.set_tags(illust_id, split_tags(tags))
+    writer.flush()
+
+
+# 标签表中还没有table的作品时(旧的.db文件 或标签表是新建的) 用tags列填充
+# 建立数据库时调用, 已经填充过的表只查一行
+def ensure_tags(conn, table, batch_size=500):
+    create_tag_tables(conn)
+    tagged = conn.execute('SELECT EXISTS (SELECT 1 FROM %s WHERE illust_id IN (SELECT illust_id FROM illust_tag))'
+                          % table).fetchone()[0]
+    if not tagged:
+        backfill_tags(conn, table, batch_size)
+
+
+# 按标签查询作品 返回illust_id的list(从大到小)
+# tag_and: 每个标签都要有; tag_or: 至少有其中一个; tag_not: 不能有其中任何一个 (str 或 list, 标签要完全匹配)
+# table: 只返回在该表(或视图, 例如pixiv_ranking_latest)中的作品, 缺省不限; 只有tag_not时必须指定
+# 每个条件都是在illust_tag主键上的一次范围查找, 不需要扫描整个表
+def search_tags(conn, tag_and=None, tag_or=None, tag_not=None, table=None):
+    if isinstance(tag_and, str):
+        tag_and = (tag_and,)
+    if isinstance(tag_or, str):
+        tag_or = (tag_or,)
+    if isinstance(tag_not, str):
+        tag_not = (tag_not,)
+    selects = []
+    args = []
+    for name in set(tag_and or ()):
+        selects.append('SELECT illust_id FROM illust_tag WHERE tag_id = (SELECT tag_id FROM tag WHERE name = ?)')
+        args.append(name)
+    if tag_or:
+        tag_or = list(set(tag_or))
+        selects.append('SELECT DISTINCT illust_id FROM illust_tag WHERE tag_id IN '
+                       '(SELECT tag_id FROM tag WHERE name IN (%s))' % ', '.join('?' * len(tag_or)))
+        args.extend(tag_or)
+    if table is not None:
+        selects.append('SELECT illust_id FROM %s' % table)
+    if not selects:
+        raise ValueError('tag_and tag_or table 至少要有一个')
+    command = ' INTERSECT '.join(selects)
+    if tag_not:
+        tag_not = list(set(tag_not))
+        command += (' EXCEPT SELECT illust_id FROM illust_tag WHERE tag_id IN '
+                    '(SELECT tag_id FROM tag WHERE name IN (%s))' % ', '.join('?' * len(tag_not)))
+        args.extend(tag_not)
+    return [row[0] for row in conn.execute(command + ' ORDER BY illust_id DESC', args)]
+
+
+# 常用于筛选的列 每一项建立一个索引 (列, ...) 第一个元素也作为索引名的一部分
+# tags 的索引带上illust_id, like '%"tag"%' 查询时可以只扫描索引而不用翻过整行(包括缩略图)
+TABLE_INDEXES = {'pixiv_ranking': (('user_id',), ('total_score',), ('date',), ('last_seen_run',),
+                                   ('tags', 'illust_id')),
+                 'pixiv_papi': (('user_id',), ('total_score',), ('illust_upload_timestamp',), ('last_seen_run',),
+                                ('tags', 'illust_id'))}
+
+
+# 设置连接的pragma:
+# WAL 读写不互相阻塞, 更新数据库时也可以查询; synchronous = NORMAL 在WAL下足够安全
+# cache_size 64MB; busy_timeout 遇到锁时等待而不是立刻报 database is locked
+def apply_pragmas(conn):
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute('PRAGMA cache_size = -65536')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    conn.execute('PRAGMA busy_timeout = 30000')
+
+
+# 打开数据库 并设置pragma 参数同sqlite3.connect
+def connect(db_path, **kwargs):
+    kwargs.setdefault('timeout', 30)
+    conn = sqlite3.connect(db_path, **kwargs)
+    apply_pragmas(conn)
+    return conn
+
+
+# 给已有的表建立TABLE_INDEXES中的索引(已存在的跳过) 旧的.db文件也可以直接调用升级
+def create_indexes(conn, table):
+    for columns in TABLE_INDEXES.get(table, ()):
+        try:
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_%s_%s ON %s (%s)' % (table, columns[0], table,
+                                                                             ', '.join(columns)))
+        except sqlite3.Error as error:
+            # 旧表可能没有这一列
+            print(table, columns[0], error)
+    conn.commit()
+
+
+# 每次更新数据库记为一次crawl run, 作品行的last_seen_run记录最后一次出现的run_id
+# 本次更新出现过的作品 即 last_seen_run = 最新的run_id (走索引, 不需要每次把整个表的latest清零)
+# <table>_latest 视图等价于以前的 latest = 1: 最近一次完成(finished不为空)的更新中出现的作品
+# 之后正在进行或中断的更新碰过的行last_seen_run更大, 也包含在内 (这些行的last_seen_run已经被覆盖)
+def add_run_tracking(conn, table):
+    conn.execute('''CREATE TABLE IF NOT EXISTS crawl_run(
+                    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    table_name text not null,
+                    started timestamp,
+                    finished timestamp
+                    )''')
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(%s)' % table)]
+    if 'last_seen_run' not in columns:
+        conn.execute('ALTER TABLE %s ADD last_seen_run int' % table)
+    # 旧的视图使用max(run_id) 重新建立
+    conn.execute('DROP VIEW IF EXISTS %s_latest' % table)
+    conn.execute('''CREATE VIEW %s_latest AS
+                    SELECT * FROM %s WHERE last_seen_run >=
+                    (SELECT max(run_id) FROM crawl_run WHERE table_name = '%s' AND finished IS NOT NULL)'''
+                 % (table, table, table))
+    conn.commit()
+
+
+# 缩略图不再以BLOB存在表中, 只保存缩略图存储(thumbstore)中的key 给旧表加上img_hash列(已有的跳过)
+def add_thumbnail_column(conn, table):
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(%s)' % table)]
+    if 'img_hash' not in columns:
+        conn.execute('ALTER TABLE %s ADD img_hash text' % table)
+        conn.commit()
+
+
+# 开始一次更新 返回run_id
+def start_run(conn, table):
+    with conn:
+        cursor = conn.execute("INSERT INTO crawl_run (table_name, started) VALUES (?, datetime('now', 'localtime'))",
+                              (table,))
+    return cursor.lastrowid
+
+
+def finish_run(conn, run_id):
+    with conn:
+        conn.execute("UPDATE crawl_run SET finished = datetime('now', 'localtime') WHERE run_id = ?", (run_id,))
+
+
+# table最近一次更新的run_id 没有则返回None
+def current_run(conn, table):
+    return conn.execute('SELECT max(run_id) FROM crawl_run WHERE table_name = ?', (table,)).fetchone()[0]
+
+
+# 升级数据库文件: 设置WAL等pragma 为存在的表加上run记录 索引和标签表 并更新查询统计
+def migrate_database(db_path):
+    conn = connect(db_path)
+    try:
+        tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        for table in tables:
+            if table in TABLE_INDEXES:
+                add_run_tracking(conn, table)
+                add_thumbnail_column(conn, table)
+                create_indexes(conn, table)
+                backfill_tags(conn, table)
+        conn.execute('ANALYZE')
+        conn.commit()
+    finally:
+        conn.close()
+
+
+# 排行榜历史: 每一天每个content/mode中每个作品的排名, 只追加不覆盖
+# pixiv_ranking_history(illust_id, category, date, rank, yes_rank, score, views)
+# category 是 ranking_category 中(content, mode)的编号, date 为整数 20170206, WITHOUT ROWID 按主键聚集存储
+# 主键 (illust_id, category, date) 用于查询一个作品的排名变化; 索引 (category, date, rank) 用于查询某段时间的前N名
+class RankingHistory(object):
+    def __init__(self, conn, batch_size=500):
+        self.conn = conn
+        self.create_table(conn)
+        self._categories = {}
+        self.writer = BatchWriter(conn, 'pixiv_ranking_history',
+                                  ('illust_id', 'category', 'date', 'rank', 'yes_rank', 'score', 'views'),
+                                  key='illust_id, category, date', batch_size=batch_size)
+
+    @staticmethod
+    def create_table(conn):
+        conn.execute('''CREATE TABLE IF NOT EXISTS ranking_category(
+                        category INTEGER PRIMARY KEY,
+                        content text not null,
+                        mode text not null,
+                        UNIQUE (content, mode)
+                        )''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS pixiv_ranking_history(
+                        illust_id int not null,
+                        category int not null,
+                        date int not null,
+                        rank int,
+                        yes_rank int,
+                        score int,
+                        views int,
+                        PRIMARY KEY (illust_id, category, date)
+                        ) WITHOUT ROWID''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_pixiv_ranking_history_rank '
+                     'ON pixiv_ranking_history (category, date, rank)')
+        conn.commit()
+
+    # (content, mode)的编号 不存在时新建
+    def category(self, content, mode, create=True):
+        key = (content, mode)
+        if key not in self._categories:
+            row = self.conn.execute('SELECT category FROM ranking_category WHERE content = ? AND mode = ?',
+                                    key).fetchone()
+            if row is None:
+                if not create:
+                    return None
+                with self.conn:
+                    row = (self.conn.execute('INSERT INTO ranking_category (content, mode) VALUES (?, ?)',
+                                             key).lastrowid,)
+            self._categories[key] = row[0]
+        return self._categories[key]
+
+    # 加入一页排行榜json(包含content mode date contents)
+    def add_page(self, json):
+        if not json.get('contents'):
+            return
+        category = self.category(json['content'], json['mode'])
+        date = int(json['date'])
+        for item in json['contents']:
+            self.writer.add((item['illust_id'], category, date, item.get('rank'), item.get('yes_rank'),
+                             item.get('total_score'), item.get('view_count')))
+
+    # 批量导入 pages为排行榜json的可迭代对象(例如保存下来的json文件)
+    def load_pages(self, pages):
+        for json in pages:
+            self.add_page(json)
+        self.flush()
+
+    def flush(self):
+        self.writer.flush()
+
+    # 一个作品的排名变化 返回[(content, mode, date, rank, yes_rank, score, views)] 按日期排序
+    # date_from date_to 为 20170206 形式的整数或字符串, 缺省不限
+    def trajectory(self, illust_id, content=None, mode=None, date_from=None, date_to=None):
+        command = '''SELECT c.content, c.mode, h.date, h.rank, h.yes_rank, h.score, h.views
+                     FROM pixiv_ranking_history h JOIN ranking_category c ON h.category = c.category
+                     WHERE h.illust_id = ? AND h.date BETWEEN ? AND ?'''
+        args = [illust_id, int(date_from or 0), int(date_to or 99999999)]
+        if content is not None:
+            command += ' AND c.content = ?'
+            args.append(content)
+        if mode is not None:
+            command += ' AND c.mode = ?'
+            args.append(mode)
+        return self.conn.execute(command + ' ORDER BY h.date, c.category', args).fetchall()
+
+    # 某个content/mode在日期范围内每天的前n名 返回[(date, rank, illust_id, score, views)]
+    def top(self, content, mode, date_from, date_to, n=10):
+        category = self.category(content, mode, create=False)
+        if category is None:
+            return []
+        return self.conn.execute('''SELECT date, rank, illust_id, score, views FROM pixiv_ranking_history
+                                    WHERE category = ? AND date BETWEEN ? AND ? AND rank <= ?
+                                    ORDER BY date, rank''', (category, int(date_from), int(date_to), n)).fetchall()
+
+    # 日期范围内最好名次的前n个作品 返回[(illust_id, 最好名次, 上榜天数, 最高分)]
+    def best(self, content, mode, date_from, date_to, n=10):
+        category = self.category(content, mode, create=False)
+        if category is None:
+            return []
+        return self.conn.execute('''SELECT illust_id, min(rank) AS best_rank, count(*), max(score)
+                                    FROM pixiv_ranking_history
+                                    WHERE category = ? AND date BETWEEN ? AND ?
+                                    GROUP BY illust_id ORDER BY best_rank, illust_id LIMIT ?''',
+                                 (category, int(date_from), int(date_to), n)).fetchall()
+
+
+if __name__ == '__main__':
+    import sys
+
+    # python pixivdb.py Pixiv.db [...] 升级已有的数据库文件
+    for path in sys.argv[1:]:
+        migrate_database(path)
+        print(path, 'migrated')
@@ -1,5 +1,6 @@
 # encoding=utf-8
 import datetime
+import json
 import multiprocessing
 import os
 import queue
@@ -9,39 +10,58 @@ import sqlite3
 import threading
 import time
 import zipfile
-from functools import reduce
+from contextlib import contextmanager
+from functools import partial, reduce
 from shutil import rmtree
 
 import requests
 from PIL import Image
-from bs4 import BeautifulSoup
 from pixivpy3 import *
 
+from blobstore import BlobStore
+from concurrency import AimdController
+import extract
+from httpcache import ResponseCache
+from httpclient import HttpClient
+from jobqueue import JobQueue
+from manifest import Manifest
+import pixivdb
+from pixivdb import BatchWriter, RankingHistory, RANKING_COLUMNS, ranking_row, TagWriter
 from progressbar import ProgressBar
+from ratelimit import rate_limiter
+from retry import classify_status, RETRYABLE, RetryPolicy, TryError
+from seenset import SeenSet
+import thumbstore
+import transcode
+from transcode import Transcoder
+import ugoira
+from workerpool import WorkerPool
+
+
+# 用最多threading_max个工作线程执行 func(*args) args_list为参数元组的可迭代对象
+# 返回Task列表 任务中的异常会被打印出来, 需要时可以从Task.exception取得
+def run_threading_limited(func, args_list, threading_max):
+    with WorkerPool(threading_max) as pool:
+        tasks = pool.map(func, args_list)
+    for task in tasks:
+        if task.exception is not None:
+            print(task.exception)
+    return tasks
 
 
-def run_threading_limited(func, args_list, threading_max):
-    def alloc(_func, _args_list):
-        for args in _args_list:
-            t = threading.Thread(target=_func, args=args)
-            t.start()
-            yield
-
-    threading_max += 1
-    prev_threading = threading.enumerate()
-    a = alloc(func, args_list)
-    while True:
-        if threading.active_count() < threading_max:
-            try:
-                next(a)
-            except StopIteration:
-                break
-    runing_threads = threading.enumerate()
-    list(map(lambda t: t.join() if t not in prev_threading else t, runing_threads[1:]))
+# 下载进程池中每个进程自己的spider: 建立进程时由初始化函数保存一次, 之后的任务只传作品id和保存目录
+# 同一个进程中的任务共用spider的连接池 并发窗口 数据库连接, 不用每个任务重新pickle整个spider和建立连接
+_worker_spider = None
 
 
-class TryError(requests.exceptions.RequestException):
-    pass
+def init_pixiv_worker(spider):
+    global _worker_spider
+    _worker_spider = spider
+    spider.http_client.adapter()
+
+
+def run_pixiv_worker(illust_id, path):
+    return _worker_spider.run_pixiv_page(illust_id, path)
 
 
 class Spider(object):
@@ -57,36 +77,48 @@ class Spider(object):
               'User-Agent': 'Opera/9.80 (Windows NT 6.1) Presto/2.12.388 Version/12.16'},
              {"Accept-Language": "zh-CN,zh;q=0.8",
               'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/54.0.2840.87 Safari/537.36'}]
+    # 所有实例共用的长连接客户端
+    http_client = HttpClient()
+    # 所有实例共用的重试策略
+    retry_policy = RetryPolicy()
 
-    def get_html_tree(self, input_url, header=None):
+    # 获取网页的lxml根节点 页面由extract中的函数解析
+    def get_html_root(self, input_url, header=None):
         try:
             if header is None:
                 header = self.heads[random.randint(0, len(self.heads) - 1)]
-            resp = requests.get(input_url, headers=header)
-            soup = BeautifulSoup(resp.content, "lxml")
+            resp = self.retry_policy.run(partial(self.http_client.get, input_url, headers=header))
+            return extract.parse_html(resp.content)
         except Exception as connect_error:
             print(connect_error)
             return
-        else:
-            return soup
 
+    # 请求和写入一起按retry_policy重试 与PixivSpider.download_pic相同, 失败时删除写了一半的文件
     def save_html_page(self, page_url, path, header=None):
-        try:
-            if header is None:
-                header = self.heads[random.randint(0, len(self.heads) - 1)]
-            resp = requests.get(page_url, headers=header)
+        if header is None:
+            header = self.heads[random.randint(0, len(self.heads) - 1)]
+
+        def save():
+            resp = self.http_client.get(page_url, headers=header)
+            if resp.status_code != 200:
+                raise TryError(resp.status_code, resp.headers.get('Retry-After'))
             with open(path, 'wb') as code:
                 code.write(resp.content)
-        except Exception as connect_error:
+
+        try:
+            self.retry_policy.run(save)
+        except requests.exceptions.RequestException as connect_error:
             print(connect_error)
-            return
+            if os.path.exists(path):
+                os.remove(path)
 
 
-# path设置保存地址
+# path设置保存地址 use_manifest 是否使用下载清单(path/manifest.db)跳过已下载的作品
 class PixivSpider(Spider):
-    def __init__(self, path='D:/PixivSpider/'):
+    def __init__(self, path='D:/PixivSpider/', use_manifest=True):
         self.savePath = path
         self.processPage = ''
+        self.manifest = Manifest(path + 'manifest.db') if use_manifest else None
         self.imagesType = ['.png', '.jpg', '.gif']
         self.ranking_dict = {u'综合': '', u'插画': 'illust', u'动画': 'ugoira', u'漫画': 'manga',
                              u'今日': 'daily', u'本周': 'weekly', u'本月': 'monthly', u'新人': 'rookie',
@@ -113,13 +145,11 @@ class PixivSpider(Spider):
                 pixivison_url = 'http://www.pixivision.net/zh/'
             else:
                 pixivison_url = 'http://www.pixivision.net/zh/?p=%d' % index
-            html_root = self.get_html_tree(pixivison_url)
+            html_root = self.get_html_root(pixivison_url)
             if index == 1:
-                thumbnail_container = html_root.find('div', {'class': 'aec__thumbnail-container'})
-                label = thumbnail_container.span.get_text().split()[0]
+                label, next_url = extract.pixivision_thumbnail(html_root)
                 if label in search_content:
                     print(label, 'find in content')
-                    next_url = thumbnail_container.find('a', {'data-gtm-action': 'ClickImage'})['href']
                     url = 'http://www.pixivision.net%s' % next_url
                     if stop_when_find_exists is True:
                         self.run_pixivison_page(url, label, True)
@@ -131,14 +161,9 @@ class PixivSpider(Spider):
                     total_page_count -= 1
                     if total_page_count == 0:
                         return
-            container = html_root.find('ul', {'class': 'main-column-container'}).find_all('li', {
-                'class': 'article-card-container'})
-            for i in container:
-                content = i.find('a', {'data-gtm-action': 'ClickCategory'})
-                label = content.span.get_text().split()[0]
+            for label, next_url in extract.pixivision_cards(html_root):
                 if label in search_content:
                     print(label, 'find in content')
-                    next_url = i.find('a', {'data-gtm-action': 'ClickImage'})['href']
                     url = 'http://www.pixivision.net%s' % next_url
                     if stop_when_find_exists is True:
                         if self.run_pixivison_page(url, label, True) == 'exists':
@@ -156,8 +181,7 @@ class PixivSpider(Spider):
 
     # 爬pixivison某一个页面: page_url页面地址, labal爬的类别(目前只有插画类别支持), find_exists找到存在文件夹返回'exists'
     def run_pixivison_page(self, page_url, labal, find_exists):
-        html_root = self.get_html_tree(page_url)
-        title = html_root.find('meta', {'property': 'twitter:title'})['content']
+        title, work_urls = extract.pixivision_article(self.get_html_root(page_url))
         title = u''.join(re.split(r'[\\/:*?"<>|]+', title))
         print(title)
         path = self.savePath + title
@@ -168,10 +192,8 @@ class PixivSpider(Spider):
         else:
             os.makedirs(path + '/')
         if labal == u'插画':
-            eyecatch = html_root.find('div', {'class': '_article-illust-eyecatch'})
-            self.run_pixiv_page(eyecatch.a['href'], path + '/')
-            for i in html_root.find_all('div', {'class': 'am__work'}):
-                self.run_pixiv_page(i.find('h3', {'class': 'am__work__title'}).a['href'], path + '/')
+            for work_url in work_urls:
+                self.run_pixiv_page(work_url, path + '/')
         else:
             print('')
             print('This funcation hasn\'t finished yet')
@@ -183,31 +205,33 @@ class PixivSpider(Spider):
     # 爬p站某一个作品页面,支持单图,多图,动图: page_url页面地址, path存储地址(格式: ..:/../../../)
     def run_pixiv_page(self, page_url, path):
         self.processPage = page_url
-        html_root = self.get_html_tree(page_url)
-        # html_root = BeautifulSoup(open('d:/test/test1.html'), "html.parser")
-        while html_root is None:
-            time.sleep(1)
-            html_root = self.get_html_tree(page_url)
-        container = html_root.find('div', {'class': 'img-container'})
-        content_title_user_name = html_root.find('meta', {'property': 'og:title'})['content']
-        m = re.match(r'\u300c(.*?)\u300d/\u300c(.*?)\u300d.*', content_title_user_name)
-        title = m.group(1)
-        user_name = m.group(2)
+        m = re.search(r'illust_id=(\d+)', page_url)
+        illust_id = m.group(1) if m is not None else None
+        # 清单中已经完整保存的作品不再请求页面
+        if illust_id is not None and self.manifest is not None and self.manifest.is_complete(illust_id, path):
+            print('file exist')
+            return
+        html_root = self.get_html_root(page_url)
+        if html_root is None:
+            return
+        page = extract.legacy_illust_page(html_root)
+        if page is None:
+            print(self.processPage)
+            print('Cannot find img-container')
+            return
+        title = page.title
+        user_name = page.user_name
         # 单图
-        if (u'_work' in container.a['class']) is True and (u'multiple' in container.a['class']) is False:
-            img = container.a.img
-            # print img.name, img['src']
-            # content = img['alt'].split('/')
-            # title = content[0]
-            # user_name = content[1]
+        if (u'_work' in page.a_class) is True and (u'multiple' in page.a_class) is False:
             pic_id = page_url.split('id')[1]
             save_file_name = '%s by %s id%s' % (title, user_name, pic_id)
             save_file_name = u''.join(re.split(r'[\\/:*?"<>|\x00-\x1f]+', save_file_name))
             for image_type in self.imagesType:
                 if os.path.exists(path + save_file_name + image_type):
                     print('file exist')
+                    self.record_download(illust_id, path, [(0, path + save_file_name + image_type)])
                     return
-            fake_url = img['src'].split('/')
+            fake_url = page.img_src.split('/')
             file_name = fake_url[13].split('_')
             for image_type in self.imagesType:
                 file_name_type = file_name[0] + u'_' + file_name[1] + image_type
@@ -216,15 +240,11 @@ class PixivSpider(Spider):
                                                                                 fake_url[10], fake_url[11],
                                                                                 fake_url[12], file_name_type)
                 return_msg = self.request_pic_url(page_url, real_url)
-                while return_msg == 'error':
-                    time.sleep(4)
-                    return_msg = self.request_pic_url(page_url, real_url)
                 if return_msg == 404:
                     continue
-                elif isinstance(return_msg, int):
+                elif isinstance(return_msg, int) or return_msg == 'error':
                     print(return_msg)
                     print(self.processPage)
-                    time.sleep(8)
                 else:
                     try:
                         with open(path + save_file_name + image_type, 'wb') as code:
@@ -232,29 +252,25 @@ class PixivSpider(Spider):
                     except requests.exceptions.RequestException as errno:
                         print(errno)
                         os.remove(path + save_file_name + image_type)
-                        time.sleep(5)
                         self.download_pic(page_url, real_url, path + save_file_name + image_type)
+                        self.record_download(illust_id, path, [(0, path + save_file_name + image_type)])
                         return
                     else:
                         print('download successful')
+                        self.record_download(illust_id, path, [(0, path + save_file_name + image_type)])
                         return
             print(self.processPage)
             print('Cannot find download url')
         # 多图
-        elif (u'_work' in container.a['class']) and (u'multiple' in container.a['class']):
-            # content = container.a.img['alt'].split('/')
-            # title = content[0]
-            # user_name = content[1]
+        elif (u'_work' in page.a_class) and (u'multiple' in page.a_class):
             pic_id = page_url.split('id')[1]
-            manga_page_url = 'http://www.pixiv.net/' + container.a['href']
-            manga_page = self.get_html_tree(manga_page_url)
-            # manga_page = BeautifulSoup(open('d:/test/test3.html'), "html.parser")
-            while manga_page is None:
-                time.sleep(1)
-                manga_page = self.get_html_tree(manga_page_url)
-            item_container = manga_page.find_all('img', {'data-filter': 'manga-image'})
-            for i in item_container:
-                data_index = i['data-index']
+            manga_page_url = 'http://www.pixiv.net/' + page.href
+            manga_page = self.get_html_root(manga_page_url)
+            if manga_page is None:
+                return
+            item_container = extract.legacy_manga_images(manga_page)
+            saved_files = []
+            for data_index, data_src in item_container:
                 save_file_name = '%s by %s id%s_p%s' % (title, user_name, pic_id, data_index)
                 save_file_name = u''.join(re.split(r'[\\/:*?"<>|\x00-\x1f]+', save_file_name))
                 file_exist = False
@@ -262,10 +278,11 @@ class PixivSpider(Spider):
                     if os.path.exists(path + save_file_name + image_type):
                         print('file exist')
                         file_exist = True
+                        saved_files.append((int(data_index), path + save_file_name + image_type))
                         break
                 if file_exist is True:
                     continue
-                fake_url = i['data-src'].split('/')
+                fake_url = data_src.split('/')
                 file_name = fake_url[-1].split('_')
                 success_download = False
                 for image_type in self.imagesType:
@@ -276,15 +293,11 @@ class PixivSpider(Spider):
                                                                                     fake_url[12], file_name_type)
                     manga_big_page_url = manga_page_url.replace('mode=manga', 'mode=manga_big') + '&page=' + data_index
                     return_msg = self.request_pic_url(manga_big_page_url, real_url)
-                    while return_msg == 'error':
-                        time.sleep(4)
-                        return_msg = self.request_pic_url(manga_big_page_url, real_url)
                     if return_msg == 404:
                         continue
-                    elif isinstance(return_msg, int):
+                    elif isinstance(return_msg, int) or return_msg == 'error':
                         print(return_msg)
                         print(self.processPage)
-                        time.sleep(8)
                     else:
                         try:
                             with open(path + save_file_name + image_type, 'wb') as code:
@@ -292,20 +305,20 @@ class PixivSpider(Spider):
                         except requests.exceptions.RequestException as errno:
                             print(errno)
                             os.remove(path + save_file_name + image_type)
-                            time.sleep(5)
                             self.download_pic(manga_big_page_url, real_url, path + save_file_name + image_type)
                             success_download = True
-                            break
                         else:
                             print('download successful')
                             success_download = True
-                            break
+                        saved_files.append((int(data_index), path + save_file_name + image_type))
+                        break
                 if success_download is False:
                     print(self.processPage)
                     print('Cannot find download url')
+            self.record_download(illust_id, path, saved_files, len(saved_files) == len(item_container))
         # 动图
-        elif (u'_work' in container.a['class']) is False:
-            html = html_root.get_text()
+        elif (u'_work' in page.a_class) is False:
+            html = page.text
             # content = html_root.find('meta', {'property': 'og:title'})['content']
             # m = re.match(ur'\u300c(.*?)\u300d/\u300c(.*?)\u300d.*', content)
             # title = m.group(1)
@@ -348,43 +361,60 @@ class PixivSpider(Spider):
                 with open(path + save_file_name[:-4] + '.gif', 'wb') as fp:
                     images[0].save(fp=fp, save_all=True, append_images=images[1:], loop=65535, duration=images_duration)
                 rmtree(zip_dir)
+            self.record_download(illust_id, path, [(0, path + save_file_name), (0, path + save_file_name[:-4] + '.gif')])
+
+    # 把保存完成的文件写入下载清单 (没有作品id或者没有使用清单时跳过)
+    def record_download(self, illust_id, directory, files, complete=True):
+        if illust_id is None or self.manifest is None:
+            return
+        self.manifest.finish(illust_id, directory, files, complete)
 
     # 下载某一个图片: page_url图片存在的作品页面地址, pic_url图片真正地址, path保存文件完整地址   PS.不了解不需要直接调用
+    # 请求和写入文件一起按retry_policy重试 (不再递归调用)
     def download_pic(self, page_url, pic_url, path):
-        msg = self.request_pic_url(page_url, pic_url)
-        while msg == 'error':
-            time.sleep(3)
-            msg = self.request_pic_url(page_url, pic_url)
+        try:
+            msg = self.retry_policy.run(partial(self.save_pic, page_url, pic_url, path))
+        except requests.exceptions.RequestException as error:
+            print(error)
+            if os.path.exists(path):
+                os.remove(path)
+            return
         if isinstance(msg, int):
             print(msg)
             print(self.processPage)
             print('')
-            time.sleep(8)
         else:
-            try:
-                with open(path, 'wb') as code:
-                    code.write(msg.content)
-            except requests.exceptions.RequestException as error:
-                print(error)
-                os.remove(path)
-                time.sleep(5)
-                self.download_pic(page_url, pic_url, path)
-            else:
-                print('download successful')
-
-    # 请求服务器, 不直接调用
-    def request_pic_url(self, page_url, pic_url):
+            print('download successful')
+
+    # 请求并写入一次 成功返回None, 4xx(不会重试)返回状态码
+    # 5xx 429 抛出TryError(状态码, Retry-After) 传输中断时抛出RequestException, 都由retry_policy分类重试
+    def save_pic(self, page_url, pic_url, path):
+        response = self.http_client.get(pic_url, headers=self.pic_headers(page_url, pic_url), stream=True, timeout=50)
+        if response.status_code != 200:
+            response.close()
+            if classify_status(response.status_code) in RETRYABLE:
+                raise TryError(response.status_code, response.headers.get('Retry-After'))
+            return response.status_code
+        with open(path, 'wb') as code:
+            code.write(response.content)
+
+    def pic_headers(self, page_url, pic_url):
         host = pic_url.split('/')[2]
-        header = {"Accept": "image/webp,image/*,*/*;q=0.8",
-                  "Accept - Encoding": "gzip, deflate, sdch",
-                  "Accept - Language": "zh - CN, zh;q = 0.8",
-                  "Cache-Control": "max-age=0",
-                  "Connection": "keep-alive",
-                  "Host": host,
-                  "Referer": page_url,
-                  "User-Agent": self.heads[random.randint(0, len(self.heads) - 1)]["User-Agent"]}
+        return {"Accept": "image/webp,image/*,*/*;q=0.8",
+                "Accept - Encoding": "gzip, deflate, sdch",
+                "Accept - Language": "zh - CN, zh;q = 0.8",
+                "Cache-Control": "max-age=0",
+                "Connection": "keep-alive",
+                "Host": host,
+                "Referer": page_url,
+                "User-Agent": self.heads[random.randint(0, len(self.heads) - 1)]["User-Agent"]}
+
+    # 请求服务器, 不直接调用 (按retry_policy重试, 仍然失败返回'error')
+    def request_pic_url(self, page_url, pic_url):
+        header = self.pic_headers(page_url, pic_url)
         try:
-            response = requests.get(pic_url, headers=header, stream=True, timeout=50)
+            response = self.retry_policy.run(partial(self.http_client.get, pic_url, headers=header, stream=True,
+                                                     timeout=50))
             if response.status_code == 200:
                 print('connect successful')
                 return response
@@ -431,11 +461,10 @@ class PixivSpider(Spider):
             search_url = '%s?mode=%s&content=%s' % (base_url, mode, content)
         else:
             search_url = '%s?mode=%s&content=%s&date=%s' % (base_url, mode, content, date)
-        html_tree = self.get_html_tree(search_url)
-        while html_tree is None:
-            time.sleep(2)
-            html_tree = self.get_html_tree(search_url)
-        date = html_tree.find('ul', {'class': 'sibling-items'}).li.next_sibling.get_text()
+        html_root = self.get_html_root(search_url)
+        if html_root is None:
+            return
+        date, sections = extract.legacy_ranking(html_root)
         date = date.replace('/', '-')
         if search_range in self.mode_modify:
             search_range = self.mode_modify[search_range]
@@ -445,15 +474,13 @@ class PixivSpider(Spider):
             print('dir exisits')
         else:
             os.makedirs(save_dir)
-        sections = html_tree.find_all('section', {'class': 'ranking-item'})
-        if sections is None:
+        if not sections:
             print('Cannot find ranking')
             return
-        for rank_item in sections:
-            index = int(rank_item['id'])
+        for index, data_id in sections:
             if rank_range[0] <= index <= rank_range[1]:
                 self.run_pixiv_page(
-                    'http://www.pixiv.net/member_illust.php?mode=medium&illust_id=%s' % rank_item['data-id'], save_dir)
+                    'http://www.pixiv.net/member_illust.php?mode=medium&illust_id=%s' % data_id, save_dir)
 
     def run_pixiv_area_ranking(self):
         pass
@@ -461,7 +488,34 @@ class PixivSpider(Spider):
 
 class PixivSpiderLogin(object):
     # path设置保存地址 processes设置最大进程数
-    def __init__(self, path='D:/PixivSpider/', num_processes=None, num_threading=10):
+    # pool_connections 连接池缓存的host数量 pool_maxsize 每个host保持的最大连接数(缺省为num_threading)
+    # chunk_size 下载图片时每次写入硬盘的块大小 download_retries 下载中断后最多续传的次数
+    # db_batch_size 更新数据库时每个事务写入的行数
+    # thumbnail_store 保存缩略图的thumbstore.ThumbnailStore, 缺省为数据库旁边的 <数据库名>_thumbnails/ 目录
+    # seen_path 已下载作品id集合(seenset.SeenSet)的文件路径, 设置后所有入口都会跳过已经下载过的作品, 缺省不使用
+    # use_manifest 是否使用下载清单(path/manifest.db) 清单中已经保存在目标目录的作品不再请求页面
+    # blob_path 设置后每张原图只在这个目录(blobstore.BlobStore)中保存一份, 各个文件夹里放链接, 缺省不使用
+    # blob_link 'hard' 硬链接 / 'sym' 符号链接
+    # use_cache 是否使用http响应缓存(path/cache.db, httpcache.ResponseCache) 过去日期的排行榜json永久缓存
+    #   每个登录会话(cookies)分开缓存
+    # cache_ttl 作品页面等在缓存中的有效秒数
+    # num_threading 和 num_processes 是并发的初始值, 之后由AIMD控制(concurrency.AimdController)根据延迟和错误率调整
+    # max_threading 每个进程同时进行的请求数上限(缺省为num_threading的4倍)
+    # max_processes 同时处理的作品数上限(进程池大小, 缺省为num_processes的2倍)
+    # request_rate 页面和json请求 每秒最多几个; byte_rate 下载图片 每秒最多多少字节; None不限制
+    # share_rate_limits 为True时令牌桶放在manager进程中, 进程池中的所有进程共用一个预算
+    # retry_policy 所有请求使用的重试策略(retry.RetryPolicy) 缺省为指数退避+随机抖动, 每次操作最多5分钟
+    # transcode_formats 动图zip转换的格式 'gif' 'webp'(动画webp) 'apng' 的元组
+    # transcode_processes 转码进程数(缺省为cpu数) 多进程下载时转码在独立的进程池中进行, 下载进程交出zip后继续下载
+    # 0 表示在下载的进程中直接转码
+    # use_job_queue 是否使用持久化的任务队列(path/jobs.db, jobqueue.JobQueue) 批量下载的作品先放入队列,
+    # 中断后重新运行时继续没有完成的任务; job_lease 任务的租约秒数; job_attempts 每个作品最多尝试的次数
+    def __init__(self, path='D:/PixivSpider/', num_processes=None, num_threading=10, pool_connections=10,
+                 pool_maxsize=None, chunk_size=1024 * 60, download_retries=10, db_batch_size=500,
+                 thumbnail_store=None, seen_path=None, use_manifest=True, blob_path=None, blob_link='hard',
+                 use_cache=True, cache_ttl=24 * 3600, max_threading=None, max_processes=None, request_rate=None,
+                 byte_rate=None, share_rate_limits=True, retry_policy=None, transcode_formats=('gif',),
+                 transcode_processes=None, use_job_queue=True, job_lease=600, job_attempts=3):
         self.base_headers = [{"Accept-Language": "zh-CN,zh;q=0.8",
                               'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/42.0.2311.135 Safari/537.36 Edge/12.10240'},
                              {"Accept-Language": "zh-CN,zh;q=0.8",
@@ -488,8 +542,54 @@ class PixivSpiderLogin(object):
         self.pixiv_context_token = ''
         # 多进程的数量
         self.num_processes = num_processes
+        self.max_processes = max_processes or (num_processes or multiprocessing.cpu_count()) * 2
         # 多图下载时的最大线程数
         self.num_threading = num_threading
+        self.max_threading = max_threading or num_threading * 4
+        # 请求的并发窗口 每个进程一个(传给子进程时复制当前的窗口)
+        self.concurrency = AimdController(initial=num_threading, maximum=self.max_threading)
+        # 长连接客户端 所有请求共用连接池
+        self.http_client = HttpClient(pool_connections=pool_connections,
+                                      pool_maxsize=pool_maxsize or self.max_threading)
+        # 令牌桶限速 页面/json请求数 和 图片字节数 分开计算
+        self.request_limiter = rate_limiter(request_rate, shared=share_rate_limits, name='requests')
+        self.byte_limiter = rate_limiter(byte_rate, shared=share_rate_limits, name='bytes')
+        # 重试策略 统计重试次数
+        self.retry_policy = retry_policy or RetryPolicy()
+        # 下载时写入的块大小
+        self.chunk_size = chunk_size
+        # 下载中断后最多续传的次数
+        self.download_retries = download_retries
+        # 更新数据库时每个事务写入的行数
+        self.db_batch_size = db_batch_size
+        # 缩略图存储 数据库中只保存img_hash
+        self.thumbnail_store = thumbnail_store
+        # 已下载作品id集合的路径 (SeenSet不能pickle, 只在主进程中打开)
+        self.seen_path = seen_path
+        # 下载清单 每个进程(线程)使用自己的数据库连接
+        self.manifest = Manifest(path + 'manifest.db') if use_manifest else None
+        # 原图存储 同一张图在不同文件夹里只保存一份
+        self.blob_store = BlobStore(blob_path, blob_link) if blob_path is not None else None
+        # http响应缓存 重新运行或崩溃后恢复时已经请求过的页面不再访问网络
+        self.response_cache = ResponseCache(path + 'cache.db', ttl=cache_ttl) if use_cache else None
+        # 批量下载的任务队列 记录每个作品的状态和尝试次数
+        self.job_queue = JobQueue(path + 'jobs.db', job_lease, job_attempts) if use_job_queue else None
+        # 动图转码 transcode_queue 为转码队列(transcoding()中设置, 可以pickle传给下载进程), None时直接转码
+        self.transcode_formats = tuple(transcode_formats)
+        self.transcode_processes = transcode_processes
+        self.transcode_queue = None
+        self._transcoder = None
+        self._transcode_users = 0
+        # 下载期间打开的已下载作品id集合 转码的回调(transcoded)完成动图时加入
+        self._seen_set = None
+
+    # 转码进程池属于主进程 不传给子进程
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_transcoder'] = None
+        state['_transcode_users'] = 0
+        state['_seen_set'] = None
+        return state
 
     # 登录pixiv 登录后保存cookies.txt 类也会保存cookies可以之后直接调用登录后的操作
     def login_pixiv(self, pixiv_id, password):
@@ -553,165 +653,312 @@ class PixivSpiderLogin(object):
             f.close()
             return False
         f.close()
-        html = self.get_html_tree("http://www.pixiv.net/")
-        if html.find('div', {'class': 'signup-form'}) is not None:
+        home = extract.home_page(self.get_html_root("http://www.pixiv.net/"))
+        if not home.signed_in:
             print("cookies失效 重新登录")
             return False
-        m = re.search(r'pixiv\.context\.token\s*=\s*\"(.+?)\";', html.get_text())
-        self.pixiv_context_token = m.group(1)
+        self.pixiv_context_token = home.token
         return True
 
-    # 获取网页的beautifulsoup
-    def get_html_tree(self, url, header=None, params=None):
+    # 获取网页的lxml根节点 配合extract中预编译的XPath使用 (比建立完整的beautifulsoup快得多)
+    def get_html_root(self, url, header=None, params=None):
         if header is None:
             header = self.base_headers[random.randint(0, len(self.base_headers) - 1)]
         resp, s = self.get_response(url, params=params, headers=header, cookies=self.cookies, timeout=50)
         try:
-            soup = BeautifulSoup(resp.content, "lxml")
-            return soup
+            return extract.parse_html(resp.content)
         except Exception as error:
             print(error)
             return
 
-    # 保存网页 path 完整地址
-    def save_html_page(self, url, path, header=None, params=None):
-        connect = False
-        while connect is False:
-            try:
-                if header is None:
-                    header = self.base_headers[random.randint(0, len(self.base_headers) - 1)]
-                s = requests.Session()
-                req = requests.Request('GET', url=url, params=params, headers=header, cookies=self.cookies)
-                prepped = s.prepare_request(req)
-                resp = s.send(prepped, timeout=50)
-                with open(path, 'wb') as code:
-                    code.write(resp.content)
-                connect = True
-            except Exception as connect_error:
-                print(connect_error)
+    # 保存网页 path 完整地址 请求和写入一起按retry_policy重试 (与download_pic相同)
+    # 状态码不是200时抛出TryError由策略分类: 5xx 429 等待后重试, 其他不重试
+    # 仍然失败时打印错误 删除写了一半的文件, 返回False
+    def save_html_page(self, url, path, header=None, params=None, try_time=None):
+        if header is None:
+            header = self.base_headers[random.randint(0, len(self.base_headers) - 1)]
+        get = self.response_getter(self.http_client.session())
+
+        def save():
+            resp = get(url, params=params, headers=header, cookies=self.cookies, timeout=50)
+            if resp.status_code != 200:
+                raise TryError(resp.status_code, resp.headers.get('Retry-After'))
+            with open(path, 'wb') as code:
+                code.write(resp.content)
+
+        try:
+            self.request_policy(try_time).run(save)
+        except requests.exceptions.RequestException as connect_error:
+            print(connect_error)
+            if os.path.exists(path):
+                os.remove(path)
+            return False
+        return True
 
     # 爬p站某一个作品页面, 支持单图, 多图, 动图: illust_id 图片id, path 存储地址(格式:..: /../../../ )
     # 修改后基于登录,不用猜测图片类型
     # 漫画会单独放在一个文件夹里
+    # 作品的文件全部保存完成时返回True
     def run_pixiv_page(self, illust_id, path):
+        # 清单中已经完整保存的作品不再请求页面
+        if self.manifest is not None and self.manifest.is_complete(illust_id, path):
+            print('file exist')
+            return True
+        # 已经保存在其他文件夹的作品直接链接过来 不访问网络
+        if self.link_from_store(illust_id, path):
+            print(illust_id, 'linked')
+            return True
+        directory = path
         process_page = "http://www.pixiv.net/member_illust.php?mode=medium&illust_id=%s" % illust_id
-        html_root = self.get_html_tree(process_page)
-        works_display = html_root.find('div', {'class': 'works_display'})
-        if works_display is None:
+        html_root = self.get_html_root(process_page)
+        info = self.parse_illust_page(html_root, illust_id)
+        if info is None:
             print(illust_id, '作品不存在或不可见')
             return
-        content_title_user_name = html_root.find('meta', {'property': 'og:title'})['content']
-        m = re.match(r'\u300c(.*?)\u300d/\u300c(.*?)\u300d.*', content_title_user_name)
-        title = m.group(1)
-        user_name = m.group(2)
         # 单图
-        if works_display.div['class'][-1] == 'ui-modal-trigger':
-            # 得到原图地址
-            img = html_root.find('img', {'class': 'original-image'})
-            data_src = img['data-src']
-            # 编辑保存文件名
-            save_file_name = '%s by %s id=%s' % (title, user_name, illust_id)
-            # 去除非法字段
-            save_file_name = u''.join(re.split(r'[\\/:*?"<>|\x00-\x1f]+', save_file_name))
-            filename_type = re.split(r'\.', data_src)[-1]
-            if os.path.exists(path + save_file_name + '.' + filename_type):
+        if info.type == 'single':
+            file_path = path + self.single_file_name(info)
+            if os.path.exists(file_path):
                 print('file exist')
-                return
-            self.download_pic(process_page, data_src, path + save_file_name + '.' + filename_type)
-        # 多图
-        elif works_display.div['class'][-1] == '_layout-thumbnail':
-            lock = threading.Lock()
-
-            def run_thread(func, url, args):
-                item_page = func(url)
-                _index = re.split(r'=', url)[-1]
-                _img = item_page.find('img')
-                src = _img['src']
-                _filename_type = re.split(r'\.', src)[-1]
-                if os.path.exists(path + save_file_name + _index + '.' + _filename_type):
-                    print('file exist')
-                    return
-                lock.acquire()
-                try:
-                    args.append((url, src, path + save_file_name + _index + '.' + _filename_type))
-                finally:
-                    lock.release()
-
-            a = html_root.find('div', {'class': 'works_display'}).a
-            save_file_name = '%s by %s id=%s_p' % (title, user_name, illust_id)
-            save_file_name = u''.join(re.split(r'[\\/:*?"<>|\x00-\x1f]+', save_file_name))
-            if 'manga' in a['class']:
-                path = path + save_file_name[:-2] + '/'
-                if os.path.exists(path):
-                    print('this dir exists')
-                else:
-                    os.makedirs(path)
-            manga_page_url = "http://www.pixiv.net/" + a['href']
-            manga_page = self.get_html_tree(manga_page_url)
-            download_args = []
-            item_container = manga_page.find_all('div', {'class': 'item-container'})
-            # 另一种漫画页面 e.g 54976833
-            if not item_container:
-                html = manga_page.get_text()
-                pic_urls = re.findall(r'pixiv\.context\.originalImages\[\d+\]\s*=\s*\"(.+?)\";', html)
-                pic_urls = map(lambda x: ''.join(re.split(r'\\', x)), pic_urls)
-                for pic_url in pic_urls:
-                    spilt = re.split(r'\.', pic_url)
-                    filename_type = spilt[-1]
-                    index = re.split(r'_p', spilt[-2])[-1]
-                    if os.path.exists(path + save_file_name + index + '.' + filename_type):
-                        print('file exist')
-                        continue
-                    download_args.append((manga_page_url, pic_url, path + save_file_name + index + '.' + filename_type))
             else:
-                run_thread_args = map(lambda x: (self.get_html_tree,
-                                                 "http://www.pixiv.net/" + x.a['href'], download_args), item_container)
-                run_threading_limited(run_thread, run_thread_args, self.num_threading)
+                self.download_pic(process_page, info.data_src, file_path)
+            return self.record_download(illust_id, directory, [(0, file_path)])
+        # 多图
+        elif info.type == 'multiple':
+            path, save_file_name = self.multiple_save_path(info, path)
+            manga_page = self.get_html_root(info.manga_page_url)
+            download_args, item_urls = self.parse_manga_page(manga_page, info.manga_page_url, path, save_file_name)
             # 多线程下载插画
-            run_threading_limited(self.download_pic, download_args, self.num_threading)
+            tasks = run_threading_limited(self.download_pic, download_args, self.max_threading)
+            if item_urls:
+                tasks += self.download_manga_pages(item_urls, path, save_file_name)
+            return self.record_download(illust_id, directory, Manifest.page_files(path, save_file_name),
+                                        all(task.exception is None for task in tasks))
         # 动图
-        elif works_display.div['class'][-1] == '_ugoku-illust-player-container':
-            save_file_name = title + ' by ' + user_name + ' id=' + str(illust_id) + '.zip'
-            save_file_name = u''.join(re.split(r'[\\/:*?"<>|\x00-\x1f]+', save_file_name))
-            html = html_root.get_text()
-            m = re.search(r'pixiv.context.ugokuIllustFullscreenData\s*=\s*\{(.+?)\};', html)
-            ugoku_illust_fullscreen_data = m.group(1)
-            if os.path.exists(path + save_file_name):
+        elif info.type == 'ugoira':
+            zip_path = path + self.ugoira_file_name(info)
+            if os.path.exists(zip_path):
                 print('file exist')
             else:
-                m = re.search(r'"src":"(http:\\/\\/.+?.zip)"', ugoku_illust_fullscreen_data)
-                zip_url = m.group(1)
-                zip_url = ''.join(zip_url.split('\\'))
-                self.download_pic(process_page, zip_url, path + save_file_name)
-            # 自动转gif动图
-            if os.path.exists(path + save_file_name[:-4] + '.gif'):
-                print('file exist')
+                self.download_pic(process_page, self.ugoira_zip_url(info.ugoku_data), zip_path)
+            return self.transcode_ugoira(illust_id, directory, zip_path, info.ugoku_data)
+
+    # 动图自动转换为transcode_formats中的格式
+    # 有转码队列时交给转码进程, 清单先只记录zip(不完整) 转码完成后在主进程的回调(transcoded)中写入完整的记录
+    # 交出zip后返回transcode.QUEUED, 任务队列中的任务保持进行中 由转码的回调(transcoded)完成或放回队列
+    def transcode_ugoira(self, illust_id, directory, zip_path, ugoku_data):
+        outputs = [out_path for _, out_path in transcode.output_paths(zip_path, self.transcode_formats)]
+        if all(os.path.exists(out_path) for out_path in outputs):
+            print('file exist')
+        elif self.transcode_queue is not None:
+            self.transcode_queue.put(zip_path, ugoku_data, illust_id, directory)
+            self.record_download(illust_id, directory, [(0, zip_path)], False)
+            return transcode.QUEUED
+        else:
+            outputs = transcode.transcode(zip_path, ugoku_data, self.transcode_formats)
+        return self.finish_transcode(illust_id, directory, zip_path, outputs)
+
+    # 转码结束 zip和输出文件写入清单(使用blob_store时放进存储) 返回作品是否完整
+    # 没有输出(zip损坏)时删除zip, 重试时重新下载
+    def finish_transcode(self, illust_id, directory, zip_path, outputs):
+        if not outputs and os.path.exists(zip_path):
+            os.remove(zip_path)
+        return self.record_download(illust_id, directory, [(0, zip_path)] + [(0, out_path) for out_path in outputs])
+
+    # 使用任务队列时 在这个范围内取出的任务由后台线程定期续约
+    @contextmanager
+    def renewing_jobs(self):
+        if self.job_queue is None:
+            yield None
+            return
+        with self.job_queue.renewing() as jobs:
+            yield jobs
+
+    # 在这个范围内下载的动图交给独立的转码进程池 退出时等待转码全部完成
+    # 可以嵌套使用, 最外层退出时关闭进程池; transcode_processes为0时不使用进程池
+    @contextmanager
+    def transcoding(self):
+        if self.transcode_processes == 0:
+            yield None
+            return
+        if self._transcode_users == 0:
+            self._transcoder = Transcoder(self.transcode_formats, self.transcode_processes, self.transcoded,
+                                          self.transcode_failed)
+            self.transcode_queue = self._transcoder.handle()
+        self._transcode_users += 1
+        try:
+            yield self._transcoder
+        finally:
+            self._transcode_users -= 1
+            if self._transcode_users == 0:
+                self.transcode_queue = None
+                self._transcoder.close()
+                print('转码:', self._transcoder.metrics())
+                self._transcoder = None
+
+    # 转码进程完成一个动图 (在主进程中) 写入清单 更新任务队列, 完整的作品加入已下载作品id集合
+    def transcoded(self, zip_path, illust_id, directory, outputs):
+        if illust_id is None:
+            return
+        complete = self.finish_transcode(illust_id, directory, zip_path, outputs)
+        if self.job_queue is not None:
+            self.job_queue.finish(illust_id, directory, complete)
+        if complete and self._seen_set is not None:
+            self._seen_set.add(illust_id)
+
+    # 转码失败 任务放回队列(超过最多尝试次数时为失败)
+    def transcode_failed(self, zip_path, illust_id, directory, error):
+        if self.job_queue is not None and illust_id is not None:
+            self.job_queue.fail(illust_id, directory, repr(error))
+
+    # 还没有完成的转码任务数
+    def transcode_pending(self):
+        return self._transcoder.pending() if self._transcoder is not None else 0
+
+    # 把保存完成的文件[(page, 文件路径)]写入下载清单 返回作品是否完整
+    # 使用blob_store时文件先放进存储, 原位置换成链接
+    def record_download(self, illust_id, directory, files, complete=True):
+        if self.blob_store is not None:
+            files = [(page, file_path, self.blob_store.add(file_path)) if os.path.exists(file_path)
+                     else (page, file_path) for page, file_path in files]
+        if self.manifest is None:
+            return complete and all(os.path.exists(item[1]) for item in files)
+        return self.manifest.finish(illust_id, directory, files, complete)
+
+    # 作品已经完整保存在其他文件夹时, 按同样的相对路径从blob_store建立链接并写入清单
+    # 需要同时使用清单和blob_store 成功返回True
+    def link_from_store(self, illust_id, directory):
+        if self.blob_store is None or self.manifest is None:
+            return False
+        copy = self.manifest.complete_copy(illust_id, directory)
+        if copy is None:
+            return False
+        source_directory, rows = copy
+        files = []
+        for page, source_path, size, sha1 in rows:
+            ext = os.path.splitext(source_path)[1]
+            if not self.blob_store.exists(sha1, ext):
+                # 使用blob_store之前下载的文件 先放进存储
+                if not os.path.exists(source_path):
+                    return False
+                self.blob_store.add(source_path, sha1)
+            dest = os.path.join(directory, os.path.relpath(source_path, source_directory))
+            self.blob_store.link(self.blob_store.path(sha1, ext), dest)
+            files.append((page, dest, sha1))
+        return self.manifest.finish(illust_id, directory, files)
+
+    # 解析作品页面 作品不存在或不可见时返回None, 否则返回extract.IllustPage
+    # html_root 为get_html_root得到的lxml根节点
+    @staticmethod
+    def parse_illust_page(html_root, illust_id):
+        if html_root is None:
+            return None
+        return extract.illust_page(html_root, illust_id)
+
+    # 去除文件名中的非法字段
+    @staticmethod
+    def legal_file_name(file_name):
+        return u''.join(re.split(r'[\\/:*?"<>|\x00-\x1f]+', file_name))
+
+    # 单图保存的文件名
+    def single_file_name(self, info):
+        filename_type = re.split(r'\.', info.data_src)[-1]
+        save_file_name = '%s by %s id=%s' % (info.title, info.user_name, info.illust_id)
+        return self.legal_file_name(save_file_name) + '.' + filename_type
+
+    # 动图zip保存的文件名
+    def ugoira_file_name(self, info):
+        save_file_name = '%s by %s id=%s.zip' % (info.title, info.user_name, info.illust_id)
+        return self.legal_file_name(save_file_name)
+
+    # 多图的保存路径和文件名前缀(后面接页码) 漫画会单独建立文件夹
+    def multiple_save_path(self, info, path):
+        save_file_name = '%s by %s id=%s_p' % (info.title, info.user_name, info.illust_id)
+        save_file_name = self.legal_file_name(save_file_name)
+        if info.manga:
+            path = path + save_file_name[:-2] + '/'
+            if os.path.exists(path):
+                print('this dir exists')
             else:
-                zip_name = save_file_name
-                zip_dir = path + save_file_name[:-4] + '/'
-                if os.path.exists(zip_dir):
-                    print('dir exists')
-                else:
-                    os.makedirs(zip_dir)
-                if zipfile.is_zipfile(path + zip_name):
-                    file_zip = zipfile.ZipFile(path + zip_name, 'r')
-                    for single_file in file_zip.namelist():
-                        if os.path.exists(zip_dir + single_file):
-                            print('file exists')
-                        else:
-                            file_zip.extract(single_file, zip_dir)
-                else:
-                    print('This file is not zip file')
-                files = os.listdir(zip_dir)
-                images = [Image.open(zip_dir + fn).convert('P', palette=Image.ADAPTIVE, dither=Image.FLOYDSTEINBERG) for
-                          fn in files]
-                m = re.search(r'"frames":\[(\{"file":.+\})\]', ugoku_illust_fullscreen_data)
-                images_duration = re.findall(r'\{"file":".+?","delay":(\d+?)\}', m.group(1))
-                # 使用PTL 关于GIFFile的save(), 由gif标准 duration >=20
-                images_duration = list(map(lambda x: (int(x) if int(x) >= 20 else 20), images_duration))
-                with open(path + save_file_name[:-4] + '.gif', 'wb') as fp:
-                    images[0].save(fp=fp, save_all=True, append_images=images[1:], loop=65535, duration=images_duration)
-                rmtree(zip_dir)
+                os.makedirs(path)
+        return path, save_file_name
+
+    # 解析多图页面 返回(download_args, item_urls)
+    # download_args 可以直接下载的(页面地址, 原图地址, 保存地址), 已存在的文件会被跳过
+    # item_urls 需要再请求一次才能得到原图地址的manga_big页面
+    @staticmethod
+    def parse_manga_page(manga_page, manga_page_url, path, save_file_name):
+        download_args = []
+        item_urls = []
+        page = extract.manga_page(manga_page)
+        # 另一种漫画页面 e.g 54976833
+        if not page.item_urls:
+            for pic_url in page.original_urls:
+                spilt = re.split(r'\.', pic_url)
+                filename_type = spilt[-1]
+                index = re.split(r'_p', spilt[-2])[-1]
+                if os.path.exists(path + save_file_name + index + '.' + filename_type):
+                    print('file exist')
+                    continue
+                download_args.append((manga_page_url, pic_url, path + save_file_name + index + '.' + filename_type))
+        else:
+            item_urls = page.item_urls
+        return download_args, item_urls
+
+    # 解析manga_big页面 返回(页面地址, 原图地址, 保存地址), 文件已存在返回None
+    @staticmethod
+    def manga_big_download_arg(item_page, url, path, save_file_name):
+        index = re.split(r'=', url)[-1]
+        src = extract.manga_big_src(item_page)
+        return PixivSpiderLogin.manga_download_arg(url, src, path, save_file_name, index)
+
+    # manga_big页面url的第index页的(页面地址, 原图地址, 保存地址), 文件已存在返回None
+    @staticmethod
+    def manga_download_arg(url, src, path, save_file_name, index):
+        filename_type = re.split(r'\.', src)[-1]
+        if os.path.exists(path + save_file_name + index + '.' + filename_type):
+            print('file exist')
+            return None
+        return url, src, path + save_file_name + index + '.' + filename_type
+
+    # 由第0页的原图地址推出第index页的原图地址: ..._p0.png -> ..._p{index}.png (扩展名可能不同, 需要404时回退)
+    @staticmethod
+    def manga_original_url(first_src, index):
+        return re.sub(r'_p0(\.\w+)$', r'_p%s\1' % index, first_src)
+
+    # 多图的manga_big页面 只请求第一页, 其余页面的原图地址按 _p{index} 推出, 不再每页请求一次html
+    # 每一页是一个任务: 推出地址 -> 下载, 404(扩展名不同等)时才请求该页的manga_big页面
+    # 任务在工作线程中流水线执行, 一页在下载时下一页已经在处理 返回Task列表
+    def download_manga_pages(self, item_urls, path, save_file_name):
+        first_src = extract.manga_big_src(self.get_html_root(item_urls[0]))
+
+        def run_page(url):
+            index = re.split(r'=', url)[-1]
+            arg = self.manga_download_arg(url, self.manga_original_url(first_src, index), path, save_file_name, index)
+            if arg is None:
+                return
+            try:
+                self.download_pic(*arg)
+            except TryError as error:
+                if error.args[0] != 404:
+                    raise
+                arg = self.manga_big_download_arg(self.get_html_root(url), url, path, save_file_name)
+                if arg is not None:
+                    self.download_pic(*arg)
+
+        return run_threading_limited(run_page, ((url,) for url in item_urls), self.max_threading)
+
+    # 动图zip的地址
+    @staticmethod
+    def ugoira_zip_url(ugoku_data):
+        m = re.search(r'"src":"(http:\\/\\/.+?.zip)"', ugoku_data)
+        return ''.join(m.group(1).split('\\'))
+
+    # 动图zip转gif: zip_path zip文件地址, gif_path 保存地址, ugoku_data 作品页面中的动图信息(帧的顺序和延时)
+    # 帧从zip中逐个读取 量化后立即写入gif, 不解压到硬盘
+    @staticmethod
+    def ugoira_to_gif(zip_path, gif_path, ugoku_data):
+        return ugoira.ugoira_to_gif(zip_path, gif_path, ugoku_data)
 
     # 爬p站用户:
     # user_id 用户id
@@ -735,50 +982,66 @@ class PixivSpiderLogin(object):
     # page:从第几页开始
     def run_pixiv_user(self, user_id, method="illust", search_type="", tag="", order="desc", rest="show",
                        untagged="", page='1'):
+        request = self.user_request(user_id, method, search_type, tag, order, rest, untagged, page)
+        if request is None:
+            return
+        url, params, current_method = request
+        self.processPage = url
+        html_root = self.get_html_root(self.processPage, params=params)
+        path = self.user_save_path(html_root, user_id, method, current_method)
+        if path is None:
+            return
+        illust_ids = self.listing_illust_ids(html_root)
+        # 若有下一页 继续
+        next_url = self.listing_next_url(html_root)
+        while next_url is not None:
+            self.processPage = next_url
+            html_root = self.get_html_root(self.processPage)
+            illust_ids.extend(self.listing_illust_ids(html_root))
+            next_url = self.listing_next_url(html_root)
+        self.async_run_pixiv_page(illust_ids, path)
+
+    # 用户页面的请求地址和参数 返回(url, params, 方向的中文名) 不支持的method返回None
+    @staticmethod
+    def user_request(user_id, method="illust", search_type="", tag="", order="desc", rest="show", untagged="",
+                     page='1'):
         if method == "illust":
-            self.processPage = "http://www.pixiv.net/member_illust.php"
+            url = "http://www.pixiv.net/member_illust.php"
             params = {'id': user_id, 'type': search_type, 'tag': tag, 'p': page}
             current_method = u"作品"
         elif method == "bookmark":
-            self.processPage = "http://www.pixiv.net/bookmark.php"
+            url = "http://www.pixiv.net/bookmark.php"
             params = {'id': user_id, 'rest': rest, 'order': order, 'tag': tag, 'untagged': untagged, 'p': page}
             current_method = u"收藏"
         elif method == "member":
-            pass
             # FIXME 获取个人资料不知道有什么用就没有写了
-            return
+            return None
         else:
             print("no such method")
-            return
-
+            return None
         temp = [key for key in params if params[key] == '']
         list(map(lambda x: params.pop(x), temp))
-
-        html_root = self.get_html_tree(self.processPage, params=params)
-        div = html_root.find('div', {'class': 'error-unit'})
-        if div is not None:
-            print(div.h2.get_text())
-            print(div.p.get_text())
-            return
+        return url, params, current_method
+
+    # 根据用户页面第一页创建保存路径 出错或没有结果返回None
+    def user_save_path(self, html_root, user_id, method, current_method):
+        listing = extract.user_listing(html_root)
+        if listing.error is not None:
+            print(listing.error[0])
+            print(listing.error[1])
+            return None
         # 获取图片id 没有结果返回
-        image_items = html_root.find_all('li', {'class': 'image-item'})
-        if not image_items:
+        if not listing.illust_ids:
             print("未找到任何相关结果")
-            return
+            return None
         # 获取用户昵称
-        user_name = html_root.find('h1', {'class': 'user'}).get_text()
-        user_name = u''.join(re.split(r'[\\/:*?"<>|\x00-\x1f]+', user_name))
+        user_name = self.legal_file_name(listing.user_name)
         current_type = ""
         # 获取作品类型
         if method == 'illust':
-            current = html_root.find('ul', {"class": "menu-items"}).find('a', {'class': 'current'})
-            current_type = current.get_text() + ' '
+            current_type = listing.current_type + ' '
         # 获取标签
-        tag_badge = html_root.find('span', {'class': 'tag-badge'})
-        if tag_badge is None:
-            current_tag = ""
-        else:
-            current_tag = tag_badge.get_text()
+        current_tag = listing.tag or ""
         # 创建路径
         path = "%s%s id=%s/%s %s%s/" % (self.savePath, user_name, user_id, current_method, current_type, current_tag)
         print(path)
@@ -786,29 +1049,44 @@ class PixivSpiderLogin(object):
             print('this dir exists')
         else:
             os.makedirs(path)
-        illust_ids = []
-        for item in image_items:
-            img_id = item.img['data-id']
-            illust_ids.append(img_id)
-        # 获取下一页
-        next_url = html_root.find('span', {'class': 'next'})
-        if next_url is None:
-            return
-        else:
-            next_url = next_url.a
-        # 若有下一页 继续
-        while next_url is not None:
-            self.processPage = "http://www.pixiv.net/member_illust.php%s" % next_url['href']
-            html_root = self.get_html_tree(self.processPage)
-            image_items = html_root.find_all('li', {'class': 'image-item'})
-            for item in image_items:
-                img_id = item.img['data-id']
-                self.run_pixiv_page(img_id, path)
-            next_url = html_root.find('span', {'class': 'next'}).a
-        self.async_run_pixiv_page(illust_ids, path)
+        return path
+
+    # 列表页面(用户作品 收藏 搜索结果)中的作品id
+    @staticmethod
+    def listing_illust_ids(html_root):
+        return extract.listing_illust_ids(html_root)
+
+    # 列表页面的下一页地址 没有下一页返回None
+    @staticmethod
+    def listing_next_url(html_root):
+        return extract.listing_next_url(html_root)
 
     # 下载某一个图片: page_url图片存在的作品页面地址, pic_url图片真正地址, path保存文件完整地址 (直接下载)
-    def download_pic(self, page_url, pic_url, path):
+    # chunk_size 每次写入的块大小(缺省为self.chunk_size) 下载过程中内存占用不超过一个块
+    # max_retries 连接中断后最多重试的次数(缺省为self.download_retries)
+    # 先写入 path + '.part' 临时文件, 下载完整后再原子地改名为path, 中断不会留下不完整的图片
+    # path + '.part.json' 记录url 总长度 ETag 已接收字节数, 中断后用Range请求从断点继续
+    def download_pic(self, page_url, pic_url, path, chunk_size=None, max_retries=None):
+        if chunk_size is None:
+            chunk_size = self.chunk_size
+        if max_retries is None:
+            max_retries = self.download_retries
+        # 断点续传不限制总时间 只限制次数; 5xx 429 和传输中断时重试, 其他状态码(TryError)直接抛出
+        policy = self.retry_policy.derive(max_attempts=max_retries + 1, deadline=None)
+        policy.run(partial(self.download_pic_range, page_url, pic_url, path, chunk_size))
+
+    # 从.part文件的断点继续下载一次 中断时抛出RequestException 由download_pic重试
+    def download_pic_range(self, page_url, pic_url, path, chunk_size):
+        temp_path = path + '.part'
+        ledger_path = temp_path + '.json'
+        ledger = self.read_download_ledger(ledger_path)
+        offset = 0
+        if ledger is not None and ledger['url'] == pic_url and os.path.exists(temp_path):
+            offset = os.path.getsize(temp_path)
+            if ledger['length'] and offset > ledger['length']:
+                offset = 0
+        else:
+            ledger = None
         host = pic_url.split('/')[2]
         headers = {"Accept": "image/webp,image/*,*/*;q=0.8",
                    "Accept - Encoding": "gzip, deflate, sdch",
@@ -818,32 +1096,97 @@ class PixivSpiderLogin(object):
                    "Host": host,
                    "Referer": page_url,
                    "User-Agent": self.base_headers[random.randint(0, len(self.base_headers) - 1)]["User-Agent"]}
-        # GET 请求
-        resp, s = self.get_response(pic_url, headers=headers, stream=True, timeout=50)
-        if resp.status_code != 200:
-            resp.close()
-            raise TryError(resp.status_code)
-        content_size = int(resp.headers.get('content-length'))
-        progress = ProgressBar(path.split('/')[-1], content_size, ProgressBar.data_size,
-                               run_status='正在下载', fin_status='下载完成')
-        # 下载保存
-        try:
-            with open(path, 'wb') as code:
-                file = b''
-                for data in resp.iter_content(chunk_size=1024 * 60):
-                    file += data
-                    progress.refresh(len(data))
+        if offset > 0:
+            headers['Range'] = 'bytes=%d-' % offset
+            # 服务器上的文件变了则返回200 重新下载
+            if_range = ledger['etag'] or ledger['last_modified']
+            if if_range:
+                headers['If-Range'] = if_range
+        # GET 请求 下载的整个过程占用一个并发位置
+        with self.concurrency.track() as call:
+            resp, s = self.get_response(pic_url, headers=headers, stream=True, timeout=50, tracked=True)
+            call.status(resp.status_code)
+            try:
+                if resp.status_code == 416 and ledger is not None and offset == ledger['length']:
+                    # 上次已经接收完整
+                    self.finish_download(temp_path, ledger_path, path, ledger['length'])
+                    return
+                if resp.status_code == 416 and offset > 0:
+                    raise self.discard_download(temp_path, ledger_path, '断点无效 416')
+                if resp.status_code == 200:
+                    offset = 0
+                elif resp.status_code != 206:
+                    raise TryError(resp.status_code)
+                elif not resp.headers.get('content-range', '').startswith('bytes %d-' % offset):
+                    raise self.discard_download(temp_path, ledger_path,
+                                                'Content-Range不匹配 %s' % resp.headers.get('content-range'))
+                content_size = int(resp.headers.get('content-length', 0))
+                ledger = {'url': pic_url,
+                          'length': offset + content_size if content_size else 0,
+                          'etag': resp.headers.get('etag', ledger['etag'] if ledger else None),
+                          'last_modified': resp.headers.get('last-modified',
+                                                            ledger['last_modified'] if ledger else None),
+                          'received': offset}
+                self.write_download_ledger(ledger_path, ledger)
+                progress = ProgressBar(path.split('/')[-1], ledger['length'], ProgressBar.data_size, progress=offset,
+                                       run_status='正在下载' if offset == 0 else '继续下载', fin_status='下载完成')
+                # 边下载边写入临时文件 206时追加在断点之后
+                with open(temp_path, 'ab' if offset else 'wb') as code:
+                    try:
+                        for data in resp.iter_content(chunk_size=chunk_size):
+                            code.write(data)
+                            progress.refresh(len(data))
+                            if self.byte_limiter is not None:
+                                self.byte_limiter.acquire(len(data))
+                    except requests.exceptions.RequestException:
+                        call.fail()
+                        code.flush()
+                        ledger['received'] = code.tell()
+                        self.write_download_ledger(ledger_path, ledger)
+                        progress.close(unexcept_status='下载中断')
+                        raise
                 progress.close()
-                code.write(file)
-        except requests.exceptions.RequestException:
-            progress.close(unexcept_status='下载中断')
-            resp.close()
-            os.remove(path)
-            self.download_pic(page_url, pic_url, path)
-        finally:
-            if resp:
+                self.finish_download(temp_path, ledger_path, path, ledger['length'])
+            finally:
                 resp.close()
 
+    # 断点不能续传(416 或 Content-Range不是从断点开始): 删除临时文件和记录, 返回可以重试的异常 重试时从头下载
+    @staticmethod
+    def discard_download(temp_path, ledger_path, reason):
+        for file_path in (temp_path, ledger_path):
+            if os.path.exists(file_path):
+                os.remove(file_path)
+        return requests.exceptions.ContentDecodingError(reason)
+
+    # 校验长度后改名为最终文件 长度不对时当作中断处理(下次从断点继续)
+    @staticmethod
+    def finish_download(temp_path, ledger_path, path, length):
+        size = os.path.getsize(temp_path)
+        if length and size != length:
+            if size > length:
+                os.remove(temp_path)
+                os.remove(ledger_path)
+            raise requests.exceptions.ContentDecodingError('文件大小不符 %d/%d' % (size, length))
+        os.replace(temp_path, path)
+        if os.path.exists(ledger_path):
+            os.remove(ledger_path)
+
+    @staticmethod
+    def read_download_ledger(ledger_path):
+        if not os.path.exists(ledger_path):
+            return None
+        try:
+            with open(ledger_path, 'r') as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def write_download_ledger(ledger_path, ledger):
+        with open(ledger_path + '.tmp', 'w') as fp:
+            json.dump(ledger, fp)
+        os.replace(ledger_path + '.tmp', ledger_path)
+
     # 主要参数:(php参数)
     # content='all' 综合(缺省); 'illust' 插画; 'ugoira' 动画; 'manga' 漫画
     # mode='daily' 今日(缺省); 'weekly' 本周; 'monthly' 本月; 'rookie' 新人;
@@ -896,11 +1239,49 @@ class PixivSpiderLogin(object):
     # user_name :  フライ○ティアゆ08a
     def run_pixiv_ranking(self, content='all', mode='daily', date='', search_range=(1, 50), filter_func=None):
         base_url = 'http://www.pixiv.net/ranking.php'
+        params = self.ranking_params(content, mode, date)
+        if params is None:
+            return
+        # 请求页面 若返回4xx 报告错误
+        headers = self.base_headers[random.randint(0, len(self.base_headers) - 1)]
+        resp, s = self.get_response(base_url, params=params, headers=headers, cookies=self.cookies)
+        if re.match(r'4\d\d', str(resp.status_code)):
+            print("发生了错误")
+            return
+        # 获取当前页面信息
+        save_dir, tt = self.ranking_page_info(extract.parse_html(resp.content))
+        # 获取json
+        params['p'] = 1
+        params['format'] = 'json'
+        params['tt'] = tt
+        headers = self.base_headers[random.randint(0, len(self.base_headers) - 1)]
+        resp, s = self.get_response(base_url, params=params, headers=headers, cookies=self.cookies, session=s)
+        json = resp.json()
+        if re.match(r'4\d\d', str(resp.status_code)):
+            print(json['error'])
+            return
+        plan = self.ranking_plan(search_range, int(json['rank_total']))
+        if plan is None:
+            return
+        # 开始爬
+        illust_ids = []
+        for p, i_begin, i_end in plan:
+            params['p'] = p
+            headers = self.base_headers[random.randint(0, len(self.base_headers) - 1)]
+            resp, s = self.get_response(base_url, params=params, headers=headers, cookies=self.cookies, session=s)
+            json = resp.json()
+            if re.match(r'4\d\d', str(resp.status_code)):
+                print(json['error'], "p站欺骗了我")
+                return
+            illust_ids.extend(self.filter_ranking_items(json['contents'][i_begin - 1:i_end], filter_func))
+        self.async_run_pixiv_page(illust_ids, save_dir)
+
+    # 排行榜的query string parameters content和mode不匹配返回None
+    def ranking_params(self, content='all', mode='daily', date=''):
         if content in self.content_dict:
             if mode not in self.content_dict[content]:
                 print('错误的mode')
-                return
-        temp_range = [int(search_range[0]), int(search_range[1])]
+                return None
         # date 的合法性检测 不合法则缺省
         # 理论上还是支持(year)-(month)-(day)
         # (year)/(month)/(day)
@@ -913,58 +1294,46 @@ class PixivSpiderLogin(object):
             local_time = time.strftime('%Y%m%d')
             if local_time <= input_time:
                 input_time = ''
-        date = input_time
-        # query string parameters
-        params = {'content': content, 'mode': mode, 'date': date}
+        params = {'content': content, 'mode': mode, 'date': input_time}
         temp = [key for key in params if params[key] == '']
         list(map(lambda x: params.pop(x), temp))
-        # 请求页面 若返回4xx 报告错误
-        headers = self.base_headers[random.randint(0, len(self.base_headers) - 1)]
-        resp, s = self.get_response(base_url, params=params, headers=headers, cookies=self.cookies)
-        if re.match(r'4\d\d', str(resp.status_code)):
-            print("发生了错误")
-            return
-        # 获取当前页面信息
-        html_root = BeautifulSoup(resp.content, "lxml")
-        current_title = html_root.find('h1', {'class': 'column-title'}).a.get_text()
-        current_date = html_root.find('ul', {'class': 'sibling-items'}).find('a', {'class': 'current'}).get_text()
-        current_title = current_title.replace(u'排行榜', '')
+        return params
+
+    # 从排行榜页面得到保存文件夹(会被创建)和tt
+    def ranking_page_info(self, html_root):
+        page = extract.ranking_page(html_root)
+        current_title = page.title.replace(u'排行榜', '')
+        current_date = page.date
         save_dir = '%s%s %s/' % (self.savePath, current_title, current_date)
         print(save_dir)
         if os.path.exists(save_dir):
             print('dir exisits')
         else:
             os.makedirs(save_dir)
-        # 获取json
-        tt = html_root.find('input', {'name': 'tt'})['value']
-        params['p'] = 1
-        params['format'] = 'json'
-        params['tt'] = tt
-        headers = self.base_headers[random.randint(0, len(self.base_headers) - 1)]
-        resp, s = self.get_response(base_url, params=params, headers=headers, cookies=self.cookies, session=s)
-        json = resp.json()
-        if re.match(r'4\d\d', str(resp.status_code)):
-            print(json['error'])
-            return
+        return save_dir, page.tt
+
+    # 根据排名范围计算要请求的json页: 返回[(p, 开始序号, 结束序号)] 序号从1开始 范围出错返回None
+    @staticmethod
+    def ranking_plan(search_range, rank_total):
+        temp_range = [int(search_range[0]), int(search_range[1])]
         # 负数特性(不靠谱 p站排名总数往往不是和json上的一样的)
-        rank_total = int(json['rank_total'])
         if temp_range[0] <= 0:
             temp_range[0] = search_range[0] + rank_total
         if temp_range[0] <= 0:
             print("范围出错")
-            return
+            return None
         if temp_range[1] <= 0:
             temp_range[1] = search_range[1] + rank_total
         if temp_range[1] <= 0:
             print("范围出错")
-            return
+            return None
         # 超范围修正
         if temp_range[1] > rank_total:
             print("超出范围 修正最大值:", rank_total)
             temp_range[1] = rank_total
         if temp_range[0] > temp_range[1]:
             print("范围出错")
-            return
+            return None
         print('range:', temp_range)
         # 一页50张图 模50的最小正完全剩余系 得到开始结束地址
         p_begin = ((temp_range[0] - 1) // 50) + 1
@@ -975,40 +1344,17 @@ class PixivSpiderLogin(object):
         i_end = temp_range[1] % 50
         if i_end == 0:
             i_end = 50
-        # 开始爬
-        p = p_begin
-        i = i_begin
-        illust_ids = []
-        while p <= p_end:
-            params['p'] = p
-            headers = self.base_headers[random.randint(0, len(self.base_headers) - 1)]
-            resp, s = self.get_response(base_url, params=params, headers=headers, cookies=self.cookies, session=s)
-            json = resp.json()
-            if re.match(r'4\d\d', str(resp.status_code)):
-                print(json['error'], "p站欺骗了我")
-                return
-            max_item = len(json['contents'])
-            if p != p_end:
-                while i <= 50 and i <= max_item:
-                    item = json['contents'][i - 1]
-                    if filter_func is None:
-                        illust_ids.append(item['illust_id'])
-                    else:
-                        if filter_func(item):
-                            illust_ids.append(item['illust_id'])
-                    i += 1
-            else:
-                while i <= i_end and i <= max_item:
-                    item = json['contents'][i - 1]
-                    if filter_func is None:
-                        illust_ids.append(item['illust_id'])
-                    else:
-                        if filter_func(item):
-                            illust_ids.append(item['illust_id'])
-                    i += 1
-            i = 1
-            p += 1
-        self.async_run_pixiv_page(illust_ids, save_dir)
+        plan = []
+        for p in range(p_begin, p_end + 1):
+            plan.append((p, i_begin if p == p_begin else 1, i_end if p == p_end else 50))
+        return plan
+
+    # 用filter_func筛选排行榜json中的作品 返回作品id列表
+    @staticmethod
+    def filter_ranking_items(items, filter_func=None):
+        if filter_func is None:
+            return [item['illust_id'] for item in items]
+        return [item['illust_id'] for item in items if filter_func(item)]
 
     # 参数
     # folder= 保存的文件夹名字, 文件夹在类默认路径下(名字Unicode编码)
@@ -1020,21 +1366,9 @@ class PixivSpiderLogin(object):
     def run_pixiv_recommended(self, folder='推荐', num_recommendations=500, sample_illusts=None, tags=None, match_mode=0,
                               strict_fliter=False):
         self.processPage = 'http://www.pixiv.net/recommended.php'
-        tt = self.pixiv_context_token
         recommender_url = 'http://www.pixiv.net/rpc/recommender.php'
         illust_list_url = 'http://www.pixiv.net/rpc/illust_list.php'
-        # num_recommendations 返回插画数(玄学)
-        if sample_illusts is None:
-            sample_illusts = 'auto'
-        elif isinstance(sample_illusts, str):
-            sample_illusts = ''.join(sample_illusts.split())
-        elif isinstance(sample_illusts, (list, tuple)):
-            sample_illusts = reduce(lambda x, y: x + ',' + y, sample_illusts)
-        params = {'type': 'illust', 'sample_illusts': sample_illusts, 'num_recommendations': num_recommendations,
-                  'tt': tt}
-        headers = self.base_headers[random.randint(0, len(self.base_headers) - 1)]
-        headers['Referer'] = 'http://www.pixiv.net/recommended.php'
-        headers['Host'] = 'www.pixiv.net'
+        params, headers = self.recommended_request(sample_illusts, num_recommendations)
         # 获取推荐json
         resp, s = self.get_response(recommender_url, params=params, headers=headers, cookies=self.cookies)
         if re.match(r'4\d\d', str(resp.status_code)):
@@ -1049,8 +1383,6 @@ class PixivSpiderLogin(object):
         remain_list = recommender_list[700:]
         illust_id_list = []
         while recommender_list:
-            illust_ids = str(recommender_list)[1:-1]
-            illust_ids = ''.join(re.split(r'\s', illust_ids))
             # 获取illust_list json
             # 似乎illust_ids有多少就返回多少(url 长度极限)  exclude_muted_illusts必须是数字
             # 信息
@@ -1063,51 +1395,10 @@ class PixivSpiderLogin(object):
             # illust_restrict : 0 (不知道什么用)
             # illust_type : 0 (不知道什么用)
             # user_name : ぴもぴ@お仕事募集中
-            params = {'illust_ids': illust_ids, 'exclude_muted_illusts': 1, 'tt': tt}
+            params = self.illust_list_params(recommender_list)
             resp, s = self.get_response(illust_list_url, params=params, headers=headers, cookies=self.cookies,
                                         session=s)
-            json = resp.json()
-            if not tags:
-                for item in json:
-                    print(item['illust_id'], item['illust_title'], str(item['tags']))
-                    illust_id_list.append(item['illust_id'])
-            else:
-                if match_mode == 0:
-                    if strict_fliter is False:
-                        for item in json:
-                            for i in tags:
-                                if i in item['tags']:
-                                    print(item['illust_id'], item['illust_title'], str(item['tags']))
-                                    illust_id_list.append(item['illust_id'])
-                    else:
-                        for item in json:
-                            content = True
-                            for i in tags:
-                                if i not in item['tags']:
-                                    content = False
-                                    break
-                            if content is True:
-                                print(item['illust_id'], item['illust_title'], str(item['tags']))
-                                illust_id_list.append(item['illust_id'])
-                elif match_mode == 1:
-                    if strict_fliter is False:
-                        for item in json:
-                            for i in tags:
-                                str_tags = str(item['tags'])
-                                if str_tags.find(i) != -1:
-                                    print(item['illust_id'], item['illust_title'], str(item['tags']))
-                                    illust_id_list.append(item['illust_id'])
-                    else:
-                        for item in json:
-                            content = True
-                            for i in tags:
-                                str_tags = str(item['tags'])
-                                if str_tags.find(i) == -1:
-                                    content = False
-                                    break
-                            if content is True:
-                                print(item['illust_id'], item['illust_title'], str(item['tags']))
-                                illust_id_list.append(item['illust_id'])
+            illust_id_list.extend(self.filter_recommended(resp.json(), tags, match_mode, strict_fliter))
             recommender_list = remain_list[:700]
             remain_list = remain_list[700:]
         if tags:
@@ -1120,9 +1411,78 @@ class PixivSpiderLogin(object):
             os.makedirs(path)
         self.async_run_pixiv_page(illust_id_list, path)
 
+    # 推荐请求的参数和headers
+    def recommended_request(self, sample_illusts=None, num_recommendations=500):
+        # num_recommendations 返回插画数(玄学)
+        if sample_illusts is None:
+            sample_illusts = 'auto'
+        elif isinstance(sample_illusts, str):
+            sample_illusts = ''.join(sample_illusts.split())
+        elif isinstance(sample_illusts, (list, tuple)):
+            sample_illusts = reduce(lambda x, y: x + ',' + y, sample_illusts)
+        params = {'type': 'illust', 'sample_illusts': sample_illusts, 'num_recommendations': num_recommendations,
+                  'tt': self.pixiv_context_token}
+        headers = dict(self.base_headers[random.randint(0, len(self.base_headers) - 1)])
+        headers['Referer'] = 'http://www.pixiv.net/recommended.php'
+        headers['Host'] = 'www.pixiv.net'
+        return params, headers
+
+    # illust_list.php 的参数 recommender_list为作品id列表
+    def illust_list_params(self, recommender_list):
+        illust_ids = str(recommender_list)[1:-1]
+        illust_ids = ''.join(re.split(r'\s', illust_ids))
+        return {'illust_ids': illust_ids, 'exclude_muted_illusts': 1, 'tt': self.pixiv_context_token}
+
+    # 按tags筛选illust_list json 返回通过的作品id列表 参数意义同run_pixiv_recommended
+    @staticmethod
+    def filter_recommended(json, tags=None, match_mode=0, strict_fliter=False):
+        illust_id_list = []
+        if not tags:
+            for item in json:
+                print(item['illust_id'], item['illust_title'], str(item['tags']))
+                illust_id_list.append(item['illust_id'])
+        else:
+            if match_mode == 0:
+                if strict_fliter is False:
+                    for item in json:
+                        for i in tags:
+                            if i in item['tags']:
+                                print(item['illust_id'], item['illust_title'], str(item['tags']))
+                                illust_id_list.append(item['illust_id'])
+                else:
+                    for item in json:
+                        content = True
+                        for i in tags:
+                            if i not in item['tags']:
+                                content = False
+                                break
+                        if content is True:
+                            print(item['illust_id'], item['illust_title'], str(item['tags']))
+                            illust_id_list.append(item['illust_id'])
+            elif match_mode == 1:
+                if strict_fliter is False:
+                    for item in json:
+                        for i in tags:
+                            str_tags = str(item['tags'])
+                            if str_tags.find(i) != -1:
+                                print(item['illust_id'], item['illust_title'], str(item['tags']))
+                                illust_id_list.append(item['illust_id'])
+                else:
+                    for item in json:
+                        content = True
+                        for i in tags:
+                            str_tags = str(item['tags'])
+                            if str_tags.find(i) == -1:
+                                content = False
+                                break
+                        if content is True:
+                            print(item['illust_id'], item['illust_title'], str(item['tags']))
+                            illust_id_list.append(item['illust_id'])
+        return illust_id_list
+
     @staticmethod
     def create_pixiv_ranking_database(db_path='Pixiv.db'):
-        database = sqlite3.connect(db_path)
+        database = pixivdb.connect(db_path)
         try:
             database.execute('''create table pixiv_ranking(
                               illust_id int PRIMARY KEY not null,
@@ -1154,17 +1514,22 @@ class PixivSpiderLogin(object):
                               illust_type int,
                               illust_book_style int,
                               user_name text,
-                              img PICTURE,
-                              latest boolean
+                              img_hash text,
+                              last_seen_run int
                               )''')
         except Exception as error:
             print(error)
         database.commit()
+        pixivdb.add_run_tracking(database, 'pixiv_ranking')
+        pixivdb.add_thumbnail_column(database, 'pixiv_ranking')
+        pixivdb.create_indexes(database, 'pixiv_ranking')
+        # 旧数据库的作品标签只在tags列中, 填充标签表后按标签查询才能找到
+        pixivdb.ensure_tags(database, 'pixiv_ranking')
         database.close()
 
     @staticmethod
     def create_pixiv_papi_database(db_path='Pixiv.db'):
-        conn = sqlite3.connect(db_path)
+        conn = pixivdb.connect(db_path)
         try:
             # date text,
             # attr text,
@@ -1197,19 +1562,25 @@ class PixivSpiderLogin(object):
                             illust_upload_timestamp timestamp(10),
                             illust_type text,
                             illust_book_style text,
-                            img PICTURE,
-                            latest boolean
+                            img_hash text,
+                            last_seen_run int
                             )''')
         except sqlite3.Error as error:
             print(error)
         conn.commit()
+        pixivdb.add_run_tracking(conn, 'pixiv_papi')
+        pixivdb.add_thumbnail_column(conn, 'pixiv_papi')
+        pixivdb.create_indexes(conn, 'pixiv_papi')
+        # 旧数据库的作品标签只在tags列中, 填充标签表后按标签查询才能找到
+        pixivdb.ensure_tags(conn, 'pixiv_papi')
         conn.close()
 
-    # save_img 是否将缩略图存入数据库 (单线程不推荐 慢死你)
+    # save_img 是否保存缩略图(存入thumbnail_store, 数据库中记录img_hash) (单线程不推荐 慢死你)
     # db_path .db文件的地址 例如:'Pixiv.db'
     # 注意date严格按照20170206格式
+    # 逐页请求json, 和多线程版本一样由ranking_database_consumer写入(BatchWriter 排名历史 标签 crawl_run)
     def run_pixiv_ranking_update_database(self, db_path, content='all', mode='daily', date='', save_img=False):
-        database = sqlite3.connect(db_path)
+        self.create_pixiv_ranking_database(db_path)
         base_url = 'http://www.pixiv.net/ranking.php'
         # 请求页面
         params = {'content': content, 'mode': mode, 'date': date}
@@ -1218,90 +1589,43 @@ class PixivSpiderLogin(object):
         params['p'] = 1
         params['format'] = 'json'
         params['tt'] = self.pixiv_context_token
-        # 获取信息
-        finish = False
+        # 获取信息 全部页面取完后在当前线程中写入数据库
+        queue_for_contents = queue.Queue()
+        total_progress = 0
         p = 1
-        while finish is False:
+        while True:
             params['p'] = p
             headers = self.base_headers[random.randint(0, len(self.base_headers) - 1)]
             # 获取json
             resp, s = self.get_response(base_url, params=params, headers=headers, cookies=self.cookies)
-            json = resp.json()
             if re.match(r'4\d\d', str(resp.status_code)):
-                finish = True
-                continue
-            contents = json['contents']
+                break
+            json = resp.json()
             print('\r' + json['content'], json['mode'], json['date'], 'p =', p, end='')
-            # 收集编辑信息 存入数据库
-            for item in contents:
-                illust_id = item['illust_id']
-                try:
-                    database.execute('INSERT INTO pixiv_ranking (illust_id) VALUES (%s)' % illust_id)
-                except sqlite3.Error:
-                    continue
-                view_count = item['view_count']
-                user_id = item['user_id']
-                attr = item['attr']
-                tags = item['tags']
-                if tags:
-                    tags = map(lambda x: '\"' + x + '\"', tags)
-                    tags = reduce(lambda x, y: x + ' ' + y, tags)
-                else:
-                    tags = ''
-                url = item['url']
-                illust_page_count = item['illust_page_count']
-                total_score = item['total_score']
-                title = item['title']
-                height = item['height']
-                width = item['width']
-                illust_upload_timestamp = item['illust_upload_timestamp']
-                timearray = time.localtime(illust_upload_timestamp)
-                illust_upload_timestamp = time.strftime("%Y-%m-%d %H:%M:%S", timearray)
-                homosexual = int(item['illust_content_type']['homosexual'])
-                bl = int(item['illust_content_type']['bl'])
-                lo = int(item['illust_content_type']['lo'])
-                antisocial = int(item['illust_content_type']['antisocial'])
-                grotesque = int(item['illust_content_type']['grotesque'])
-                drug = int(item['illust_content_type']['drug'])
-                religion = int(item['illust_content_type']['religion'])
-                violent = int(item['illust_content_type']['violent'])
-                yuri = int(item['illust_content_type']['yuri'])
-                furry = int(item['illust_content_type']['furry'])
-                sexual = item['illust_content_type']['sexual']
-                original = int(item['illust_content_type']['original'])
-                thoughts = int(item['illust_content_type']['thoughts'])
-                date = item['date']
-                illust_type = item['illust_type']
-                illust_book_style = item['illust_book_style']
-                user_name = item['user_name']
-                if save_img:
-                    r, s = self.get_response(url,
-                                             headers=self.base_headers[random.randint(0, len(self.base_headers) - 1)],
-                                             session=s)
-                    img = sqlite3.Binary(r.content)
-                else:
-                    img = ''
-                info_list = [view_count, user_id, attr, illust_page_count, tags, url, total_score, title, height, width,
-                             illust_upload_timestamp,
-                             homosexual, bl, lo, antisocial, grotesque, drug,
-                             religion, violent, yuri, furry, sexual, original, thoughts,
-                             date, illust_type, illust_book_style, user_name, img, illust_id]
-                command = '''UPDATE pixiv_ranking
-                             set view_count = ?, user_id = ?, attr = ?, illust_page_count = ?, tags = ?, url = ?, total_score = ?, title = ?, height = ?, width = ?,
-                             illust_upload_timestamp = ?,
-                             homosexual = ?, bl = ?, lo = ?, antisocial = ?, grotesque = ?, drug = ?,
-                             religion = ?, violent = ?, yuri = ?, furry = ?, sexual = ?, original = ?, thoughts = ?,
-                             date = ?, illust_type = ?, illust_book_style = ?, user_name = ?, img = ?
-                             WHERE illust_id = ?'''
-                try:
-                    database.execute(command, info_list)
-                except Exception as error:
-                    print(error)
-                    print(illust_id)
-            database.commit()
+            queue_for_contents.put(json)
+            total_progress += len(json['contents'])
             p += 1
-        database.close()
         print()
+        queue_for_contents.put(None)
+        self.ranking_database_consumer(db_path, queue_for_contents, total_progress)
+
+        # 下载缩略图
+        if save_img:
+            connect = pixivdb.connect(db_path)
+            rows = self.ranking_thumbnail_rows(connect)
+            if rows is None:
+                return
+            cursor, row_count = rows
+            store = self.get_thumbnail_store(db_path)
+            for _id, url in cursor.fetchall():
+                try:
+                    queue_for_contents.put((store.put(self.get_thumbnail(url)), _id))
+                except (requests.exceptions.RequestException, TryError) as error:
+                    print(_id, error)
+            queue_for_contents.put(None)
+            self.ranking_thumbnail_consumer(connect, db_path, queue_for_contents, row_count)
+            connect.commit()
+            connect.close()
 
     # content: all illust ugoira manga 或者是这些参数的列表, 元组, 迭代器
     # mode:'daily' 今日(缺省); 'weekly' 本周; 'monthly' 本月; 'rookie' 新人;
@@ -1312,57 +1636,11 @@ class PixivSpiderLogin(object):
     #      'kanto' 关东; 'chubu' 中部; 'kinki' 近畿;
     #      'chugoku_shikoku' 中国/四国; 'kyusyu_okinawa' 九州/冲绳 或者是这些参数的列表, 元组, 迭代器
     # date: %Y%m%d 例如 20170206 的格式 或者是列表, 元组, 迭代器
-    # save_img 是否将缩略图存入数据库
+    # save_img 是否保存缩略图(存入thumbnail_store, 数据库中记录img_hash)
     # db_path .db文件的地址 例如:'Pixiv.db'
     def run_pixiv_ranking_update_database_threading(self, db_path, **kwargs):
         self.create_pixiv_ranking_database(db_path)
-        # 处理统一传入参数 提高鲁棒性
-        if 'content' in kwargs:
-            content = kwargs['content']
-        else:
-            content = 'all'
-        if 'mode' in kwargs:
-            mode = kwargs['mode']
-        else:
-            mode = 'daily'
-        if 'date' in kwargs:
-            date = kwargs['date']
-        else:
-            date = ''
-        if 'save_img' in kwargs:
-            save_img = kwargs['save_img']
-        else:
-            save_img = False
-
-        if isinstance(content, str):
-            content = (content,)
-
-        if isinstance(mode, str):
-            mode = (mode,)
-
-        if isinstance(date, str):
-            date = (date,)
-
-        content = set(content)
-        if '' in content:
-            content.remove('')
-            content.add('all')
-
-        mode = set(mode)
-        if '' in mode:
-            mode.remove('')
-            mode.add('daily')
-
-        # 有待商榷
-        date = set(date)
-
-        # 根据content_dict剔除不正确的组合 提高鲁棒性
-        content_mode = []
-        for item_content in content:
-            if item_content in self.content_dict:
-                for item_mode in mode:
-                    if item_mode in self.content_dict[item_content]:
-                        content_mode.append((item_content, item_mode))
+        content_mode, date, save_img = self.ranking_update_combinations(**kwargs)
 
         # GET请求基本信息
         base_url = 'http://www.pixiv.net/ranking.php'
@@ -1391,7 +1669,7 @@ class PixivSpiderLogin(object):
             _headers = header[random.randint(0, len(header) - 1)]
             r, _s = self.get_response(base_url, params=_params, headers=_headers, cookies=self.cookies)
             if re.match(r'4\d\d', str(r.status_code)):
-                error_str = '{} {} {} {}'.format(_params['content'], _params['mode'], _params['date'],
+                error_str = '{} {} {} {}'.format(_params['content'], _params['mode'], _params.get('date', ''),
                                                  r.json()['error'])
                 queue_for_error.put(error_str)
                 queue_for_combine.put(1)
@@ -1424,7 +1702,7 @@ class PixivSpiderLogin(object):
                 # total_p += p
                 total += rank_total
                 content_mode_date_p.append((json['content'], json['mode'], json['date'], p))
-                queue_for_contents.put(json['contents'])
+                queue_for_contents.put(json)
                 count += 1
             bar.close()
             value_queue.put(total)
@@ -1442,107 +1720,9 @@ class PixivSpiderLogin(object):
             _headers = header[random.randint(0, len(header) - 1)]
             r, _s = self.get_response(base_url, params=_params, headers=_headers, cookies=self.cookies)
             if re.match(r'4\d\d', str(r.status_code)):
-                queue_for_contents.put([])
+                queue_for_contents.put({'contents': []})
                 return
-            _json = r.json()
-            queue_for_contents.put(_json['contents'])
-
-        def update_database_consumer():
-            bar = ProgressBar(db_path.split('/')[-1], total_progress, ProgressBar.none_transfrom(),
-                              run_status='正在更新', fin_status='更新完成')
-            conn = sqlite3.connect(db_path)
-            try:
-                conn.execute('update pixiv_ranking set latest = 0')
-            except sqlite3.Error as e:
-                m = re.search(r'no such column', str(e))
-                if m:
-                    conn.execute('alter table pixiv_ranking add latest boolean')
-                else:
-                    print(e)
-                    queue_for_contents.put(None)
-                    conn.close()
-                    return
-            conn.commit()
-            count = 0
-            _t1 = time.time()
-            while True:
-                contents = queue_for_contents.get()
-                if contents is None:
-                    bar.refresh(count, now_time=time.time())
-                    break
-                for item in contents:
-                    _t2 = time.time()
-                    # 1.5s 刷新
-                    if (_t2 - _t1) > 1.5:
-                        bar.refresh(count, now_time=_t2)
-                        count = 0
-                        _t1 = _t2
-
-                    illust_id = item['illust_id']
-                    try:
-                        conn.execute('INSERT INTO pixiv_ranking (illust_id) VALUES (?)', (illust_id,))
-                    except sqlite3.Error:
-                        conn.execute('update pixiv_ranking set latest = 1 where illust_id = ?', (illust_id,))
-                        count += 1
-                        continue
-                    view_count = item['view_count']
-                    user_id = item['user_id']
-                    attr = item['attr']
-                    tags = item['tags']
-                    if tags:
-                        tags = map(lambda x: '\"' + x + '\"', tags)
-                        tags = reduce(lambda x, y: x + ' ' + y, tags)
-                    else:
-                        tags = ''
-                    url = item['url']
-                    illust_page_count = item['illust_page_count']
-                    total_score = item['total_score']
-                    title = item['title']
-                    height = item['height']
-                    width = item['width']
-                    illust_upload_timestamp = item['illust_upload_timestamp']
-                    timearray = time.localtime(illust_upload_timestamp)
-                    illust_upload_timestamp = time.strftime("%Y-%m-%d %H:%M:%S", timearray)
-                    homosexual = int(item['illust_content_type']['homosexual'])
-                    bl = int(item['illust_content_type']['bl'])
-                    lo = int(item['illust_content_type']['lo'])
-                    antisocial = int(item['illust_content_type']['antisocial'])
-                    grotesque = int(item['illust_content_type']['grotesque'])
-                    drug = int(item['illust_content_type']['drug'])
-                    religion = int(item['illust_content_type']['religion'])
-                    violent = int(item['illust_content_type']['violent'])
-                    yuri = int(item['illust_content_type']['yuri'])
-                    furry = int(item['illust_content_type']['furry'])
-                    sexual = item['illust_content_type']['sexual']
-                    original = int(item['illust_content_type']['original'])
-                    thoughts = int(item['illust_content_type']['thoughts'])
-                    _date = item['date']
-                    illust_type = item['illust_type']
-                    illust_book_style = item['illust_book_style']
-                    user_name = item['user_name']
-                    info_list = [view_count, user_id, attr, illust_page_count, tags, url, total_score, title, height,
-                                 width,
-                                 illust_upload_timestamp,
-                                 homosexual, bl, lo, antisocial, grotesque, drug,
-                                 religion, violent, yuri, furry, sexual, original, thoughts,
-                                 _date, illust_type, illust_book_style, user_name, illust_id]
-                    command = '''UPDATE pixiv_ranking
-                                 set view_count = ?, user_id = ?, attr = ?, illust_page_count = ?, tags = ?, url = ?,
-                                 total_score = ?, title = ?, height = ?, width = ?, illust_upload_timestamp = ?,
-                                 homosexual = ?, bl = ?, lo = ?, antisocial = ?, grotesque = ?, drug = ?,
-                                 religion = ?, violent = ?, yuri = ?, furry = ?, sexual = ?, original = ?, thoughts = ?,
-                                 date = ?, illust_type = ?, illust_book_style = ?, user_name = ?, latest = 1
-                                 WHERE illust_id = ?'''
-                    try:
-                        conn.execute(command, info_list)
-                        count += 1
-                    except sqlite3.Error as _error:
-                        print(_error)
-                        bar.close(unexcept_status='数据库出错')
-                        exit()
-            bar.close()
-            conn.commit()
-            conn.close()
+            queue_for_contents.put(r.json())
 
         # 获取rank_total计算总json数量 都是为了进度条
         consumer_thread = threading.Thread(target=get_combine_info_consumer, args=())
@@ -1555,7 +1735,8 @@ class PixivSpiderLogin(object):
             print(queue_for_error.get())
 
         # 更新数据库
-        consumer_thread = threading.Thread(target=update_database_consumer, args=())
+        consumer_thread = threading.Thread(target=self.ranking_database_consumer,
+                                           args=(db_path, queue_for_contents, total_progress))
         consumer_thread.start()
         run_threading_limited(get_json_contents, get_json_contents_args(), self.num_threading)
         queue_for_contents.put(None)
@@ -1563,57 +1744,19 @@ class PixivSpiderLogin(object):
 
         # 下载缩略图
         if save_img:
-            connect = sqlite3.connect(db_path, check_same_thread=False)
-            try:
-                cursor = connect.execute('select illust_id, url from pixiv_ranking where latest == 1 and img is null')
-            except sqlite3.Error as error:
-                print(error)
+            connect = pixivdb.connect(db_path, check_same_thread=False)
+            rows = self.ranking_thumbnail_rows(connect)
+            if rows is None:
                 return
+            cursor, row_count = rows
 
-            sql_count = connect.execute('select count(*) from pixiv_papi where latest == 1 and img is null')
-            row_count = sql_count.fetchall()[0][0]
+            store = self.get_thumbnail_store(db_path)
 
             def get_img(_id, url):
-                r, s = self.get_response(url, headers=self.base_headers[random.randint(0, len(self.base_headers) - 1)],
-                                         stream=True,
-                                         timeout=50)
-                while True:
-                    try:
-                        img = r.content
-                        break
-                    except requests.exceptions.RequestException:
-                        r.close()
-                        r, s = self.get_response(url, headers=self.base_headers[
-                            random.randint(0, len(self.base_headers) - 1)],
-                                                 stream=True, timeout=50, session=s)
-                queue_for_contents.put((img, _id))
+                queue_for_contents.put((store.put(self.get_thumbnail(url)), _id))
 
-            def insert_img():
-                count = 0
-                bar = ProgressBar(db_path.split('/')[-1], row_count, ProgressBar.none_transfrom(unit='张'),
-                                  run_status='正在下图',
-                                  fin_status='更新完成')
-                _t1 = time.time()
-                while True:
-                    info_tuple = queue_for_contents.get()
-                    if info_tuple is None:
-                        bar.refresh(count, now_time=time.time())
-                        bar.close()
-                        break
-                    try:
-                        connect.execute('update pixiv_ranking set img = ? where illust_id = ?', info_tuple)
-                        count += 1
-                        _t2 = time.time()
-                        # 1.5s 刷新
-                        if (_t2 - _t1) > 1.5:
-                            bar.refresh(count, now_time=_t2)
-                            count = 0
-                            _t1 = _t2
-                    except sqlite3.Error:
-                        bar.close(unexcept_status='数据库错误')
-                        return
-
-            consumer_thread = threading.Thread(target=insert_img, args=())
+            consumer_thread = threading.Thread(target=self.ranking_thumbnail_consumer,
+                                               args=(connect, db_path, queue_for_contents, row_count))
             consumer_thread.start()
             run_threading_limited(get_img, cursor, self.num_threading)
             queue_for_contents.put(None)
@@ -1621,12 +1764,155 @@ class PixivSpiderLogin(object):
             connect.commit()
             connect.close()
 
+    # 统一处理run_pixiv_ranking_update_database_threading的参数 提高鲁棒性
+    # 返回(content_mode, date, save_img) content_mode为content_dict中合法的(content, mode)组合
+    def ranking_update_combinations(self, **kwargs):
+        content = kwargs.get('content', 'all')
+        mode = kwargs.get('mode', 'daily')
+        date = kwargs.get('date', '')
+        save_img = kwargs.get('save_img', False)
+
+        if isinstance(content, str):
+            content = (content,)
+
+        if isinstance(mode, str):
+            mode = (mode,)
+
+        if isinstance(date, str):
+            date = (date,)
+
+        content = set(content)
+        if '' in content:
+            content.remove('')
+            content.add('all')
+
+        mode = set(mode)
+        if '' in mode:
+            mode.remove('')
+            mode.add('daily')
+
+        # 有待商榷
+        date = set(date)
+
+        # 根据content_dict剔除不正确的组合 提高鲁棒性
+        content_mode = []
+        for item_content in content:
+            if item_content in self.content_dict:
+                for item_mode in mode:
+                    if item_mode in self.content_dict[item_content]:
+                        content_mode.append((item_content, item_mode))
+        return content_mode, date, save_img
+
+    # 数据库消费线程: 从queue_for_contents取出排行榜json写入pixiv_ranking, 取到None结束
+    # 每db_batch_size行用一次UPSERT批量写入: 新作品写入全部信息, 已存在的作品只更新last_seen_run
+    # 同时把每个作品当天的排名 分数 浏览数追加到pixiv_ranking_history, 标签写入tag/illust_tag
+    def ranking_database_consumer(self, db_path, queue_for_contents, total_progress):
+        bar = ProgressBar(db_path.split('/')[-1], total_progress, ProgressBar.none_transfrom(),
+                          run_status='正在更新', fin_status='更新完成')
+        conn = pixivdb.connect(db_path)
+        run_id = pixivdb.start_run(conn, 'pixiv_ranking')
+        writer = BatchWriter(conn, 'pixiv_ranking', RANKING_COLUMNS, update_columns=('last_seen_run',),
+                             batch_size=self.db_batch_size)
+        history = RankingHistory(conn, batch_size=self.db_batch_size)
+        tag_writer = TagWriter(conn, batch_size=self.db_batch_size)
+        count = 0
+        _t1 = time.time()
+        try:
+            while True:
+                json = queue_for_contents.get()
+                if json is None:
+                    break
+                for item in json['contents']:
+                    writer.add(ranking_row(item, run_id))
+                    tag_writer.set_tags(item['illust_id'], item['tags'])
+                    count += 1
+                history.add_page(json)
+                _t2 = time.time()
+                # 1.5s 刷新
+                if (_t2 - _t1) > 1.5:
+                    bar.refresh(count, now_time=_t2)
+                    count = 0
+                    _t1 = _t2
+            writer.flush()
+            history.flush()
+            tag_writer.flush()
+        except sqlite3.Error as _error:
+            print(_error)
+            bar.close(unexcept_status='数据库出错')
+            conn.close()
+            return
+        pixivdb.finish_run(conn, run_id)
+        bar.refresh(count, now_time=time.time())
+        bar.close()
+        writer.print_report()
+        conn.close()
+
+    # 本次更新中需要下载缩略图的(illust_id, url)游标和数量 出错返回None
+    @staticmethod
+    def ranking_thumbnail_rows(connect):
+        try:
+            run_id = pixivdb.current_run(connect, 'pixiv_ranking')
+            cursor = connect.execute('select illust_id, url from pixiv_ranking where last_seen_run = ? and img_hash is null',
+                                     (run_id,))
+        except sqlite3.Error as error:
+            print(error)
+            return None
+        sql_count = connect.execute('select count(*) from pixiv_ranking where last_seen_run = ? and img_hash is null',
+                                    (run_id,))
+        return cursor, sql_count.fetchall()[0][0]
+
+    # 数据库db_path对应的缩略图存储 没有指定thumbnail_store时为 <数据库名>_thumbnails/ 目录
+    def get_thumbnail_store(self, db_path):
+        if self.thumbnail_store is not None:
+            return self.thumbnail_store
+        return thumbstore.FileThumbnailStore(thumbstore.default_root(db_path))
+
+    # 下载一张缩略图 返回bytes; 读取内容时中断按retry_policy重试, 状态码不是200时抛出TryError
+    def get_thumbnail(self, url, session=None):
+        def fetch():
+            r, _ = self.get_response(url, headers=self.base_headers[random.randint(0, len(self.base_headers) - 1)],
+                                     stream=True, timeout=50, session=session)
+            try:
+                if r.status_code != 200:
+                    raise TryError(r.status_code)
+                return r.content
+            finally:
+                r.close()
+
+        return self.retry_policy.run(fetch)
+
+    # 缩略图消费线程: 从queue_for_img取出(img_hash, illust_id)写入pixiv_ranking, 取到None结束
+    def ranking_thumbnail_consumer(self, connect, db_path, queue_for_img, row_count):
+        count = 0
+        bar = ProgressBar(db_path.split('/')[-1], row_count, ProgressBar.none_transfrom(unit='张'),
+                          run_status='正在下图',
+                          fin_status='更新完成')
+        _t1 = time.time()
+        while True:
+            info_tuple = queue_for_img.get()
+            if info_tuple is None:
+                bar.refresh(count, now_time=time.time())
+                bar.close()
+                break
+            try:
+                connect.execute('update pixiv_ranking set img_hash = ? where illust_id = ?', info_tuple)
+                count += 1
+                _t2 = time.time()
+                # 1.5s 刷新
+                if (_t2 - _t1) > 1.5:
+                    bar.refresh(count, now_time=_t2)
+                    count = 0
+                    _t1 = _t2
+            except sqlite3.Error:
+                bar.close(unexcept_status='数据库错误')
+                return
+
     # illust_id :  61210737 (插画id)
     # view_count :  28177
     # user_id :  1024922
     # attr : (illust_content_type 中True的键)
     # illust_page_count :  1 (插画页数)
-    # tags :  "オリジナル" "女の子" "COMITIA119" "ブレザー" "金髪ロング" "白ソックス" "制服" "美少女" "しゃがみ" "オリジナル5000users入り" (要完全匹配某一个标签加上双引号)
+    # tags :  "オリジナル" "女の子" "COMITIA119" "ブレザー" "金髪ロング" "白ソックス" "制服" "美少女" "しゃがみ" "オリジナル5000users入り" (按标签查询用tag_and tag_or tag_not)
     # url :  http://i2.pixiv.net/c/240x480/img-master/img/2017/01/31/21/41/10/61210737_p0_master1200.jpg (缩略图地址)
     # total_score :  32682
     # title :  はなあらし
@@ -1650,15 +1936,24 @@ class PixivSpiderLogin(object):
     # illust_type :  0  (0 插画, 1 漫画, 2 动画)
     # illust_book_style :  0 (1 高赞作品? 2 超高赞作品?)(还是很玄)
     # user_name :  フライ○ティアゆ08a
+    # last_seen_run : 最后一次出现在更新中的编号(crawl_run表)
     #
     # db_path 数据库地址
-    # table 数据库中的表名
+    # table 数据库中的表名 (pixiv_ranking_latest, pixiv_papi_latest 只包含最近一次更新中出现的作品)
     # command= sqlite 的 条件语句 教程:http://www.runoob.com/sqlite/sqlite-tutorial.html (东西太多了没有好的办法整合, 一个一个弄参数太多了)
-    def run_pixiv_database(self, db_path, table, command, folder='排行数据库'):
-        database = sqlite3.connect(db_path)
-        command = 'select illust_id from %s where %s' % (table, command)
+    # tag_and tag_or tag_not 按标签筛选(完全匹配, 走tag/illust_tag索引), 意义同pixivdb.search_tags, 可以和command一起使用
+    # 按标签查询不要再写 tags like '%"tag"%' (需要扫描整个表)
+    def run_pixiv_database(self, db_path, table, command=None, folder='排行数据库', tag_and=None, tag_or=None,
+                           tag_not=None):
+        database = pixivdb.connect(db_path)
         try:
-            cursor = database.execute(command)
+            if tag_and or tag_or or tag_not:
+                if command:
+                    table = '(select illust_id from %s where %s)' % (table, command)
+                illust_id_list = pixivdb.search_tags(database, tag_and, tag_or, tag_not, table=table)
+            else:
+                command = 'select illust_id from %s where %s' % (table, command or '1')
+                illust_id_list = [row[0] for row in database.execute(command)]
         except Exception as error:
             print(error)
             return
@@ -1668,58 +1963,147 @@ class PixivSpiderLogin(object):
             print('dir exists')
         else:
             os.makedirs(path)
-        illust_id_list = [row[0] for row in cursor]
         print("搜索插画数量:", len(illust_id_list))
         self.async_run_pixiv_page(illust_id_list, path)
         database.close()
 
-    # 多进程下载插画
+    # 打开seen_path的已下载作品id集合 没有设置seen_path时返回None
+    def open_seen_set(self):
+        if self.seen_path is None:
+            return None
+        return SeenSet(self.seen_path)
+
+    # 从illust_id_list中去掉seen中已经下载过的作品 seen为None时不变
+    # seen只记录作品id: 使用blob_store时 下载过但path中还没有的作品保留, run_pixiv_page会从存储链接过来(不访问网络)
+    def filter_seen(self, illust_id_list, seen, path=None):
+        if seen is None:
+            return illust_id_list
+        remain = seen.filter(illust_id_list)
+        if path is not None and self.blob_store is not None and self.manifest is not None:
+            unseen = set(remain)
+            remain = [illust_id for illust_id in illust_id_list
+                      if illust_id in unseen or not self.manifest.is_complete(illust_id, path)]
+        print('跳过已下载的作品:', len(illust_id_list) - len(remain))
+        return remain
+
+    # 多进程下载插画 (所有入口最终都调用这里, 设置了seen_path时先跳过已下载的作品, 下载完成的作品加入集合)
+    # 使用任务队列时作品先加入队列 (见run_pixiv_pool)
     def async_run_pixiv_page(self, illust_id_list, path):
-        p = multiprocessing.Pool(self.num_processes)
-        for illust_id in illust_id_list:
-            p.apply_async(self.run_pixiv_page, args=(illust_id, path,))
+        seen = self.open_seen_set()
+        illust_id_list = self.filter_seen(illust_id_list, seen, path)
+        # 进程池按上限建立, 同时处理的作品数由并发窗口控制 作品出错(异常)时减小
+        # 作品的处理时间差别很大(单图 多图 动图), 延迟的容忍度设得宽一些
+        window = AimdController(initial=self.num_processes or multiprocessing.cpu_count(),
+                                maximum=self.max_processes, latency_factor=4.0)
+        # 下载期间后台线程定期续约 退出transcoding()时转码全部完成, 之后才关闭seen
+        self._seen_set = seen
+        try:
+            with self.renewing_jobs(), self.transcoding():
+                self.run_pixiv_pool(illust_id_list, path, window, seen)
+        finally:
+            self._seen_set = None
+            if seen is not None:
+                seen.close()
+        print(window.metrics())
+        print("download finished")
+
+    # 进程池下载 回调中更新并发窗口 seen 和任务队列
+    # 每个进程在初始化时得到一份spider(init_pixiv_worker), 任务只传(作品id, 保存目录)
+    # 使用任务队列时先把作品加入队列, 再从队列中取出任务下载 (上次中断时没有完成的任务也会取出)
+    # 失败的任务重新放回队列, 超过最多尝试次数后记为失败
+    def run_pixiv_pool(self, illust_id_list, path, window, seen):
+        jobs = self.job_queue
+        p = multiprocessing.Pool(self.max_processes, initializer=init_pixiv_worker, initargs=(self,))
+
+        def submit(illust_id, start):
+            # 回调在主进程中执行 先更新任务队列再释放窗口, 主循环看到窗口为空时重试的任务已经放回队列
+            # 交给转码进程的动图(QUEUED) 由转码的回调更新任务队列和seen
+            def callback(done, _id=illust_id, _start=start):
+                if done == transcode.QUEUED:
+                    window.release(_start)
+                    return
+                if jobs is not None:
+                    jobs.finish(_id, path, done)
+                window.release(_start)
+                if done and seen is not None:
+                    seen.add(_id)
+
+            def error_callback(error, _id=illust_id, _start=start):
+                if jobs is not None:
+                    jobs.fail(_id, path, repr(error))
+                window.release(_start, False)
+                print(_id, error)
+
+            p.apply_async(run_pixiv_worker, args=(illust_id, path,), callback=callback,
+                          error_callback=error_callback)
+
+        if jobs is None:
+            for illust_id in illust_id_list:
+                submit(illust_id, window.acquire())
+        else:
+            print('新加入的任务:', jobs.enqueue(illust_id_list, path))
+            while True:
+                start = window.acquire()
+                claimed = jobs.claim(path)
+                if claimed:
+                    submit(claimed[0], start)
+                else:
+                    window.release(start, ignore=True)
+                    if window.in_flight == 0 and self.transcode_pending() == 0:
+                        break
+                    # 等待进行中的作品和转码 失败的会放回队列
+                    time.sleep(1)
+            print('任务:', jobs.counts(path))
         p.close()
         p.join()
-        print("download finished")
 
-    @staticmethod
-    def get_response(url, try_time=50, **kwargs):
-        if 'session' in kwargs:
+    # 不传入session时使用连接池中当前线程的session
+    # try_time 最多尝试的次数 缺省按retry_policy; 5xx 429 重试后仍然失败时返回最后的响应
+    # tracked 为True时调用者自己占用并发窗口并按字节数限速(download_pic_range), 这里不再占用窗口和请求令牌
+    def get_response(self, url, try_time=None, tracked=False, **kwargs):
+        if kwargs.get('session') is not None:
             s = kwargs.pop('session')
         else:
-            s = requests.Session()
-        r = None
-        while try_time > 0:
-            try:
-                r = s.get(url, **kwargs)
-                break
-            except requests.exceptions.RequestException:
-                try_time -= 1
-        if try_time <= 0:
-            try:
-                s.get(url, **kwargs)
-            except requests.exceptions.RequestException as error:
-                raise TryError(error, "过多的尝试")
+            kwargs.pop('session', None)
+            s = self.http_client.session()
+        r = self.request_policy(try_time).run(partial(self.response_getter(s, tracked), url, **kwargs))
         return r, s
 
-    @staticmethod
-    def post_response(url, try_time=50, **kwargs):
-        if 'session' in kwargs:
+    # session的一次GET(不重试): 响应缓存 -> 限速 -> 并发窗口 -> 请求 (命中缓存时不消耗令牌; 限速等待的时间不计入延迟)
+    def response_getter(self, s, tracked=False):
+        get = s.get if tracked else partial(self.tracked_get, s.get)
+        if self.request_limiter is not None and not tracked:
+            get = partial(self.limited_get, get)
+        if self.response_cache is not None:
+            get = partial(self.response_cache.get, get)
+        return get
+
+    def request_policy(self, try_time=None):
+        return self.retry_policy if try_time is None else self.retry_policy.derive(max_attempts=try_time)
+
+    # 占用并发窗口中的一个位置进行请求
+    def tracked_get(self, get, url, **kwargs):
+        with self.concurrency.track() as call:
+            r = get(url, **kwargs)
+            call.status(r.status_code)
+        return r
+
+    # 按request_rate等待后请求 等待的秒数记在r.rate_wait (缩略图也算一个请求)
+    # 下载图片按字节数在download_pic_range中限速
+    def limited_get(self, get, url, **kwargs):
+        wait = self.request_limiter.acquire()
+        r = get(url, **kwargs)
+        r.rate_wait = wait
+        return r
+
+    # 不传入session时使用连接池中当前线程的session
+    def post_response(self, url, try_time=None, **kwargs):
+        if kwargs.get('session') is not None:
             s = kwargs.pop('session')
         else:
-            s = requests.Session()
-        r = None
-        while try_time > 0:
-            try:
-                r = s.post(url, **kwargs)
-                break
-            except requests.exceptions.RequestException:
-                try_time -= 1
-        if try_time <= 0:
-            try:
-                s.post(url, **kwargs)
-            except requests.exceptions.RequestException as error:
-                raise TryError(error, "过多的尝试")
+            kwargs.pop('session', None)
+            s = self.http_client.session()
+        r = self.request_policy(try_time).run(partial(s.post, url, **kwargs))
         return r, s
 
     # 参数:
@@ -1868,10 +2252,7 @@ class PixivSpiderLogin(object):
             save_img = False
 
         # 获取搜索结果数
-        html = self.get_html_tree(base_url, params=params)
-        count_badge = html.find('span', {'class': 'count-badge'}).get_text()
-        m = re.search(r'\d+', count_badge)
-        count_badge = int(m.group())
+        count_badge = extract.search_result(self.get_html_root(base_url, params=params)).count
         max_p = count_badge // 20 + (1 if (count_badge % 20) else 0)
         if max_p > 1000:
             # FIXME 可以用日期分割搜索结果
@@ -1897,17 +2278,9 @@ class PixivSpiderLogin(object):
         def update_database():
             bar = ProgressBar(db_path.split('/')[-1], count_badge, ProgressBar.none_transfrom(), run_status='正在更新',
                               fin_status='更新完成')
-            conn = sqlite3.connect(db_path)
-            try:
-                conn.execute('update pixiv_papi set latest = 0')
-            except sqlite3.Error as e:
-                if re.search(r'no such column', str(e)):
-                    conn.execute('alter table pixiv_papi add latest boolean')
-                else:
-                    print(e)
-                    conn.close()
-                    return
-            conn.commit()
+            conn = pixivdb.connect(db_path)
+            run_id = pixivdb.start_run(conn, 'pixiv_papi')
+            tag_writer = TagWriter(conn, batch_size=self.db_batch_size)
             count = 0
             _t1 = time.time()
             while True:
@@ -1932,20 +2305,16 @@ class PixivSpiderLogin(object):
                 illust_id = int(response['id'])
 
                 try:
-                    conn.execute('INSERT INTO pixiv_papi (illust_id) VALUES (?)', (illust_id,))
+                    conn.execute('INSERT INTO pixiv_papi (illust_id, last_seen_run) VALUES (?, ?)', (illust_id, run_id))
                 except sqlite3.Error:
                     # 失败
-                    conn.execute('update pixiv_papi set latest = 1 where illust_id = ?', (illust_id,))
+                    conn.execute('update pixiv_papi set last_seen_run = ? where illust_id = ?', (run_id, illust_id))
                     count += 1
                     continue
 
                 title = response['title']
-                tags = response['tags']
-                if tags:
-                    tags = map(lambda x: '\"' + x + '\"', tags)
-                    tags = reduce(lambda x, y: x + ' ' + y, tags)
-                else:
-                    tags = ''
+                tag_writer.set_tags(illust_id, response['tags'])
+                tags = pixivdb.join_tags(response['tags'])
                 tools = response['tools']
                 if tools:
                     tools = map(lambda x: '\"' + x + '\"', tools)
@@ -1975,7 +2344,7 @@ class PixivSpiderLogin(object):
                              set title = ?, tags = ?, tools = ?, url = ?, width = ?, height = ?, scored_count = ?,
                              total_score = ?, view_count = ?, favorited_count = ?, commented_count = ?, age_limit = ?,
                              illust_upload_timestamp = ?, user_id = ?, user_name = ?, illust_page_count = ?,
-                             illust_book_style = ?, illust_type = ?, latest = 1
+                             illust_book_style = ?, illust_type = ?
                              WHERE illust_id = ?'''
                 try:
                     conn.execute(command, info_list)
@@ -1985,6 +2354,8 @@ class PixivSpiderLogin(object):
                     bar.close(unexcept_status='更新出错')
                     exit()
             conn.commit()
+            tag_writer.flush()
+            pixivdb.finish_run(conn, run_id)
             conn.close()
 
         db_consumer_thread = threading.Thread(target=update_database, args=())
@@ -1998,30 +2369,22 @@ class PixivSpiderLogin(object):
         if save_img:
             queue_for_thread = queue.Queue()
 
-            connect = sqlite3.connect(db_path, check_same_thread=False)
+            connect = pixivdb.connect(db_path, check_same_thread=False)
             try:
-                cursor = connect.execute('select illust_id, url from pixiv_papi where latest == 1 and img is null')
+                run_id = pixivdb.current_run(connect, 'pixiv_papi')
+                cursor = connect.execute('select illust_id, url from pixiv_papi where last_seen_run = ? and img_hash is null',
+                                         (run_id,))
             except sqlite3.Error as error:
                 print(error)
                 return
 
-            sql_count = connect.execute('select count(*) from pixiv_papi where latest == 1 and img is null')
+            sql_count = connect.execute('select count(*) from pixiv_papi where last_seen_run = ? and img_hash is null',
+                                        (run_id,))
             row_count = sql_count.fetchall()[0][0]
+            store = self.get_thumbnail_store(db_path)
 
             def get_img(_id, url):
-                r, s = self.get_response(url, headers=self.base_headers[random.randint(0, len(self.base_headers) - 1)],
-                                         stream=True,
-                                         timeout=50)
-                while True:
-                    try:
-                        img = r.content
-                        break
-                    except requests.exceptions.RequestException:
-                        r.close()
-                        r, s = self.get_response(url, headers=self.base_headers[
-                            random.randint(0, len(self.base_headers) - 1)],
-                                                 stream=True, timeout=50, session=s)
-                queue_for_thread.put((img, _id))
+                queue_for_thread.put((store.put(self.get_thumbnail(url)), _id))
 
             def insert_img():
                 count = 0
@@ -2042,7 +2405,7 @@ class PixivSpiderLogin(object):
                         bar.close()
                         break
                     try:
-                        connect.execute('update pixiv_papi set img = ? where illust_id = ?', info_tuple)
+                        connect.execute('update pixiv_papi set img_hash = ? where illust_id = ?', info_tuple)
                         count += 1
                     except sqlite3.Error as _error:
                         print(_error)
@@ -2071,9 +2434,8 @@ class PixivSpiderLogin(object):
                 _queue.put(1)
 
         _url = 'http://www.pixiv.net/search.php?'
-        html_root = self.get_html_tree(_url, params=_params)
-        search_result = html_root.find('section', {'class': 'column-search-result'})
-        args_map = map(lambda item: (int(item.img['data-id']),), search_result.find_all('li', {'class': 'image-item'}))
+        search_result = extract.search_result(self.get_html_root(_url, params=_params))
+        args_map = map(lambda illust_id: (int(illust_id),), search_result.illust_ids)
         run_threading_limited(get_illust_json_use_papi, args_map, self.num_threading)
 
 
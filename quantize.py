@@ -0,0 +1,122 @@
+# encoding=utf-8
+import numpy as np
+from PIL import Image
+
+import ugoira
+
+# 颜色查找表每个通道的位数 (2 ** (3 * LUT_BITS) 个格子, 每格预先算好最近的调色板颜色)
+LUT_BITS = 5
+
+
+# 从所有帧中随机采样像素 返回(n, 3)的uint8数组
+# samples 总的采样数, 平均分到每一帧; 采样时jpeg按1/reduce的大小解码
+def sample_pixels(zip_path, frames, samples=1 << 16, reduce=4, seed=0):
+    rng = np.random.default_rng(seed)
+    per_frame = max(1024, samples // max(len(frames), 1))
+    chunks = []
+    for image, _ in ugoira.iter_frames(zip_path, frames, reduce):
+        pixels = np.asarray(image.convert('RGB')).reshape(-1, 3)
+        if len(pixels) > per_frame:
+            pixels = pixels[rng.integers(0, len(pixels), per_frame)]
+        chunks.append(pixels)
+    return np.concatenate(chunks)
+
+
+# points 中每个颜色在palette中最近(欧氏距离)的下标 分块计算, 内存不随points增长
+def nearest(points, palette, chunk=8192):
+    palette = palette.astype(np.int32)
+    norms = (palette ** 2).sum(axis=1)
+    result = np.empty(len(points), dtype=np.uint8)
+    for begin in range(0, len(points), chunk):
+        block = points[begin:begin + chunk].astype(np.int32)
+        # |p - c|^2 = |p|^2 - 2 p·c + |c|^2, |p|^2 对每一行相同 不影响argmin
+        result[begin:begin + chunk] = (norms - 2 * block @ palette.T).argmin(axis=1)
+    return result
+
+
+# 由采样的像素建立调色板 (n, 3) uint8
+# 先在采样上做中位切分(采样很少 很快), 再用k-means迭代几次修正
+def build_palette(samples, colors=256, iterations=2):
+    strip = Image.fromarray(np.ascontiguousarray(samples.reshape(1, -1, 3)), 'RGB')
+    quantized = strip.quantize(colors, method=Image.Quantize.MEDIANCUT)
+    used = int(np.asarray(quantized).max()) + 1
+    palette = np.array(quantized.getpalette()[:used * 3], dtype=np.uint8).reshape(-1, 3)
+    for _ in range(iterations):
+        labels = nearest(samples, palette)
+        counts = np.bincount(labels, minlength=len(palette))
+        sums = np.zeros((len(palette), 3))
+        np.add.at(sums, labels, samples)
+        filled = counts > 0
+        palette[filled] = np.rint(sums[filled] / counts[filled, None]).astype(np.uint8)
+    return palette
+
+
+# 所有帧共用的调色板:
+# 颜色查找表把每个通道截到LUT_BITS位 每个格子对应格子中心最近的颜色, 映射一帧只需要一次数组下标
+class GlobalPalette(object):
+    def __init__(self, palette, bits=LUT_BITS):
+        self.palette = palette
+        self.bits = bits
+        step = 1 << (8 - bits)
+        cells = np.arange(1 << (3 * bits))
+        mask = (1 << bits) - 1
+        centers = np.stack([(cells >> (2 * bits)) & mask, (cells >> bits) & mask, cells & mask], axis=1)
+        self.lut = nearest(centers * step + step // 2, palette)
+
+    @classmethod
+    def from_zip(cls, zip_path, frames, colors=256, samples=1 << 16):
+        return cls(build_palette(sample_pixels(zip_path, frames, samples), colors))
+
+    # 全局颜色表 768字节
+    def palette_bytes(self):
+        return self.palette.astype(np.uint8).tobytes().ljust(768, b'\x00')
+
+    # 一帧映射为调色板下标 (高, 宽) uint8
+    def indices(self, image):
+        rgb = np.asarray(image.convert('RGB'))
+        shift = 8 - self.bits
+        key = (rgb[..., 0].astype(np.int32) >> shift) << (2 * self.bits)
+        key |= (rgb[..., 1].astype(np.int32) >> shift) << self.bits
+        key |= rgb[..., 2].astype(np.int32) >> shift
+        return self.lut[key]
+
+    def to_image(self, indices):
+        image = Image.fromarray(np.ascontiguousarray(indices), 'P')
+        image.putpalette(self.palette_bytes())
+        return image
+
+
+# 两帧下标不同的区域 (左, 上, 右, 下) 完全相同时返回None
+def changed_box(previous, current):
+    diff = previous != current
+    rows = np.flatnonzero(diff.any(axis=1))
+    if not len(rows):
+        return None
+    cols = np.flatnonzero(diff.any(axis=0))
+    return cols[0], rows[0], cols[-1] + 1, rows[-1] + 1
+
+
+# 按全局调色板逐帧编码 返回(P模式的Image, 延时, 位置)的迭代器
+# crop 为True时第二帧起只输出和上一帧不同的矩形区域 (帧的处置方式为保留, 其他部分沿用上一帧)
+def encode_frames(zip_path, frames, global_palette, crop=True):
+    previous = None
+    for image, delay in ugoira.iter_frames(zip_path, frames):
+        current = global_palette.indices(image)
+        offset = (0, 0)
+        region = current
+        if crop and previous is not None:
+            box = changed_box(previous, current)
+            # 没有变化的帧只写一个像素 保留延时
+            left, top, right, bottom = box if box is not None else (0, 0, 1, 1)
+            region = current[top:bottom, left:right]
+            offset = (int(left), int(top))
+        previous = current
+        yield global_palette.to_image(region), delay, offset
+
+
+# 动图zip转gif 使用全局调色板: 第一遍(缩小解码)采样建立调色板, 第二遍逐帧映射写入
+# 没有抖动 所有帧颜色一致, 不会闪烁
+def zip_to_gif(zip_path, gif_path, frames, colors=256, crop=True, loop=65535):
+    global_palette = GlobalPalette.from_zip(zip_path, frames, colors)
+    return ugoira.write_gif(gif_path, encode_frames(zip_path, frames, global_palette, crop), loop,
+                            global_palette.palette_bytes())
@@ -0,0 +1,107 @@
+# encoding=utf-8
+import asyncio
+import threading
+import time
+from multiprocessing.managers import BaseManager
+
+
+# 令牌桶: 每秒补充rate个令牌, 最多存capacity个(允许的突发量)
+# reserve(n) 预订n个令牌 返回需要等待的秒数; 令牌可以透支, 之后的请求排在后面等待, 不会互相抢
+# 线程安全; 放在manager进程中时所有进程共用一个桶
+class TokenBucket(object):
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    # 本地的桶pickle到子进程后是独立的一个桶 (多进程共用请使用shared_bucket)
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def reserve(self, n=1):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= n
+            return max(0.0, -self._tokens / self.rate)
+
+
+class _BucketManager(BaseManager):
+    pass
+
+
+_BucketManager.register('TokenBucket', TokenBucket)
+_manager = None
+_manager_lock = threading.Lock()
+
+
+# 建立放在manager进程中的令牌桶 返回代理对象 (可以pickle传给进程池中的子进程)
+# 一个进程只启动一个manager, 在进程退出时关闭
+def shared_bucket(rate, capacity=None):
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = _BucketManager()
+            _manager.start()
+        return _manager.TokenBucket(rate, capacity)
+
+
+# 限速器: 包装一个令牌桶(本地的TokenBucket或shared_bucket的代理), 按需要等待并统计等待时间
+# acquire(n) 线程中使用 返回等待的秒数; aacquire(n) 协程中使用
+# 共用的桶(manager代理)每次预订都是一次进程间通信 aacquire在线程池中预订, 不阻塞事件循环
+# 统计只在当前进程中累计
+class RateLimiter(object):
+    def __init__(self, bucket, name=''):
+        self.bucket = bucket
+        self.name = name
+        self.count = 0
+        self.waited = 0.0
+        self.max_wait = 0.0
+
+    def _reserve(self, n):
+        return self._record(self.bucket.reserve(n))
+
+    def _record(self, wait):
+        self.count += 1
+        self.waited += wait
+        if wait > self.max_wait:
+            self.max_wait = wait
+        return wait
+
+    def acquire(self, n=1):
+        wait = self._reserve(n)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def aacquire(self, n=1):
+        if isinstance(self.bucket, TokenBucket):
+            wait = self._reserve(n)
+        else:
+            loop = asyncio.get_running_loop()
+            wait = self._record(await loop.run_in_executor(None, self.bucket.reserve, n))
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def metrics(self):
+        return {'name': self.name, 'count': self.count, 'waited': self.waited, 'max_wait': self.max_wait,
+                'average_wait': self.waited / self.count if self.count else 0.0}
+
+
+# 按参数建立限速器 rate为None时返回None(不限速)
+# shared为True时令牌桶放在manager进程中, 多进程共用一个预算
+def rate_limiter(rate, capacity=None, shared=True, name=''):
+    if rate is None:
+        return None
+    bucket = shared_bucket(rate, capacity) if shared else TokenBucket(rate, capacity)
+    return RateLimiter(bucket, name)
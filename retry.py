@@ -0,0 +1,220 @@
+# encoding=utf-8
+import asyncio
+import email.utils
+import random
+import threading
+import time
+from collections import Counter
+
+import requests
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class TryError(requests.exceptions.RequestException):
+    pass
+
+
+# 错误分类
+CONNECT = 'connect'        # 连接失败 连接超时
+TIMEOUT = 'timeout'        # 读取超时
+READ = 'read'              # 传输中断 内容不完整
+SERVER = '5xx'             # 服务器错误
+THROTTLED = '429'          # 请求过多 (可能带Retry-After)
+CLIENT = '4xx'             # 请求本身的问题 重试没有用
+FATAL = 'fatal'            # 其他异常 不重试
+
+RETRYABLE = (CONNECT, TIMEOUT, READ, SERVER, THROTTLED)
+
+
+# 按状态码分类 2xx 3xx 返回None
+def classify_status(status):
+    if status is None or status < 400:
+        return None
+    if status == 429:
+        return THROTTLED
+    if status >= 500:
+        return SERVER
+    return CLIENT
+
+
+# 按异常分类 TryError(状态码, ...) 按状态码分类
+def classify_error(error):
+    if isinstance(error, TryError):
+        if error.args and isinstance(error.args[0], int):
+            return classify_status(error.args[0])
+        return FATAL
+    if isinstance(error, (requests.exceptions.ConnectTimeout, requests.exceptions.ConnectionError)):
+        return CONNECT
+    if isinstance(error, requests.exceptions.Timeout):
+        return TIMEOUT
+    if isinstance(error, requests.exceptions.RequestException):
+        return READ
+    if isinstance(error, asyncio.TimeoutError):
+        return TIMEOUT
+    if aiohttp is not None:
+        if isinstance(error, aiohttp.ClientConnectionError) and not isinstance(error, aiohttp.ServerDisconnectedError):
+            return CONNECT
+        if isinstance(error, aiohttp.ClientResponseError):
+            return classify_status(error.status) or FATAL
+        if isinstance(error, aiohttp.ClientError):
+            return READ
+    return FATAL
+
+
+# Retry-After: 秒数 或 HTTP日期 返回秒数(不能解析返回None)
+def parse_retry_after(value):
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+# requests.Response 的(状态码, Retry-After) 其他结果返回(None, None)
+def inspect_response(result):
+    status = getattr(result, 'status_code', None)
+    if status is None:
+        return None, None
+    return status, result.headers.get('Retry-After')
+
+
+# 重试的统计 同一个策略派生出的策略共用; 每个进程分别计数
+class RetryStats(object):
+    def __init__(self):
+        self.counter = Counter()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def add(self, key, n=1):
+        with self._lock:
+            self.counter[key] += n
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counter)
+
+
+# 重试策略:
+# max_attempts 最多尝试的次数(包括第一次); deadline 一次操作(包括等待)最多的秒数, None不限制
+# 第n次重试前等待 random.uniform(0, min(max_delay, base_delay * 2 ** n)) 秒 (full jitter, 许多线程同时出错时不会同时重试)
+# 429 带Retry-After时至少等待Retry-After秒
+# 4xx(429除外)和其他异常不重试
+# 统计: attempts 请求次数, retries 重试次数, retry.<分类> 各类错误的重试次数, gave_up 放弃的次数, waited 等待的总秒数
+class RetryPolicy(object):
+    def __init__(self, max_attempts=8, base_delay=0.5, max_delay=30, deadline=300, stats=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.stats = stats or RetryStats()
+
+    # 修改部分参数的策略 共用统计
+    def derive(self, **kwargs):
+        options = dict(max_attempts=self.max_attempts, base_delay=self.base_delay, max_delay=self.max_delay,
+                       deadline=self.deadline)
+        options.update(kwargs)
+        return RetryPolicy(stats=self.stats, **options)
+
+    def metrics(self):
+        return self.stats.snapshot()
+
+    def backoff(self, retry, retry_after=None):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retry))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    # 第attempt次尝试失败后 返回需要等待的秒数, 不能再重试返回None
+    def _next_delay(self, kind, attempt, start, retry_after=None):
+        if kind not in RETRYABLE or attempt >= self.max_attempts:
+            self.stats.add('gave_up' if kind in RETRYABLE else 'not_retryable')
+            return None
+        delay = self.backoff(attempt - 1, retry_after)
+        if self.deadline is not None and time.monotonic() - start + delay > self.deadline:
+            self.stats.add('gave_up')
+            self.stats.add('deadline')
+            return None
+        self.stats.add('retries')
+        self.stats.add('retry.' + kind)
+        self.stats.add('waited', delay)
+        return delay
+
+    # 执行func()直到成功:
+    # func 抛出可重试的异常时重试, 不能再重试时抛出TryError(最后的异常, "过多的尝试"), 不可重试的异常直接抛出
+    # inspect(结果) 返回(状态码, Retry-After) 状态码为5xx或429时重试, 不能再重试时返回最后的结果
+    def run(self, func, inspect=inspect_response):
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            self.stats.add('attempts')
+            try:
+                result = func()
+            except Exception as error:
+                delay = self._next_delay(classify_error(error), attempt, start, self._error_retry_after(error))
+                if delay is None:
+                    if classify_error(error) in RETRYABLE:
+                        raise TryError(error, "过多的尝试")
+                    raise
+                time.sleep(delay)
+                continue
+            status, retry_after = inspect(result)
+            kind = classify_status(status)
+            if kind in (SERVER, THROTTLED):
+                delay = self._next_delay(kind, attempt, start, parse_retry_after(retry_after))
+                if delay is not None:
+                    if hasattr(result, 'close'):
+                        result.close()
+                    time.sleep(delay)
+                    continue
+            return result
+
+    # run的协程版本 func()返回awaitable
+    async def arun(self, func, inspect=inspect_response):
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            self.stats.add('attempts')
+            try:
+                result = await func()
+            except Exception as error:
+                delay = self._next_delay(classify_error(error), attempt, start, self._error_retry_after(error))
+                if delay is None:
+                    if classify_error(error) in RETRYABLE:
+                        raise TryError(error, "过多的尝试")
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            status, retry_after = inspect(result)
+            kind = classify_status(status)
+            if kind in (SERVER, THROTTLED):
+                delay = self._next_delay(kind, attempt, start, parse_retry_after(retry_after))
+                if delay is not None:
+                    await asyncio.sleep(delay)
+                    continue
+            return result
+
+    # TryError(429, Retry-After) 中的Retry-After
+    @staticmethod
+    def _error_retry_after(error):
+        if isinstance(error, TryError) and len(error.args) > 1 and error.args[0] == 429:
+            return parse_retry_after(error.args[1])
+        return None
@@ -0,0 +1,171 @@
+# encoding=utf-8
+import mmap
+import os
+import struct
+import threading
+from array import array
+from heapq import merge
+
+# 已经下载过的作品id集合(持久化, 所有入口共用), 在请求作品页面之前跳过已下载的作品
+# path.bloom: 布隆过滤器的位数组 (mmap), 大部分没见过的id在这里就能确定不存在, 不用读id文件
+# path.ids: 从小到大排列的id (8字节无符号整数 本机字节序, mmap), 布隆过滤器命中后二分查找确认
+# path.log: 新加入的id先追加到这里, 超过merge_size个(或close时)合并进path.ids
+# capacity: 预计的id数量, 决定位数组大小(约每个id 10位, 误判率约1%), 文件建立后不再改变
+class SeenSet(object):
+    ID_SIZE = 8
+    HASH_COUNT = 7
+
+    def __init__(self, path, capacity=10000000, merge_size=100000):
+        self.path = path
+        self.merge_size = merge_size
+        self._lock = threading.RLock()
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        # 布隆过滤器
+        bloom_path = path + '.bloom'
+        if not os.path.exists(bloom_path):
+            with open(bloom_path, 'wb') as f:
+                f.truncate(max(capacity * 10 // 8, 1024))
+        self._bloom_file = open(bloom_path, 'r+b')
+        self._bloom = mmap.mmap(self._bloom_file.fileno(), 0)
+        self.bits = len(self._bloom) * 8
+        # 排序的id文件
+        self._ids_file = None
+        self._ids = None
+        self._open_ids()
+        # 未合并的新id
+        self.pending = set()
+        if os.path.exists(path + '.log'):
+            with open(path + '.log', 'rb') as f:
+                data = f.read()
+            # 写到一半的记录丢弃
+            data = data[:len(data) - len(data) % self.ID_SIZE]
+            self.pending.update(array('Q', data))
+            # 进程异常退出时位数组可能没有写回 重新设置
+            for illust_id in self.pending:
+                self._set_bits(illust_id)
+        self._log = open(path + '.log', 'ab')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return self.count + len(self.pending)
+
+    def __contains__(self, illust_id):
+        with self._lock:
+            return self._contains(int(illust_id))
+
+    def _contains(self, illust_id):
+        for bit in self._bit_positions(illust_id):
+            if not self._bloom[bit >> 3] & (1 << (bit & 7)):
+                return False
+        if illust_id in self.pending:
+            return True
+        return self._search(illust_id)
+
+    def _close_ids(self):
+        if self._ids is not None:
+            self._ids.close()
+            self._ids_file.close()
+            self._ids = None
+
+    def _open_ids(self):
+        ids_path = self.path + '.ids'
+        self.count = os.path.getsize(ids_path) // self.ID_SIZE if os.path.exists(ids_path) else 0
+        if self.count:
+            self._ids_file = open(ids_path, 'rb')
+            self._ids = mmap.mmap(self._ids_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # 双重哈希得到HASH_COUNT个位置
+    def _bit_positions(self, illust_id):
+        h1 = (illust_id * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        h2 = ((illust_id ^ (illust_id >> 31)) * 0xBF58476D1CE4E5B9 & 0xFFFFFFFFFFFFFFFF) | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.HASH_COUNT)]
+
+    def _set_bits(self, illust_id):
+        for bit in self._bit_positions(illust_id):
+            self._bloom[bit >> 3] |= 1 << (bit & 7)
+
+    # 在id文件中二分查找
+    def _search(self, illust_id):
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            value = struct.unpack_from('=Q', self._ids, middle * self.ID_SIZE)[0]
+            if value < illust_id:
+                low = middle + 1
+            elif value > illust_id:
+                high = middle
+            else:
+                return True
+        return False
+
+    # 加入一个id 可以在多个线程中调用
+    def add(self, illust_id):
+        illust_id = int(illust_id)
+        with self._lock:
+            if self._contains(illust_id):
+                return
+            self._set_bits(illust_id)
+            self.pending.add(illust_id)
+            self._log.write(struct.pack('=Q', illust_id))
+            self._log.flush()
+            if len(self.pending) >= self.merge_size:
+                self._merge()
+
+    def update(self, illust_ids):
+        for illust_id in illust_ids:
+            self.add(illust_id)
+
+    # 返回illust_id_list中没有见过的id (保持顺序, 列表中重复的id只保留一个)
+    def filter(self, illust_id_list):
+        result = []
+        listed = set()
+        for illust_id in illust_id_list:
+            if int(illust_id) not in listed and illust_id not in self:
+                listed.add(int(illust_id))
+                result.append(illust_id)
+        return result
+
+    # 把log中的id合并进排序的id文件 (写临时文件后替换)
+    def _merge(self):
+        if not self.pending:
+            return
+        # 直接遍历mmap 不把整个id文件读进内存
+        old = memoryview(self._ids).cast('Q') if self.count else memoryview(array('Q'))
+        temp_path = self.path + '.ids.tmp'
+        with open(temp_path, 'wb') as f:
+            out = array('Q')
+            last = None
+            for value in merge(old, sorted(self.pending)):
+                if value != last:
+                    out.append(value)
+                    last = value
+                if len(out) >= 65536:
+                    out.tofile(f)
+                    out = array('Q')
+            out.tofile(f)
+        old.release()
+        self._close_ids()
+        os.replace(temp_path, self.path + '.ids')
+        self._open_ids()
+        self._log.close()
+        self._log = open(self.path + '.log', 'wb')
+        self.pending = set()
+
+    def flush(self):
+        with self._lock:
+            self._merge()
+            self._bloom.flush()
+
+    def close(self):
+        self.flush()
+        self._log.close()
+        self._bloom.close()
+        self._bloom_file.close()
+        self._close_ids()
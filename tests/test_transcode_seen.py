@@ -0,0 +1,54 @@
+# encoding=utf-8
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zipfile
+
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pixivspider
+
+UGOKU_DATA = '"src":"x","frames":[' + ','.join('{"file":"%06d.jpg","delay":60}' % i for i in range(3)) + ']'
+
+
+# 不访问网络: 作品页面直接生成一个动图zip 交给transcode_ugoira
+class UgoiraSpider(pixivspider.PixivSpiderLogin):
+    def run_pixiv_page(self, illust_id, path):
+        zip_path = path + 'id=%d.zip' % illust_id
+        with zipfile.ZipFile(zip_path, 'w') as file_zip:
+            for i in range(3):
+                data = io.BytesIO()
+                Image.new('RGB', (16, 16), (i * 80, 0, 0)).save(data, 'JPEG')
+                file_zip.writestr('%06d.jpg' % i, data.getvalue())
+        return self.transcode_ugoira(illust_id, path, zip_path, UGOKU_DATA)
+
+
+# 经过转码进程池完成的动图 加入seen, 下一次运行时被filter_seen跳过
+class TranscodeSeenTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp() + '/'
+        self.path = self.root + 'd/'
+        os.makedirs(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.root, True)
+
+    def test_transcoded_ugoira_is_seen(self):
+        spider = UgoiraSpider(self.root, use_cache=False, num_processes=1, max_processes=1, transcode_processes=1,
+                              seen_path=self.root + 'seen')
+        spider.async_run_pixiv_page([8], self.path)
+        self.assertTrue(os.path.exists(self.path + 'id=8.gif'))
+        self.assertEqual(spider.job_queue.counts(self.path), {'done': 1})
+        seen = spider.open_seen_set()
+        try:
+            self.assertEqual(spider.filter_seen([8, 9], seen, self.path), [9])
+        finally:
+            seen.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+# encoding=utf-8
+import abc
+import hashlib
+import os
+import sqlite3
+import threading
+
+import pixivdb
+
+
+# 缩略图存储的接口: 数据库中只保存put返回的key(img_hash列), 图片本身放在存储里
+# put(data) 保存bytes 返回key; get(key) 取回bytes, 不存在返回None; exists(key)
+# 想换成别的存储(例如对象存储)时继承这个类 实现put和get(exists可选), 传给PixivSpiderLogin(thumbnail_store=...)
+class ThumbnailStore(abc.ABC):
+    @abc.abstractmethod
+    def put(self, data):
+        pass
+
+    @abc.abstractmethod
+    def get(self, key):
+        pass
+
+    def exists(self, key):
+        return self.get(key) is not None
+
+
+# 默认的存储: 按内容寻址的本地目录
+# key 为图片的sha1, 文件存放在 root/前两位/接下来两位/sha1 (每层最多256个子目录, 避免单个目录文件过多)
+# 同样的图片只保存一份; 先写临时文件再os.replace, 多线程写入同一张图也不会出现半个文件
+class FileThumbnailStore(ThumbnailStore):
+    def __init__(self, root):
+        self.root = root if root.endswith('/') else root + '/'
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key_of(data):
+        return hashlib.sha1(data).hexdigest()
+
+    def path(self, key):
+        return self.root + key[:2] + '/' + key[2:4] + '/' + key
+
+    def put(self, data):
+        key = self.key_of(data)
+        path = self.path(key)
+        if os.path.exists(path):
+            return key
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            with self._lock:
+                if not os.path.exists(directory):
+                    os.makedirs(directory)
+        temp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        return key
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'rb') as f:
+                return f.read()
+        except (FileNotFoundError, TypeError):
+            return None
+
+    def exists(self, key):
+        return key is not None and os.path.exists(self.path(key))
+
+
+# 数据库 Pixiv.db 缺省的缩略图目录 Pixiv_thumbnails/
+def default_root(db_path):
+    return os.path.splitext(db_path)[0] + '_thumbnails/'
+
+
+# 把旧数据库img列中的缩略图移到store, img列清空, 写入img_hash
+# 每batch_size张提交一次; vacuum为True时最后整理数据库文件 释放空间
+def migrate_thumbnails(db_path, store=None, batch_size=500, vacuum=True):
+    store = store or FileThumbnailStore(default_root(db_path))
+    conn = pixivdb.connect(db_path)
+    moved = 0
+    try:
+        tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        for table in tables:
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(%s)' % table)]
+            if 'img' not in columns:
+                continue
+            pixivdb.add_thumbnail_column(conn, table)
+            while True:
+                rows = conn.execute("SELECT illust_id, img FROM %s WHERE img IS NOT NULL AND img != '' LIMIT ?"
+                                    % table, (batch_size,)).fetchall()
+                if not rows:
+                    break
+                with conn:
+                    conn.executemany('UPDATE %s SET img = NULL, img_hash = ? WHERE illust_id = ?' % table,
+                                     [(store.put(bytes(img)), illust_id) for illust_id, img in rows])
+                moved += len(rows)
+                print('\r%s %d' % (table, moved), end='')
+        print()
+        if vacuum and moved:
+            conn.execute('VACUUM')
+    except sqlite3.Error as error:
+        print(error)
+    finally:
+        conn.close()
+    return moved
+
+
+if __name__ == '__main__':
+    import sys
+
+    # python thumbstore.py Pixiv.db [缩略图目录] 把数据库中的缩略图移到目录中
+    if len(sys.argv) < 2:
+        print('python thumbstore.py Pixiv.db [缩略图目录]')
+    else:
+        _store = FileThumbnailStore(sys.argv[2]) if len(sys.argv) > 2 else None
+        print(sys.argv[1], migrate_thumbnails(sys.argv[1], _store), 'moved')
@@ -0,0 +1,155 @@
+# encoding=utf-8
+import multiprocessing
+import os
+import threading
+import zipfile
+
+import ugoira
+
+try:
+    import quantize
+except ImportError:
+    quantize = None
+
+# 支持的输出格式: 扩展名
+FORMATS = {'gif': '.gif', 'webp': '.webp', 'apng': '.apng'}
+# 已经交给转码进程 结果在Transcoder的回调中处理
+QUEUED = 'queued'
+
+
+# zip对应的输出文件 [(格式, 路径)]
+def output_paths(zip_path, formats):
+    return [(fmt, zip_path[:-4] + FORMATS[fmt]) for fmt in formats]
+
+
+# 动画webp和apng: Pillow的编码器需要全部帧, 帧转换为RGBA后一次保存 (无损)
+def _save_animation(zip_path, out_path, frames, fmt):
+    images = []
+    durations = []
+    for image, delay in ugoira.iter_frames(zip_path, frames):
+        images.append(image.convert('RGBA'))
+        durations.append(delay)
+    temp_path = out_path + '.tmp'
+    if fmt == 'webp':
+        images[0].save(temp_path, format='WEBP', save_all=True, append_images=images[1:], duration=durations,
+                       loop=0, lossless=True)
+    else:
+        images[0].save(temp_path, format='PNG', save_all=True, append_images=images[1:], duration=durations,
+                       loop=0)
+    os.replace(temp_path, out_path)
+
+
+# 把一个动图zip转换为formats中的格式 已存在的输出跳过 返回输出文件路径的列表, 不是zip文件时返回[]
+# gif 安装了numpy时使用全局调色板(quantize), 否则每一帧单独计算调色板
+# 在转码进程中执行, 参数都可以pickle; 写入清单等在主进程的回调中进行
+def transcode(zip_path, ugoku_data, formats=('gif',)):
+    if not zipfile.is_zipfile(zip_path):
+        print('This file is not zip file')
+        return []
+    frames = ugoira.ugoira_frames(ugoku_data)
+    outputs = []
+    for fmt, out_path in output_paths(zip_path, formats):
+        if os.path.exists(out_path):
+            print('file exist')
+        elif fmt == 'gif' and quantize is not None:
+            quantize.zip_to_gif(zip_path, out_path, frames)
+        elif fmt == 'gif':
+            ugoira.zip_to_gif(zip_path, out_path, frames)
+        else:
+            _save_animation(zip_path, out_path, frames, fmt)
+        outputs.append(out_path)
+    return outputs
+
+
+# 交给转码进程的队列 (manager的Queue代理 可以pickle传给下载进程)
+# put 立即返回, 下载进程不等待转码
+class TranscodeQueue(object):
+    def __init__(self, queue, formats):
+        self.queue = queue
+        self.formats = tuple(formats)
+
+    def put(self, zip_path, ugoku_data, illust_id=None, directory=None):
+        self.queue.put((zip_path, ugoku_data, self.formats, illust_id, directory))
+
+
+# 独立的转码阶段: 进程池 + 队列
+# 下载进程(线程)通过handle()得到的TranscodeQueue提交任务后继续下载, 主进程中的分发线程从队列取出任务交给进程池
+# 网络和CPU的工作同时进行; close()等待队列中的任务全部完成
+# callback(zip_path, illust_id, directory, 输出文件列表) 转码完成, error_callback(zip_path, illust_id, directory, 异常)
+# 转码失败 都在主进程中执行
+class Transcoder(object):
+    def __init__(self, formats=('gif',), processes=None, callback=None, error_callback=None):
+        for fmt in formats:
+            if fmt not in FORMATS:
+                raise ValueError('不支持的格式 %s' % fmt)
+        self.formats = tuple(formats)
+        self.processes = processes
+        self.callback = callback
+        self.error_callback = error_callback
+        self.submitted = 0
+        self.done = 0
+        self.failed = 0
+        self._manager = multiprocessing.Manager()
+        self._queue = self._manager.Queue()
+        self._pool = multiprocessing.Pool(processes)
+        self._lock = threading.Lock()
+        self._dispatcher = threading.Thread(target=self._dispatch)
+        self._dispatcher.daemon = True
+        self._dispatcher.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def handle(self):
+        return TranscodeQueue(self._queue, self.formats)
+
+    def _dispatch(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            with self._lock:
+                self.submitted += 1
+            # (zip_path, illust_id, directory)
+            info = (job[0],) + job[3:]
+            self._pool.apply_async(transcode, args=job[:3],
+                                   callback=lambda outputs, _info=info: self._callback(_info, outputs),
+                                   error_callback=lambda error, _info=info: self._error(_info, error))
+
+    def _callback(self, info, outputs):
+        if outputs:
+            print(outputs[-1].split('/')[-1], '转码完成')
+        try:
+            if self.callback is not None:
+                self.callback(*info, outputs)
+        finally:
+            with self._lock:
+                self.done += 1
+
+    def _error(self, info, error):
+        print(info[0], error)
+        try:
+            if self.error_callback is not None:
+                self.error_callback(*info, error)
+        finally:
+            with self._lock:
+                self.failed += 1
+
+    # 还没有完成的转码任务数 (包括队列中还没有分发的)
+    def pending(self):
+        with self._lock:
+            return self._queue.qsize() + self.submitted - self.done - self.failed
+
+    def metrics(self):
+        with self._lock:
+            return {'done': self.done, 'failed': self.failed}
+
+    def close(self):
+        self._queue.put(None)
+        self._dispatcher.join()
+        self._pool.close()
+        self._pool.join()
+        self._manager.shutdown()
@@ -0,0 +1,110 @@
+# encoding=utf-8
+import io
+import json
+import os
+import struct
+import zipfile
+
+from PIL import Image, GifImagePlugin
+
+# 由gif标准 浏览器会把小于20ms的延时当作100ms, 小于20的按20保存
+MIN_DELAY = 20
+
+
+# 作品页面中的 pixiv.context.ugokuIllustFullscreenData (去掉外层大括号的部分) 解析为dict
+def parse_ugoku_data(ugoku_data):
+    if isinstance(ugoku_data, dict):
+        return ugoku_data
+    return json.loads('{%s}' % ugoku_data)
+
+
+# 帧的顺序和延时 [(zip中的文件名, 延时ms)]
+def ugoira_frames(ugoku_data):
+    return [(frame['file'], max(int(frame['delay']), MIN_DELAY)) for frame in parse_ugoku_data(ugoku_data)['frames']]
+
+
+# 按frames的顺序从zip中逐帧读取解码 每次只有一帧在内存中 返回(Image, 延时)的迭代器
+# 帧直接从zip中读取, 不解压到硬盘
+# reduce 大于1时jpeg按1/reduce的大小解码(只需要颜色统计时使用 快很多)
+def iter_frames(zip_path, frames, reduce=1):
+    with zipfile.ZipFile(zip_path, 'r') as file_zip:
+        for name, delay in frames:
+            with file_zip.open(name) as f:
+                image = Image.open(io.BytesIO(f.read()))
+                if reduce > 1:
+                    image.draft('RGB', (image.size[0] // reduce, image.size[1] // reduce))
+                image.load()
+            yield image, delay
+
+
+# 每一帧单独计算调色板 (原来的转换方式)
+def adaptive_quantize(image):
+    return image.convert('RGB').convert('P', palette=Image.ADAPTIVE, dither=Image.FLOYDSTEINBERG)
+
+
+# 逐帧写入的gif:
+# 文件头只包含画面大小和循环次数, 每一帧带自己的调色板(局部颜色表), 写完一帧就可以丢弃
+# palette 为所有帧共用的调色板(768字节的RGB)时写入全局颜色表, 帧不再带局部颜色表
+# add_frame(image, duration, offset) image为P模式; offset为这一帧在画面中的位置(只写变化的区域时使用)
+class GifWriter(object):
+    def __init__(self, fp, size, loop=65535, palette=None):
+        self.fp = fp
+        self.size = size
+        self.frames = 0
+        self.palette = palette
+        if palette is None:
+            # 逻辑屏幕描述: 宽 高 无全局颜色表(颜色深度8位) 背景色 像素比
+            fp.write(b'GIF89a' + struct.pack('<HHBBB', size[0], size[1], 0x70, 0, 0))
+        else:
+            # 256色的全局颜色表
+            fp.write(b'GIF89a' + struct.pack('<HHBBB', size[0], size[1], 0xf7, 0, 0))
+            fp.write(bytes(palette[:768]).ljust(768, b'\x00'))
+        # NETSCAPE2.0 循环次数
+        fp.write(b'!\xff\x0bNETSCAPE2.0\x03\x01' + struct.pack('<H', loop) + b'\x00')
+
+    def add_frame(self, image, duration, offset=(0, 0), disposal=1):
+        for data in GifImagePlugin.getdata(image, offset, duration=duration, disposal=disposal,
+                                           include_color_table=self.palette is None):
+            self.fp.write(data)
+        self.frames += 1
+
+    def close(self):
+        self.fp.write(b';')
+
+
+# 把encoded中的帧写成gif 返回帧数
+# encoded 为(P模式的Image, 延时, 位置)的迭代器, 第一帧是完整的画面; palette 见GifWriter
+# 先写入临时文件 完成后改名, 中断不会留下不完整的gif
+def write_gif(gif_path, encoded, loop=65535, palette=None):
+    temp_path = gif_path + '.tmp'
+    writer = None
+    try:
+        with open(temp_path, 'wb') as fp:
+            for image, delay, offset in encoded:
+                if writer is None:
+                    writer = GifWriter(fp, image.size, loop, palette)
+                writer.add_frame(image, delay, offset)
+            if writer is None:
+                raise ValueError('%s 中没有帧' % gif_path)
+            writer.close()
+        os.replace(temp_path, gif_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return writer.frames
+
+
+# 动图zip转gif: 逐帧解码 量化 写入, 峰值内存只有一帧
+# frames 为ugoira_frames的结果; quantize(RGB或其他模式的Image) 返回P模式的Image
+def zip_to_gif(zip_path, gif_path, frames, quantize=adaptive_quantize, loop=65535):
+    return write_gif(gif_path, ((quantize(image), delay, (0, 0)) for image, delay in iter_frames(zip_path, frames)),
+                     loop)
+
+
+# 作品页面的ugoku_data 直接转换
+def ugoira_to_gif(zip_path, gif_path, ugoku_data):
+    if not zipfile.is_zipfile(zip_path):
+        print('This file is not zip file')
+        return 0
+    return zip_to_gif(zip_path, gif_path, ugoira_frames(ugoku_data))
@@ -0,0 +1,98 @@
+# encoding=utf-8
+import queue
+import threading
+
+
+# 提交到WorkerPool的一个任务 保存结果或者异常
+class Task(object):
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.result = None
+        self.exception = None
+        self._done = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except BaseException as error:
+            self.exception = error
+        finally:
+            self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    # 等待任务结束 返回结果 任务抛出异常时重新抛出
+    def get(self, timeout=None):
+        self.wait(timeout)
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+
+# 固定数量的常驻线程 + 有界任务队列:
+# num_workers: 工作线程数
+# queue_size: 等待队列长度(缺省为num_workers的两倍) 队列满时submit阻塞 即背压
+# 只统计自己的线程 不受其他线程(如数据库消费线程)的影响
+class WorkerPool(object):
+    def __init__(self, num_workers, queue_size=None):
+        if num_workers < 1:
+            num_workers = 1
+        if queue_size is None:
+            queue_size = num_workers * 2
+        self.num_workers = num_workers
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._closed = False
+        self._workers = []
+        for _ in range(num_workers):
+            t = threading.Thread(target=self._worker)
+            t.daemon = True
+            t.start()
+            self._workers.append(t)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+    def _worker(self):
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    return
+                task.run()
+            finally:
+                self._queue.task_done()
+
+    # 提交一个任务 返回Task
+    def submit(self, func, *args):
+        if self._closed:
+            raise RuntimeError('WorkerPool已经关闭')
+        task = Task(func, args)
+        self._queue.put(task)
+        return task
+
+    # args_list 为参数元组的可迭代对象 返回Task列表(顺序与参数一致)
+    def map(self, func, args_list):
+        return [self.submit(func, *args) for args in args_list]
+
+    # 等待已提交的任务全部完成
+    def join(self):
+        self._queue.join()
+
+    # 关闭线程池 wait为True时等待已提交的任务完成
+    def shutdown(self, wait=True):
+        if self._closed:
+            return
+        self._closed = True
+        for _ in self._workers:
+            self._queue.put(None)
+        if wait:
+            for t in self._workers:
+                t.join()